@@ -130,6 +130,26 @@ def run_analysis_comfile(comfile, analysis):
             comfile], stdout = f)
 
 
+def analysis_file_name(analysisdir, design):
+    """Constructs the name of a new analysis file from its array design file
+
+    Inputs:
+        analysisdir: the directory in which to save the analysis file
+        design: path to the array design file
+            This file should be named '*DNAFront_BCBottom*.tdt'
+
+    Output:
+        the path to the analysis file to create
+    """
+    # Extract ID number from filename of design file
+    endID = design.index('_D_DNAFront_BCBottom')
+    startID = design.rindex('_', 0, endID) + 1
+    ID = design[startID:endID]
+
+    # Construct analysis file name
+    return(analysisdir + '/ID_' + ID + '_genomic_analysis.txt')
+
+
 def analysis_file_wrapper(analysisdir):
     """Checks for an analysis file and creates one if it doesn't exist
 
@@ -152,13 +172,8 @@ def analysis_file_wrapper(analysisdir):
         make_analysis_comfile(analysis[0], analysis[1],
                 analysis[2], analysiscom)
 
-        # Extract ID number from filename of design file
-        endID = analysis[0].index('_D_DNAFront_BCBottom')
-        startID = analysis[0].rindex('_', 0, endID) + 1
-        ID = analysis[0][startID:endID]
-
         # Construct analysis file name
-        analysisfile = analysisdir + '/ID_' + ID + '_genomic_analysis.txt'
+        analysisfile = analysis_file_name(analysisdir, analysis[0])
 
         # Run analysis comfile
         run_analysis_comfile(analysiscom, analysisfile)
@@ -2,6 +2,9 @@ import subprocess
 import glob
 import logging
 from natsort import natsorted
+import submit_job
+import job_history
+import pipeline_files
 from prevent_overwrite import prevent_overwrite
 
 def make_norm_gpr_list(normgprdir, normgprlist):
@@ -42,15 +45,30 @@ def make_average_probes_comfile(normgprlist, avgtype, comfile):
 
     # Open comfile for writing
     with open(comfile, 'w') as f:
-        f.write('perl /project/siggers/perl/GENEPIX/' +
-                'average_replicate_rc_custom_probes.pl\n\n')
-        f.write('-l ' + normgprlist + '\n')
-        f.write('-op ' + avgtype + '\n')
-        f.write('-avg ' + avgtype + '\n')
-        f.write('-no_gfilter')
+        f.write(average_probes_command(normgprlist, avgtype))
 
 
-def run_average_probes_comfile(comfile, avgtype):
+def average_probes_command(normgprlist, avgtype):
+    """Writes the contents of a comfile for averaging probe intensities
+
+    Inputs:
+        normgprlist: the path to the file listing the normalized, masliner
+            adjusted gpr files
+        avgtype: the type of averaging to perform:
+            must be one of ('or', 'br', 'r')
+
+    Output:
+        the contents of the comfile
+    """
+    return('perl /project/siggers/perl/GENEPIX/' +
+            'average_replicate_rc_custom_probes.pl\n\n' +
+            '-l ' + normgprlist + '\n' +
+            '-op ' + avgtype + '\n' +
+            '-avg ' + avgtype + '\n' +
+            '-no_gfilter')
+
+
+def run_average_probes_comfile(comfile, avgtype, inputs, avggprdir):
     """Runs a comfile for averaging probe intensities
 
     Inputs:
@@ -58,16 +76,34 @@ def run_average_probes_comfile(comfile, avgtype):
         avgtype: the type of averaging to perform:
             must be one of ('or', 'br', 'r')
             This affects the names of the output and error files for this job
+        inputs: a list of paths to the normalized gpr files used by the comfile
+        avggprdir: the path to the directory in which the output files
+            should be made
     """
-    # Read contents of comfile as single string on one line
-    with open(comfile) as f:
-        comfilecont = f.read().replace('\n', ' ')
+    # Run comfile and make sure it made every type of output file
+    submit_job.submit_comfile(**average_probes_job(comfile, avgtype, inputs,
+        avggprdir))
 
-    # Run comfile
-    logging.info('qsub -sync y -P siggers -m a -cwd -N avg_' +
-            avgtype + ' -V -b y ' + comfilecont + '\n')
-    subprocess.run(['qsub', '-sync', 'y', '-P', 'siggers', '-m', 'a', '-cwd',
-        '-N', 'avg_' + avgtype, '-V', '-b', 'y', comfilecont])
+
+def average_probes_job(comfile, avgtype, inputs, avggprdir):
+    """Describes a batch job for averaging probe intensities
+
+    Inputs:
+        comfile: the comfile to run
+        avgtype: the type of averaging to perform:
+            must be one of ('or', 'br', 'r')
+        inputs: a list of paths to the normalized gpr files used by the comfile
+        avggprdir: the path to the directory in which the output files
+            should be made
+
+    Output:
+        a dictionary of arguments for submit_job.submit_comfile
+    """
+    # There should be an averaged gpr file of every type of output
+    return({'comfile': comfile, 'jobname': 'avg_' + avgtype,
+        'stage': 'average_probes', 'inputs': inputs, 'cwd': avggprdir,
+        'expected': [avggprdir + '/' + prefix + 'norm_madj*.gpr'
+            for prefix in pipeline_files.OUTPUT_PREFIXES[avgtype]]})
 
 
 def average_probes_wrapper(normgprdir, avggprdir):
@@ -93,17 +129,23 @@ def average_probes_wrapper(normgprdir, avggprdir):
     logging.info('Making a list of all normalized gpr files')
     normgprlist = avggprdir + '/norm_gpr.list'
     make_norm_gpr_list(normgprdir, normgprlist)
+    with open(normgprlist) as f:
+        inputs = [l.strip() for l in f if l.strip()]
     
     # Make and run a comfile for averaging probe intensities each of three ways
-    for avgtype in ['or', 'br', 'r']:
+    for avgtype in pipeline_files.AVERAGE_TYPES:
         logging.info('Making ' + avgtype + ' comfile')
         comfile = 'average_probes_' + avgtype + '.com'
         make_average_probes_comfile(normgprlist, avgtype, comfile)
         logging.info('Running ' + avgtype + ' comfile ' +
                 '(this may take a few minutes)')
-        run_average_probes_comfile(comfile, avgtype)
+        run_average_probes_comfile(comfile, avgtype, inputs, avggprdir)
     
     # Navigate back to original directory
     subprocess.os.chdir(cwd)
 
+    # Record how much disk space the averaged gpr files take up
+    job_history.record_stage('average_probes', job_history.total_size(inputs),
+            job_history.total_size(glob.glob(avggprdir + '/*')))
+
 
@@ -0,0 +1,279 @@
+import subprocess
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import job_history
+import submit_job
+import sim_scheduler
+import preprocess_pipeline
+
+# Gains at which every synthetic chamber is scanned (lowest first)
+GAINS = [300, 400, 500]
+
+# Column header of the synthetic gpr files
+GPR_COLUMNS = ['Block', 'Column', 'Row', 'Name', 'ID', 'X', 'Y',
+        'F488 Median', 'B488 Median', 'Flags']
+
+
+def make_gpr_file(filename, spots, gain, rng):
+    """Writes a small synthetic gpr file
+
+    Inputs:
+        filename: the path to the gpr file to write
+        spots: the number of spots in the file
+        gain: the gain of the scan, which scales every intensity
+        rng: the random number generator that chooses the spot intensities
+            (seeded the same way for every scan of a chamber)
+    """
+    with open(filename, 'w') as f:
+        f.write('ATF\t1.0\n')
+        f.write('2\t' + str(len(GPR_COLUMNS)) + '\n')
+        f.write('"Type=GenePix Results 3"\n')
+        f.write('"Wavelengths=488"\n')
+        f.write('\t'.join(['"' + column + '"' for column in GPR_COLUMNS]) +
+                '\n')
+        for i in range(spots):
+            intensity = rng.lognormvariate(6, 1) * gain / 100
+            f.write('\t'.join([str(i % 4 + 1), str(i), '1', 'probe' + str(i),
+                'probe' + str(i), str(i * 10), '10',
+                '%.0f' % min(intensity, 60000), '50', '0']) + '\n')
+
+
+def make_inputs(workdir, slides, chambers, spots, seed):
+    """Makes an analysis directory and gpr directories of synthetic scans
+
+    Inputs:
+        workdir: the directory in which to make the inputs
+        slides: the number of gpr directories to make
+        chambers: the number of chambers on each slide
+        spots: the number of spots in each gpr file
+        seed: the seed for the spot intensities
+
+    Output:
+        the path to the analysis directory
+        a list of the paths to the gpr directories
+    """
+    # The analysis file already exists, so it does not need to be made
+    analysisdir = workdir + '/analysis_file'
+    subprocess.os.makedirs(analysisdir)
+    with open(analysisdir + '/ID_000000_genomic_analysis.txt', 'w') as f:
+        f.write('synthetic analysis file\n')
+
+    # Scan every chamber of every slide at every gain
+    gprdirs = []
+    for slide in range(1, slides + 1):
+        gprdir = workdir + '/gpr_' + str(slide)
+        subprocess.os.makedirs(gprdir)
+        gprdirs.append(gprdir)
+        for chamber in range(1, chambers + 1):
+            for gain in GAINS:
+                make_gpr_file(gprdir + '/25800000000' + str(slide) + '_G' +
+                    str(gain) + '_488_' + str(chamber) + '-8.gpr', spots,
+                    gain, random.Random(str(seed) + str(slide) + str(chamber)))
+
+    return(analysisdir, gprdirs)
+
+
+def install_shims(bindir):
+    """Makes qsub, qstat and qacct commands that call the simulator
+
+    Inputs:
+        bindir: the directory in which to make the commands
+    """
+    subprocess.os.makedirs(bindir)
+    for command in ['qsub', 'qstat', 'qacct']:
+        with open(bindir + '/' + command, 'w') as f:
+            f.write('#!/bin/sh\nexec ' + sys.executable + ' ' +
+                    subprocess.os.path.abspath(sim_scheduler.__file__) + ' ' +
+                    command + ' "$@"\n')
+        subprocess.os.chmod(bindir + '/' + command, 0o755)
+
+
+def critical_path(jobs, start, end):
+    """Finds the chain of jobs that determined how long the run took
+
+    Inputs:
+        jobs: a list of the simulator's records of the finished jobs
+        start: the time at which the run started
+        end: the time at which the run finished
+
+    Output:
+        a list of the jobs on the critical path, in the order they ran
+            Working back from the end of the run, each job is the last one
+            to finish before the next job on the path was submitted
+    """
+    path = []
+    t = end
+    while True:
+        finished = [job for job in jobs if start <= job['end'] <= t]
+        if not finished:
+            break
+        path.append(max(finished, key = lambda x: x['end']))
+        t = path[-1]['submit']
+    return(path[::-1])
+
+
+def format_report(jobs, path, start, end, timescale):
+    """Formats the makespan, job count and critical path of a run
+
+    Inputs:
+        jobs: a list of the simulator's records of the finished jobs
+        path: the jobs on the critical path
+        start: the time at which the run started
+        end: the time at which the run finished
+        timescale: real seconds slept per simulated second
+
+    Output:
+        the report as a string
+        NOTE: queue waits and runtimes are in simulated seconds, while the
+            time spent in the pipeline itself between jobs is in real seconds
+    """
+    lines = []
+    failed = [job for job in jobs if job['exit_status'] != 0]
+    lines.append('Jobs submitted: ' + str(len(jobs)) + ' (' +
+            str(len(failed)) + ' failed)')
+    lines.append('Total cluster time: %.0f s' % sum(job['runtime']
+        for job in jobs))
+
+    # Walk the critical path, separating queue waits, runtimes and the time
+    #   spent by the pipeline itself between jobs
+    lines.append('Critical path:')
+    makespan = 0
+    waits = 0
+    runtimes = 0
+    previous = start
+    for job in path:
+        local = job['submit'] - previous
+        lines.append('  %-16s id %-5d local %6.1f s  queue %6.0f s  run ' \
+                '%6.0f s%s' % (job['name'], job['id'], local, job['wait'],
+                    job['runtime'], '' if job['exit_status'] == 0 else
+                    '  FAILED'))
+        makespan += local + job['wait'] + job['runtime']
+        waits += job['wait']
+        runtimes += job['runtime']
+        previous = job['end']
+    makespan += end - previous
+
+    lines.append('Makespan: %.0f s (%.0f s queued, %.0f s running, ' \
+            '%.1f s in the pipeline between jobs)' % (makespan, waits,
+                runtimes, makespan - waits - runtimes))
+    lines.append('Real time: %.1f s at a time scale of %g' % (end - start,
+        timescale))
+    return('\n'.join(lines))
+
+
+def run_benchmark(workdir, config, slides, chambers, spots, chunksize,
+        perchamber, scratch, retries):
+    """Runs the full pipeline on synthetic data against the simulator
+
+    Inputs:
+        workdir: an empty directory in which to run
+        config: the configuration of the simulated cluster
+            (see sim_scheduler.DEFAULT_CONFIG)
+        slides: the number of gpr directories
+        chambers: the number of chambers on each slide
+        spots: the number of spots in each gpr file
+        chunksize: the number of chambers in each spatial detrending job
+        perchamber: if True, run a separate masliner job for every chamber
+        scratch: if True, run jobs on (simulated) node-local scratch
+        retries: the number of times to resubmit a failed job
+
+    Output:
+        the benchmark report
+    """
+    analysisdir, gprdirs = make_inputs(workdir, slides, chambers, spots,
+            config['seed'])
+
+    # Point the pipeline at the simulator instead of the real scheduler
+    install_shims(workdir + '/bin')
+    subprocess.os.environ['PATH'] = workdir + '/bin' + \
+            subprocess.os.pathsep + subprocess.os.environ['PATH']
+    subprocess.os.environ['SIM_SCHEDULER_DIR'] = workdir + '/scheduler'
+    subprocess.os.environ['TMPDIR'] = workdir
+    subprocess.os.makedirs(workdir + '/scheduler')
+    with open(workdir + '/scheduler/config.json', 'w') as f:
+        json.dump(config, f, indent = 1)
+
+    # Keep the simulated jobs out of the real job history
+    job_history.HISTORY_DIR = workdir + '/history'
+    job_history.JOB_HISTORY = job_history.HISTORY_DIR + '/job_history.tsv'
+    job_history.LOCAL_JOB_HISTORY = job_history.HISTORY_DIR + \
+            '/local_job_history.tsv'
+    job_history.STAGE_HISTORY = job_history.HISTORY_DIR + '/stage_history.tsv'
+
+    # Scale the wait before resubmitting failed jobs like every other wait
+    submit_job.configure(retries = retries, scratch = scratch,
+            backoff = submit_job.SETTINGS['backoff'] * config['time_scale'])
+
+    # Run the pipeline
+    start = time.time()
+    preprocess_pipeline.run_pipeline(analysisdir, gprdirs, None, 0.9,
+            workdir + '/data_matrices', 'benchmark', chunksize, perchamber)
+    end = time.time()
+
+    # Report on the finished jobs
+    sim_scheduler.STATE_DIR = workdir + '/scheduler'
+    jobs = [job for job in sim_scheduler.read_records().values()
+            if job['state'] == 'done']
+    return(format_report(jobs, critical_path(jobs, start, end), start, end,
+        config['time_scale']))
+
+
+if __name__ == '__main__':
+    # Create object for handling command line arguments
+    parser = argparse.ArgumentParser(
+            description = 'Runs the full pipeline on synthetic gpr files ' +
+            'against a simulated scheduler and reports its makespan, job ' +
+            'count and critical path')
+    parser.add_argument('--slides', default = 2, type = int,
+            help = 'the number of gpr directories (default: 2)')
+    parser.add_argument('--chambers', default = 8, type = int,
+            help = 'the number of chambers on each slide (default: 8)')
+    parser.add_argument('--spots', default = 500, type = int,
+            help = 'the number of spots in each gpr file (default: 500)')
+    parser.add_argument('-c', '--chunk_size', default = 1, type = int,
+            help = 'the number of chambers to spatially detrend in each ' +
+            'batch job (default: 1)')
+    parser.add_argument('-s', '--split_chambers', action = 'store_true',
+            help = 'run a separate masliner job for every chamber')
+    parser.add_argument('--scratch', action = 'store_true',
+            help = 'run each batch job on node-local scratch')
+    parser.add_argument('--retries', default = 2, type = int,
+            help = 'the number of times to resubmit a failed batch job ' +
+            '(default: 2)')
+    parser.add_argument('--queue_wait', default = 30, type = float,
+            help = 'the mean simulated seconds a job waits in the queue ' +
+            '(default: 30)')
+    parser.add_argument('--runtime_sigma', default = 0.3, type = float,
+            help = 'the spread of the lognormal job runtimes (default: 0.3)')
+    parser.add_argument('--failure_rate', default = 0, type = float,
+            help = 'the probability that a job fails (default: 0)')
+    parser.add_argument('--time_scale', default = 0.01, type = float,
+            help = 'real seconds per simulated second (default: 0.01)')
+    parser.add_argument('--seed', default = None, type = int,
+            help = 'the seed for the simulated queue waits, runtimes and ' +
+            'failures (default: None)')
+    parser.add_argument('--keep', action = 'store_true',
+            help = 'keep the synthetic data and pipeline output')
+    args = parser.parse_args()
+
+    config = dict(sim_scheduler.DEFAULT_CONFIG)
+    config.update({'queue_wait': args.queue_wait,
+        'runtime_sigma': args.runtime_sigma,
+        'failure_rate': args.failure_rate, 'time_scale': args.time_scale,
+        'seed': args.seed})
+
+    workdir = tempfile.mkdtemp(prefix = 'auto_PBM_prepro_benchmark_')
+    try:
+        print(run_benchmark(workdir, config, args.slides, args.chambers,
+            args.spots, args.chunk_size, args.split_chambers, args.scratch,
+            args.retries))
+    finally:
+        if args.keep:
+            print('Output kept in ' + workdir)
+        else:
+            shutil.rmtree(workdir, ignore_errors = True)
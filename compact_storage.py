@@ -0,0 +1,286 @@
+import subprocess
+import glob
+import gzip
+import logging
+import argparse
+from natsort import natsorted
+import pipeline_files
+
+# Extension added to gpr files stored as a delta against a raw gpr file
+DELTA_EXTENSION = '.gprdelta.gz'
+
+# Codes used to record the line ending of each row in a delta file
+LINE_ENDINGS = {'\n': 'n', '\r\n': 'rn', '\r': 'r', '': 'x'}
+
+
+def differing_columns(filename, base):
+    """Finds which columns of a gpr file differ from those of another
+
+    Inputs:
+        filename: the path to the gpr file to compare
+        base: the path to the gpr file to compare it with
+
+    Output:
+        a sorted list of the indices of the columns that differ in any spot
+            row (or None if the files do not have the same number of rows
+            and columns)
+    """
+    differ = set()
+    try:
+        with open(filename, newline = '',
+                encoding = pipeline_files.ENCODING) as f, \
+                open(base, newline = '',
+                        encoding = pipeline_files.ENCODING) as b:
+            header, rows = pipeline_files.split_gpr(iter(f))
+            baseheader, baserows = pipeline_files.split_gpr(iter(b))
+            for row in rows:
+                baserow = next(baserows, None)
+                if baserow is None:
+                    return(None)
+                fields = row.rstrip('\r\n').split('\t')
+                basefields = baserow.rstrip('\r\n').split('\t')
+                if len(fields) != len(basefields):
+                    return(None)
+                differ.update(i for i in range(len(fields))
+                        if fields[i] != basefields[i])
+            if next(baserows, None) is not None:
+                return(None)
+    except (StopIteration, ValueError, IndexError, UnicodeDecodeError):
+        return(None)
+    return(sorted(differ))
+
+
+def write_delta(filename, base, columns, deltafile):
+    """Stores a gpr file as the columns in which it differs from a raw file
+
+    Inputs:
+        filename: the path to the gpr file to store
+        base: the path to the raw gpr file it is compared with
+        columns: the indices of the columns that differ
+        deltafile: the path to the delta file to write
+    """
+    with open(filename, newline = '',
+            encoding = pipeline_files.ENCODING) as f, \
+            gzip.open(deltafile, 'wt', newline = '',
+                    encoding = pipeline_files.ENCODING) as out:
+        header, rows = pipeline_files.split_gpr(iter(f))
+        out.write('GPRDELTA\t1\n')
+        out.write(subprocess.os.path.relpath(base,
+            subprocess.os.path.dirname(deltafile)) + '\t' +
+            pipeline_files.content_hash(base) + '\n')
+        out.write(str(len(header)) + '\n')
+        out.writelines(header)
+        out.write('\t'.join(str(i) for i in columns) + '\n')
+        for row in rows:
+            fields = row.rstrip('\r\n').split('\t')
+            ending = row[len(row.rstrip('\r\n')):]
+            out.write(LINE_ENDINGS[ending] + '\t' +
+                    '\t'.join(fields[i] for i in columns) + '\n')
+
+
+def read_delta(deltafile):
+    """Rebuilds the lines of a gpr file stored as a delta
+
+    Inputs:
+        deltafile: the path to the delta file
+
+    Output:
+        a generator yielding the lines of the original gpr file
+    """
+    endings = {code: ending for ending, code in LINE_ENDINGS.items()}
+    with gzip.open(deltafile, 'rt', newline = '',
+            encoding = pipeline_files.ENCODING) as f:
+        if f.readline() != 'GPRDELTA\t1\n':
+            raise ValueError(deltafile + ' is not a gpr delta file')
+        base, basehash = f.readline().rstrip('\n').split('\t')
+        base = subprocess.os.path.join(subprocess.os.path.dirname(deltafile),
+                base)
+
+        # Make sure the raw file has not changed since the delta was written
+        if pipeline_files.content_hash(base) != basehash:
+            logging.error('The raw gpr file ' + base + ' has changed since ' +
+                    deltafile + ' was written')
+            raise ValueError('The raw gpr file ' + base + ' has changed ' +
+                    'since ' + deltafile + ' was written')
+
+        nheader = int(f.readline())
+        for i in range(nheader):
+            yield(f.readline())
+        columns = [int(i) for i in f.readline().rstrip('\n').split('\t')
+                if i != '']
+
+        # Fill the stored columns into the rows of the raw file
+        with open(base, newline = '', encoding = pipeline_files.ENCODING) as b:
+            baseheader, baserows = pipeline_files.split_gpr(iter(b))
+            for l in f:
+                values = l.rstrip('\n').split('\t')
+                fields = next(baserows).rstrip('\r\n').split('\t')
+                for i, value in zip(columns, values[1:]):
+                    fields[i] = value
+                yield('\t'.join(fields) + endings[values[0]])
+
+
+def expand_delta(deltafile, filename):
+    """Writes the original gpr file stored in a delta file
+
+    Inputs:
+        deltafile: the path to the delta file
+        filename: the path to the gpr file to write
+    """
+    with open(filename, 'w', newline = '',
+            encoding = pipeline_files.ENCODING) as f:
+        f.writelines(read_delta(deltafile))
+
+
+def choose_base(filename, rawfiles):
+    """Chooses the raw gpr file that a gpr file differs least from
+
+    Inputs:
+        filename: the path to the intermediate gpr file
+        rawfiles: a list of the paths to the raw gpr files
+
+    Output:
+        the path to the raw gpr file (or None if none is similar enough)
+        the indices of the columns that differ from it
+    """
+    # Try the raw file the intermediate file is named after first, so it
+    #   wins any ties
+    rawfiles = sorted(rawfiles, key = lambda x:
+            subprocess.os.path.basename(x) not in filename)
+
+    best = None
+    bestcolumns = None
+    for rawfile in rawfiles:
+        # Only compare with raw files from the same chamber
+        if rawfile[-7:] != filename[-7:]:
+            continue
+        columns = differing_columns(filename, rawfile)
+        if columns is not None and (bestcolumns is None or
+                len(columns) < len(bestcolumns)):
+            best = rawfile
+            bestcolumns = columns
+    return(best, bestcolumns)
+
+
+def hardlink_duplicates(files):
+    """Replaces files that have identical contents with hard links
+
+    Inputs:
+        files: a list of paths to the files to check
+
+    Output:
+        the number of bytes freed
+    """
+    # Only files of the same size can be identical
+    bysize = {}
+    for filename in files:
+        if subprocess.os.path.isfile(filename) and \
+                not subprocess.os.path.islink(filename):
+            bysize.setdefault(subprocess.os.path.getsize(filename),
+                    []).append(filename)
+
+    freed = 0
+    for size, samesize in bysize.items():
+        if len(samesize) < 2 or size == 0:
+            continue
+        byhash = {}
+        for filename in samesize:
+            byhash.setdefault(pipeline_files.content_hash(filename),
+                    []).append(filename)
+        for duplicates in byhash.values():
+            first = duplicates[0]
+            for filename in duplicates[1:]:
+                if subprocess.os.path.samefile(first, filename):
+                    continue
+                subprocess.os.link(first, filename + '.tmp')
+                subprocess.os.replace(filename + '.tmp', filename)
+                freed += size
+    return(freed)
+
+
+def compact_gpr_dir(gprdir):
+    """Compacts the intermediate files of a finished run in a gpr directory
+
+    Inputs:
+        gprdir: the path to the directory containing the raw gpr files and the
+            masliner, spatial_detrend and average_probes subdirectories
+
+    Output:
+        the number of bytes freed
+    """
+    rawfiles = natsorted(glob.glob(gprdir + '/*.gpr'))
+    stagefiles = natsorted([filename
+        for stagedir in pipeline_files.STAGE_DIRS
+        for filename in glob.glob(gprdir + '/' + stagedir + '/*')])
+
+    # Store intermediate gpr files that only change some columns of a raw
+    #   gpr file as those columns
+    freed = 0
+    for filename in stagefiles:
+        if not filename.endswith('.gpr') or \
+                subprocess.os.path.islink(filename):
+            continue
+        base, columns = choose_base(filename, rawfiles)
+        if base is None:
+            continue
+        deltafile = filename + DELTA_EXTENSION
+        write_delta(filename, base, columns, deltafile)
+
+        # Only remove the original if the delta rebuilds it exactly and is
+        #   actually smaller
+        with open(filename, 'rb') as f:
+            original = f.read()
+        rebuilt = ''.join(read_delta(deltafile)).encode(pipeline_files.ENCODING)
+        saved = len(original) - subprocess.os.path.getsize(deltafile)
+        if rebuilt == original and saved > 0:
+            subprocess.os.remove(filename)
+            freed += saved
+            logging.info('Stored ' + filename + ' as a delta against ' + base)
+        else:
+            subprocess.os.remove(deltafile)
+
+    # Hard link any remaining identical files
+    freed += hardlink_duplicates(natsorted([filename
+        for stagedir in pipeline_files.STAGE_DIRS
+        for filename in glob.glob(gprdir + '/' + stagedir + '/*')]))
+
+    return(freed)
+
+
+def expand_gpr_dir(gprdir):
+    """Restores the intermediate gpr files of a compacted gpr directory
+
+    Inputs:
+        gprdir: the path to the compacted gpr directory
+    """
+    for stagedir in pipeline_files.STAGE_DIRS:
+        for deltafile in natsorted(glob.glob(gprdir + '/' + stagedir + '/*' +
+            DELTA_EXTENSION)):
+            filename = deltafile[:-len(DELTA_EXTENSION)]
+            expand_delta(deltafile, filename)
+            subprocess.os.remove(deltafile)
+            logging.info('Restored ' + filename)
+
+
+if __name__ == '__main__':
+    # Create object for handling command line arguments
+    parser = argparse.ArgumentParser(
+            description = 'Compacts the intermediate files of finished ' +
+            'pipeline runs, or restores them',
+            usage = 'python compact_storage.py {compact,expand} ' +
+            'GPR_DIRS [GPR_DIRS ...]')
+    parser.add_argument('command', choices = ['compact', 'expand'],
+            help = 'compact: store intermediate gpr files as the columns ' +
+            'that differ from the raw gpr files and hard link identical ' +
+            'files; expand: restore the intermediate gpr files')
+    parser.add_argument('gpr_dirs', nargs = '+',
+            help = 'the paths to the gpr directories of finished runs')
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO, format = '%(message)s')
+    for gprdir in args.gpr_dirs:
+        if args.command == 'compact':
+            freed = compact_gpr_dir(gprdir)
+            logging.info('Freed %.1f MB in %s' % (freed / 1024 ** 2, gprdir))
+        else:
+            expand_gpr_dir(gprdir)
@@ -1,6 +1,9 @@
 import subprocess
 import glob
 import logging
+import submit_job
+import job_history
+import pipeline_files
 from prevent_overwrite import prevent_overwrite
 
 def make_avg_gpr_list(avggprdirs, avgtype, outdir):
@@ -18,15 +21,7 @@ def make_avg_gpr_list(avggprdirs, avgtype, outdir):
         the path to the output list file
     """
     # Use avgtype to determine file naming schema
-    filename = ''
-    if avgtype == 'or':
-        filename = 'or_norm_madj*.gpr'
-    if avgtype == 'br':
-        filename = 'o1o2top_br_norm_madj*.gpr'
-    if avgtype == 'o1':
-        filename = 'o1match_r_norm_madj*.gpr'
-    if avgtype == 'o2':
-        filename = 'o2match_r_norm_madj*.gpr'
+    filename = pipeline_files.AVG_GPR_PATTERNS[avgtype]
     
     # Make an empty list to store file paths
     files = []
@@ -75,13 +70,26 @@ def make_data_matrix_comfile(avggprlist, comfile, datmat):
     
     # Open comfile for writing
     with open(comfile, 'w') as f:
-        f.write('perl /project/siggers/perl/GENEPIX/' +
-                'control_sequence_process.pl\n\n')
-        f.write('-l ' + avggprlist + '\n')
-        f.write('-o ' + datmat)
+        f.write(data_matrix_command(avggprlist, datmat))
 
 
-def run_data_matrix_comfile(comfile, avgtype):
+def data_matrix_command(avggprlist, datmat):
+    """Writes the contents of a comfile for creating a data matrix
+
+    Inputs:
+        avggprlist: the path to the file listing the averaged gpr files
+        datmat: the path to the data matrix you want to generate
+
+    Output:
+        the contents of the comfile
+    """
+    return('perl /project/siggers/perl/GENEPIX/' +
+            'control_sequence_process.pl\n\n' +
+            '-l ' + avggprlist + '\n' +
+            '-o ' + datmat)
+
+
+def run_data_matrix_comfile(comfile, avgtype, inputs, datmat):
     """Runs a comfile for creating a data matrix
 
     Inputs:
@@ -89,16 +97,242 @@ def run_data_matrix_comfile(comfile, avgtype):
         avgtype: the type of averaging that was done:
             must be one of ('or', 'br', 'r')
             This affects the names of the error and output files
+        inputs: a list of paths to the averaged gpr files used by the comfile
+        datmat: the path to the data matrix the comfile should make
     """
-    # Read contents of comfile as single string on one line
-    with open(comfile) as f:
-        comfilecont = f.read().replace('\n', ' ')
-    
-    # Run comfile
-    logging.info('qsub -sync y -P siggers -m a -cwd -N ' + avgtype +
-            '_matrix -V -b y ' + comfilecont + '\n')
-    subprocess.run(['qsub', '-sync', 'y', '-P', 'siggers', '-m', 'a', '-cwd',
-        '-N', avgtype + '_matrix', '-V', '-b', 'y', comfilecont])
+    # Run comfile and make sure it made the data matrix
+    submit_job.submit_comfile(**data_matrix_job(comfile, avgtype, inputs,
+        datmat))
+
+
+def data_matrix_job(comfile, avgtype, inputs, datmat):
+    """Describes a batch job for creating a data matrix
+
+    Inputs:
+        comfile: the comfile to run
+        avgtype: the type of averaging that was done:
+            must be one of ('or', 'br', 'o1', 'o2')
+        inputs: a list of paths to the averaged gpr files used by the comfile
+        datmat: the path to the data matrix the comfile should make
+
+    Output:
+        a dictionary of arguments for submit_job.submit_comfile
+        NOTE: the job runs in the current directory
+    """
+    return({'comfile': comfile, 'jobname': avgtype + '_matrix',
+        'stage': 'data_matrix', 'inputs': inputs, 'expected': [datmat]})
+
+
+def manifest_name(datmat):
+    """Constructs the name of the manifest of a data matrix
+
+    Inputs:
+        datmat: the path to the data matrix
+
+    Output:
+        the path to the manifest (e.g. PREFIX_or.manifest.tsv)
+    """
+    return(subprocess.os.path.splitext(datmat)[0] +
+            pipeline_files.MANIFEST_EXTENSION)
+
+
+def write_manifest(manifest, columns, replace = True):
+    """Writes the manifest of a data matrix
+
+    Inputs:
+        manifest: the path to the manifest to write
+        columns: a list of (name, source) pairs, one for each data column of
+            the matrix in order, where source is the path to the averaged
+            gpr file the column came from
+        replace: if False, leave the new manifest in manifest + '.tmp' for
+            the caller to move into place (default: True)
+    """
+    with open(manifest + '.tmp', 'w') as f:
+        f.write('column\tname\tsource\n')
+        for i, (name, source) in enumerate(columns):
+            f.write(str(i + 1) + '\t' + name + '\t' + source + '\n')
+    if replace:
+        subprocess.os.replace(manifest + '.tmp', manifest)
+
+
+def read_manifest(manifest):
+    """Reads the manifest of a data matrix
+
+    Inputs:
+        manifest: the path to the manifest
+
+    Output:
+        a list of (name, source) pairs, one for each data column
+    """
+    with open(manifest) as f:
+        f.readline()
+        return([tuple(l.rstrip('\n').split('\t')[1:3]) for l in f
+            if l.strip()])
+
+
+def read_header(datmat):
+    """Reads the column names of a data matrix
+
+    Inputs:
+        datmat: the path to the data matrix
+            NOTE: assumes the matrix is tab-delimited, with a header line
+                followed by one row per probe, and that its leading columns
+                describe the probe while each remaining column holds the
+                values from one averaged gpr file
+
+    Output:
+        a list of the column names
+    """
+    with open(datmat) as f:
+        return(f.readline().rstrip('\r\n').split('\t'))
+
+
+def column_stem(name):
+    """Strips the directory, quotes and .gpr extension from a column name"""
+    name = subprocess.os.path.basename(name.strip().strip('"'))
+    if name.endswith('.gpr'):
+        name = name[:-len('.gpr')]
+    return(name)
+
+
+def matrix_columns(datmat, sources):
+    """Pairs the data columns of a new data matrix with their sources
+
+    Inputs:
+        datmat: the path to the data matrix
+        sources: a list of the averaged gpr files it was made from, in order
+
+    Output:
+        a list of (name, source) pairs, one for each data column (or None if
+            the matrix does not have a probe column followed by a data column
+            named after each of its gpr files, in order)
+        NOTE: a column is named after a gpr file if, without directories,
+            quotes and the .gpr extension, one name ends with the other, so
+            columns named after the full path, the file name or the end of
+            the file name (e.g. the scan and chamber) are all recognized
+    """
+    header = read_header(datmat)
+    if len(header) <= len(sources):
+        return(None)
+    columns = list(zip(header[len(header) - len(sources):], sources))
+    for name, source in columns:
+        namestem = column_stem(name)
+        sourcestem = column_stem(source)
+        if not namestem or not (namestem.endswith(sourcestem) or
+                sourcestem.endswith(namestem)):
+            return(None)
+    return(columns)
+
+
+def append_data_matrix(datmat, newdatmat, newsources):
+    """Adds the data columns of a new data matrix to a copy of an existing one
+
+    Inputs:
+        datmat: the path to the existing data matrix, which is left as it is
+        newdatmat: the path to a data matrix made from only the new averaged
+            gpr files
+        newsources: a list of the new averaged gpr files, in order
+
+    Output:
+        a list of (temporary path, path) pairs of the new data matrix and
+            manifest, to be moved into place once every data matrix has been
+            appended to
+        NOTE: nothing is left behind if the columns cannot be appended
+    """
+    # Find where the existing matrix's columns came from
+    manifest = manifest_name(datmat)
+    if subprocess.os.path.exists(manifest):
+        columns = read_manifest(manifest)
+    else:
+        header = read_header(datmat)
+        nprobe = len(read_header(newdatmat)) - len(newsources)
+        columns = [(name, 'unknown') for name in header[nprobe:]]
+
+    # Never add the same gpr file twice
+    repeated = [source for source in newsources
+            if source in set(source for name, source in columns)]
+    if repeated:
+        logging.error(datmat + ' already has columns for: ' +
+                ', '.join(repeated))
+        raise ValueError(datmat + ' already has columns for: ' +
+                ', '.join(repeated))
+    newcolumns = matrix_columns(newdatmat, newsources)
+    if newcolumns is None:
+        logging.error(newdatmat + ' does not have a probe column and a data ' +
+                'column named after each of its ' + str(len(newsources)) +
+                ' gpr files, so its columns cannot be appended')
+        raise ValueError(newdatmat + ' does not have a probe column and a ' +
+                'data column named after each of its ' +
+                str(len(newsources)) + ' gpr files, so its columns cannot ' +
+                'be appended')
+
+    # Index the new values by the probe columns, counting repeated probes
+    #   (e.g. controls) separately
+    newvalues = {}
+    with open(newdatmat) as f:
+        newheader = f.readline().rstrip('\r\n').split('\t')
+        nprobe = len(newheader) - len(newsources)
+        for l in f:
+            fields = l.rstrip('\r\n').split('\t')
+            probe = tuple(fields[:nprobe])
+            count = 0
+            while (probe, count) in newvalues:
+                count += 1
+            newvalues[(probe, count)] = fields[nprobe:]
+
+    # Copy every row of the existing matrix with the new values added,
+    #   removing the copy if anything goes wrong
+    try:
+        with open(datmat) as f, open(datmat + '.tmp', 'w') as out:
+            header = f.readline().rstrip('\r\n').split('\t')
+            if header[:nprobe] != newheader[:nprobe]:
+                logging.error('The probe columns of ' + newdatmat +
+                        ' do not match those of ' + datmat)
+                raise ValueError('The probe columns of ' + newdatmat +
+                        ' do not match those of ' + datmat)
+            out.write('\t'.join(header + newheader[nprobe:]) + '\n')
+            counts = {}
+            values = []
+            for l in f:
+                fields = l.rstrip('\r\n').split('\t')
+                probe = tuple(fields[:nprobe])
+                counts[probe] = counts.get(probe, -1) + 1
+                values = newvalues.pop((probe, counts[probe]), None)
+                if values is None:
+                    break
+                out.write('\t'.join(fields + values) + '\n')
+    except BaseException:
+        remove_files([datmat + '.tmp'])
+        raise
+
+    # Both matrices must have exactly the same probes
+    if values is None or newvalues:
+        remove_files([datmat + '.tmp'])
+        logging.error('The probes of ' + newdatmat + ' do not match those ' +
+                'of ' + datmat + '\nPlease make sure both use the same ' +
+                'array design')
+        raise ValueError('The probes of ' + newdatmat + ' do not match ' +
+                'those of ' + datmat + '\nPlease make sure both use the ' +
+                'same array design')
+
+    # Write the new manifest next to the new matrix
+    try:
+        write_manifest(manifest, columns + newcolumns, replace = False)
+    except BaseException:
+        remove_files([datmat + '.tmp', manifest + '.tmp'])
+        raise
+    return([(datmat + '.tmp', datmat), (manifest + '.tmp', manifest)])
+
+
+def remove_files(filenames):
+    """Removes files, ignoring any that do not exist
+
+    Inputs:
+        filenames: a list of paths to the files to remove
+    """
+    for filename in filenames:
+        if subprocess.os.path.exists(filename):
+            subprocess.os.remove(filename)
 
 
 def data_matrix_wrapper(avggprdirs, outdir, matprefix):
@@ -115,7 +349,7 @@ def data_matrix_wrapper(avggprdirs, outdir, matprefix):
     subprocess.os.chdir(outdir)
     
     # Make a data matrix for each of the four groups of averaged gpr files
-    for avgtype in ['or', 'br', 'o1', 'o2']:
+    for avgtype in pipeline_files.AVG_TYPES:
         # Make a list of all the averaged gpr files for this avgtype
         logging.info('Making a list of all ' + avgtype + ' averaged gpr files')
         avggprlist = make_avg_gpr_list(avggprdirs, avgtype, outdir)
@@ -133,9 +367,56 @@ def data_matrix_wrapper(avggprdirs, outdir, matprefix):
         # Run data matrix comfile
         logging.info('Running ' + avgtype + ' data matrix comfile ' +
             '(this may take a few minutes)')
-        run_data_matrix_comfile(comfile, avgtype)
+        with open(avggprlist) as f:
+            inputs = [l.strip() for l in f if l.strip()]
+        run_data_matrix_comfile(comfile, avgtype, inputs, datmat)
+
+        # Record which gpr file each column came from, if the matrix has the
+        #   expected layout
+        columns = matrix_columns(datmat, inputs)
+        if columns is not None:
+            write_manifest(manifest_name(datmat), columns)
+        else:
+            logging.warning('Not writing a manifest for ' + datmat +
+                    ': it does not have a data column named after each of ' +
+                    'its ' + str(len(inputs)) + ' gpr files')
+
+        # Record how much disk space the data matrix takes up
+        job_history.record_stage('data_matrix', job_history.total_size(inputs),
+                job_history.total_size([datmat]))
     
     # Navigate back to original working directory
     subprocess.os.chdir(cwd)
 
 
+def append_matrix_wrapper(outdir, matprefix, appendto):
+    """Adds the columns of new data matrices to existing data matrices
+
+    Inputs:
+        outdir: the directory where the new data matrices were saved
+        matprefix: the prefix of the names of the new data matrices
+        appendto: the path and prefix of the existing data matrices
+            (e.g. /path/to/STUDY for /path/to/STUDY_or.dat)
+        NOTE: the existing data matrices are only replaced once the columns
+            have been appended to all of them, so if any cannot be appended
+            to, none are changed
+    """
+    # Append to copies of every data matrix, removing the copies if any of
+    #   them fails
+    replacements = []
+    try:
+        for avgtype in pipeline_files.AVG_TYPES:
+            datmat = appendto + '_' + avgtype + '.dat'
+            newdatmat = outdir + '/' + matprefix + '_' + avgtype + '.dat'
+            logging.info('Appending the columns of ' + newdatmat + ' to ' +
+                    datmat)
+            with open(outdir + '/' + avgtype + '_gpr.list') as f:
+                sources = [l.strip() for l in f if l.strip()]
+            replacements += append_data_matrix(datmat, newdatmat, sources)
+    except BaseException:
+        remove_files([tmpfile for tmpfile, filename in replacements])
+        raise
+
+    # Replace the existing data matrices and their manifests
+    for tmpfile, filename in replacements:
+        subprocess.os.replace(tmpfile, filename)
@@ -0,0 +1,339 @@
+import subprocess
+import re
+import math
+import logging
+import statistics
+from array import array
+from natsort import natsorted
+import pipeline_files
+from prevent_overwrite import prevent_overwrite
+
+# Foreground medians at or above this are treated as saturated
+#   (the scanner's maximum is 65535)
+SATURATED_INTENSITY = 65000
+
+# A chamber is a problem if even its lowest intensity scan has more than
+#   this fraction of saturated spots
+MAX_SATURATED_FRACTION = 0.05
+
+# A scan is a problem if more than this fraction of its spots are flagged
+MAX_FLAGGED_FRACTION = 0.1
+
+# A block is dead if its median is below this fraction of the median of all
+#   block medians in the scan
+DEAD_BLOCK_FRACTION = 0.1
+
+# A scan is a problem if the log intensities of its unsaturated spots
+#   correlate less than this with those of the next lower gain scan
+MIN_GAIN_CORRELATION = 0.9
+
+
+def find_columns(header):
+    """Finds the columns needed for quality control in a gpr file header
+
+    Inputs:
+        header: the header lines of a gpr file (see pipeline_files.split_gpr)
+
+    Output:
+        the indices of the 'Block', 'Flags' and foreground median columns
+            (each is None if the column could not be found)
+    """
+    columns = pipeline_files.gpr_columns(header)
+    block = columns.index('Block') if 'Block' in columns else None
+    flags = columns.index('Flags') if 'Flags' in columns else None
+    median = None
+    for i, column in enumerate(columns):
+        if pipeline_files.MEDIAN_COLUMN.match(column):
+            median = i
+            break
+    return(block, flags, median)
+
+
+def read_number(fields, column):
+    """Reads a number from a column of a gpr data line
+
+    Inputs:
+        fields: the tab-separated fields of the line
+        column: the index of the column to read
+
+    Output:
+        the number, or NaN if the field is missing, blank or not a number
+    """
+    try:
+        return(float(fields[column].strip().strip('"')))
+    except (IndexError, ValueError):
+        return(math.nan)
+
+
+def convert_header(header):
+    """Replaces "635" and "647" with "488" in a gpr file header if they
+    follow "B" or "F", for masliner compatibility
+
+    Inputs:
+        header: the header lines of a gpr file (see pipeline_files.split_gpr)
+
+    Output:
+        the converted header lines
+    """
+    return([re.sub(r'(B|F)(635|647)', r'\g<1>488', l) for l in header])
+
+
+def rewrite_and_scan(filename):
+    """Converts 635s and 647s to 488s in a gpr file header and collects
+    quality control statistics for its spots in the same pass
+
+    Inputs:
+        filename: the path to the gpr file
+
+    Output:
+        a dictionary of statistics for the scan:
+            spots: the number of spots
+            saturated: the number of spots with saturated foreground medians
+            flagged: the number of spots with negative flags
+            unparseable: the number of spots whose foreground median or
+                flags are blank or not a number
+            block_medians: a dictionary mapping each block to the median of
+                the foreground medians of its spots
+            intensities: the foreground median of every spot, in file order
+        NOTE: the file is only rewritten if its header needs changing, and
+            every byte other than the converted wavelengths is kept as it is
+            (including GenePix's CRLF line endings)
+    """
+    with open(filename, newline = '',
+            encoding = pipeline_files.ENCODING) as f:
+        header, rows = pipeline_files.split_gpr(iter(f))
+
+        # Replace "635" and "647" with "488" if they follow "B" or "F"
+        converted = convert_header(header)
+        block, flags, median = find_columns(converted)
+
+        # Only write a new copy of the file if the header changed
+        out = None
+        try:
+            if converted != header:
+                out = open(filename + '.tmp', 'w', newline = '',
+                        encoding = pipeline_files.ENCODING)
+                out.writelines(converted)
+
+            # Stream through the spots
+            intensities = array('d')
+            saturated = 0
+            flagged = 0
+            unparseable = 0
+            blocks = {}
+            for l in rows:
+                if out is not None:
+                    out.write(l)
+                fields = l.rstrip('\r\n').split('\t')
+                if median is None or not l.strip():
+                    continue
+
+                # Count spots whose median or flags cannot be read, keeping
+                #   a NaN in their place so the spots of each scan still
+                #   line up (NaNs are never saturated or correlated)
+                intensity = read_number(fields, median)
+                flag = read_number(fields, flags) if flags is not None \
+                        else 0.0
+                if math.isnan(intensity) or math.isnan(flag):
+                    unparseable += 1
+                intensities.append(intensity)
+                if intensity >= SATURATED_INTENSITY:
+                    saturated += 1
+                if flag < 0:
+                    flagged += 1
+                if block is not None and not math.isnan(intensity):
+                    blocks.setdefault(fields[block],
+                            array('d')).append(intensity)
+
+        # Never leave a partial copy behind
+        except BaseException:
+            if out is not None:
+                out.close()
+                subprocess.os.remove(filename + '.tmp')
+            raise
+
+    # Replace the original file with the converted copy
+    if out is not None:
+        out.close()
+        subprocess.os.replace(filename + '.tmp', filename)
+
+    return({'spots': len(intensities), 'saturated': saturated,
+        'flagged': flagged, 'unparseable': unparseable,
+        'intensities': intensities,
+        'block_medians': {b: statistics.median(values)
+            for b, values in blocks.items()}})
+
+
+def converted_hash(filename):
+    """Computes the SHA-256 hash a gpr file will have once rewrite_and_scan
+    has converted its header, without changing the file
+
+    Inputs:
+        filename: the path to the gpr file
+
+    Output:
+        the hexadecimal hash
+    """
+    with open(filename, newline = '',
+            encoding = pipeline_files.ENCODING) as f:
+        header, rows = pipeline_files.split_gpr(iter(f))
+
+    # Every character of a latin-1 header is one byte, so the rest of the file
+    #   starts straight after it
+    return(pipeline_files.content_hash(filename,
+        ''.join(convert_header(header)).encode(pipeline_files.ENCODING),
+        len(''.join(header))))
+
+
+def gain_correlation(lower, higher):
+    """Correlates the log intensities of two scans of the same chamber
+
+    Inputs:
+        lower: the intensities of the lower gain scan
+        higher: the intensities of the higher gain scan
+
+    Output:
+        the Pearson correlation of the log intensities of the spots that are
+            positive and unsaturated in both scans (or None if there are
+            too few such spots or the scans do not have the same spots)
+    """
+    if len(lower) != len(higher):
+        return(None)
+    pairs = [(math.log(x), math.log(y)) for x, y in zip(lower, higher)
+            if 0 < x < SATURATED_INTENSITY and 0 < y < SATURATED_INTENSITY]
+    if len(pairs) < 3:
+        return(None)
+    xs, ys = zip(*pairs)
+    xmean = sum(xs) / len(xs)
+    ymean = sum(ys) / len(ys)
+    sxy = sum((x - xmean) * (y - ymean) for x, y in pairs)
+    sxx = sum((x - xmean) ** 2 for x in xs)
+    syy = sum((y - ymean) ** 2 for y in ys)
+    if sxx == 0 or syy == 0:
+        return(None)
+    return(sxy / math.sqrt(sxx * syy))
+
+
+def find_problems(scans):
+    """Checks the statistics of every scan for problems
+
+    Inputs:
+        scans: a dictionary mapping gpr file paths to the statistics returned
+            by rewrite_and_scan
+
+    Output:
+        a dictionary mapping each gpr file path to a list of its problems
+        a dictionary mapping each gpr file path to the correlation of its
+            log intensities with the next lower gain scan of its chamber
+    """
+    problems = {filename: [] for filename in scans}
+    correlations = {filename: None for filename in scans}
+
+    for filename, stats in scans.items():
+        # Check for spots that could not be read
+        if stats['unparseable'] > 0:
+            problems[filename].append(str(stats['unparseable']) +
+                    ' unreadable spot(s)')
+
+        # Check for flagged spots
+        if stats['spots'] > 0 and (stats['flagged'] / stats['spots'] >
+                MAX_FLAGGED_FRACTION):
+            problems[filename].append('flagged spots')
+
+        # Check for dead blocks
+        if stats['block_medians']:
+            overall = statistics.median(stats['block_medians'].values())
+            dead = [b for b, value in stats['block_medians'].items()
+                    if value < DEAD_BLOCK_FRACTION * overall]
+            if dead:
+                problems[filename].append('dead block(s) ' + ','.join(dead))
+
+    # Group the scans by directory and chamber, sorted from lowest gain
+    chambers = {}
+    for filename in natsorted(scans):
+        key = (subprocess.os.path.dirname(filename), filename[-7:])
+        chambers.setdefault(key, []).append(filename)
+
+    for filenames in chambers.values():
+        # Check that the lowest gain scan is not saturated already
+        lowest = scans[filenames[0]]
+        if lowest['spots'] > 0 and (lowest['saturated'] / lowest['spots'] >
+                MAX_SATURATED_FRACTION):
+            problems[filenames[0]].append('saturated lowest gain scan')
+
+        # Check that each scan agrees with the next lower gain scan
+        for lower, higher in zip(filenames, filenames[1:]):
+            correlation = gain_correlation(scans[lower]['intensities'],
+                    scans[higher]['intensities'])
+            correlations[higher] = correlation
+            if correlation is not None and correlation < MIN_GAIN_CORRELATION:
+                problems[higher].append('poor correlation with lower gain')
+
+    return(problems, correlations)
+
+
+def write_qc_report(scans, problems, correlations, qcreport):
+    """Writes a quality control report for every scan
+
+    Inputs:
+        scans: a dictionary mapping gpr file paths to their statistics
+        problems: a dictionary mapping gpr file paths to their problems
+        correlations: a dictionary mapping gpr file paths to their
+            correlations with the next lower gain scan
+        qcreport: the path to the report to write
+    """
+    # Do not overwrite qcreport if it already exists
+    prevent_overwrite(qcreport)
+
+    with open(qcreport, 'w') as f:
+        f.write('\t'.join(['file', 'spots', 'saturated_fraction',
+            'flagged_spots', 'unreadable_spots', 'gain_correlation',
+            'block_medians', 'problems']) + '\n')
+        for filename in natsorted(scans):
+            stats = scans[filename]
+            spots = max(stats['spots'], 1)
+            correlation = correlations[filename]
+            f.write('\t'.join([filename, str(stats['spots']),
+                '%.4f' % (stats['saturated'] / spots),
+                str(stats['flagged']), str(stats['unparseable']),
+                'NA' if correlation is None else '%.4f' % correlation,
+                ','.join(['%s:%g' % (b, value) for b, value in
+                    natsorted(stats['block_medians'].items())]),
+                '; '.join(problems[filename]) or 'none']) + '\n')
+
+
+def qc_wrapper(scans, exclude, qcreport, block):
+    """Reports on the quality of the raw scans and optionally stops the run
+
+    Inputs:
+        scans: a dictionary mapping gpr file paths to the statistics returned
+            by rewrite_and_scan (e.g. by masliner.to_488)
+        exclude: the list of gpr files to exclude from analysis
+            These are left out of the report
+        qcreport: the path to the report to write
+        block: if True, abort if any scan has a problem
+    """
+    # Leave out the excluded scans
+    if exclude is not None:
+        scans = {filename: stats for filename, stats in scans.items()
+                if subprocess.os.path.basename(filename) not in exclude}
+
+    # Check the scans and write the report
+    problems, correlations = find_problems(scans)
+    logging.info('Writing quality control report: ' + qcreport)
+    write_qc_report(scans, problems, correlations, qcreport)
+
+    # Log every scan with a problem
+    bad = [filename for filename in natsorted(problems) if problems[filename]]
+    for filename in bad:
+        logging.warning('Quality control problem in ' + filename + ': ' +
+                '; '.join(problems[filename]))
+
+    # Abort before any jobs are submitted if requested
+    if block and bad:
+        logging.error('Quality control found problems in ' + str(len(bad)) +
+                ' gpr file(s); see ' + qcreport +
+                '\nPlease select additional gpr files to exclude')
+        raise ValueError('Quality control found problems in ' +
+                str(len(bad)) + ' gpr file(s); see ' + qcreport +
+                '\nPlease select additional gpr files to exclude')
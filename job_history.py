@@ -0,0 +1,303 @@
+import subprocess
+import statistics
+import threading
+
+# Directory in which metrics from previous runs are saved
+HISTORY_DIR = subprocess.os.path.expanduser('~/.auto_PBM_prepro')
+
+# File recording the resource usage of each job that has been run
+JOB_HISTORY = HISTORY_DIR + '/job_history.tsv'
+
+# File recording the resource usage of each job run in the local worker pool
+#   These are kept apart because their peak memory is the resident set size
+#   reported by the operating system, not the virtual memory reported by the
+#   scheduler, and their runtimes do not share the scheduler's nodes
+LOCAL_JOB_HISTORY = HISTORY_DIR + '/local_job_history.tsv'
+
+# File recording the disk usage of each stage that has been run
+STAGE_HISTORY = HISTORY_DIR + '/stage_history.tsv'
+
+# Lock so that jobs finishing at the same time do not write over each other
+HISTORY_LOCK = threading.Lock()
+
+# Column names for each history file
+JOB_COLUMNS = ['stage', 'jobname', 'jobid', 'input_bytes', 'wallclock',
+        'maxvmem', 'exit_status']
+LOCAL_JOB_COLUMNS = ['stage', 'jobname', 'jobid', 'input_bytes',
+        'wallclock', 'maxrss', 'exit_status']
+STAGE_COLUMNS = ['stage', 'input_bytes', 'output_bytes']
+
+# Peak memory of a perl interpreter that has not read any input yet
+BASE_MEMORY = 50 * 1024 ** 2
+
+# Rough estimates used for stages that have no recorded history yet
+#   Both runtime and memory are modelled as a fixed cost plus a cost per unit
+#   of input, so that small jobs dominated by starting up do not inflate the
+#   estimates for large ones
+#   fixed_runtime: seconds of wall clock time a job takes whatever its input
+#   runtime: seconds of wall clock time per MB of input
+#   slack_runtime: the most seconds any job took beyond the fitted runtime
+#   fixed_memory: bytes of peak memory a job uses whatever its input
+#   memory: bytes of peak memory per byte of input
+#   slack_memory: the most bytes any job used beyond the fitted memory
+#   disk: bytes written per byte of input
+#   runtime_jobs: the number of jobs the runtimes were learned from
+DEFAULT_RATES = {
+        'masliner': {'fixed_runtime': 60.0, 'runtime': 2.0,
+            'memory': 4.0, 'disk': 1.1},
+        'spatial_detrend': {'fixed_runtime': 60.0, 'runtime': 3.0,
+            'memory': 6.0, 'disk': 1.2},
+        'average_probes': {'fixed_runtime': 30.0, 'runtime': 1.0,
+            'memory': 4.0, 'disk': 4.0},
+        'data_matrix': {'fixed_runtime': 30.0, 'runtime': 0.5,
+            'memory': 3.0, 'disk': 0.3}}
+
+# Without history, no job has gone beyond the estimates and every stage
+#   starts from the memory of a bare perl interpreter
+for rates in DEFAULT_RATES.values():
+    rates.update({'slack_runtime': 0.0, 'fixed_memory': BASE_MEMORY,
+        'slack_memory': 0.0, 'runtime_jobs': 0})
+
+
+def total_size(paths):
+    """Adds up the sizes of a list of files
+
+    Inputs:
+        paths: a list of paths to files
+            NOTE: paths that do not exist are ignored
+
+    Output:
+        the total size of the files in bytes
+    """
+    return(sum(subprocess.os.path.getsize(path) for path in paths
+        if subprocess.os.path.isfile(path)))
+
+
+def append_row(historyfile, columns, values):
+    """Appends a row to a history file, creating the file if necessary
+
+    Inputs:
+        historyfile: the path to the history file
+        columns: the column names to write if the file is new
+        values: the values to write in the new row
+    """
+    with HISTORY_LOCK:
+        # Create the history directory if it doesn't already exist
+        subprocess.os.makedirs(subprocess.os.path.dirname(historyfile),
+                exist_ok = True)
+
+        # Write the header if this is a new file
+        if not subprocess.os.path.exists(historyfile):
+            with open(historyfile, 'w') as f:
+                f.write('\t'.join(columns) + '\n')
+
+        # Append the new row
+        with open(historyfile, 'a') as f:
+            f.write('\t'.join(['NA' if value is None else str(value)
+                for value in values]) + '\n')
+
+
+def read_rows(historyfile):
+    """Reads all the rows of a history file
+
+    Inputs:
+        historyfile: the path to the history file
+
+    Output:
+        a list of dictionaries mapping column names to values
+            NOTE: values recorded as 'NA' are returned as None
+    """
+    # If there is no history yet, there are no rows
+    if not subprocess.os.path.exists(historyfile):
+        return([])
+
+    # Read the header and then each row
+    with open(historyfile) as f:
+        columns = f.readline().rstrip('\n').split('\t')
+        rows = []
+        for l in f:
+            values = l.rstrip('\n').split('\t')
+            rows.append({column: (None if value == 'NA' else value)
+                for column, value in zip(columns, values)})
+
+    # Return rows
+    return(rows)
+
+
+def record_job(stage, jobname, jobid, inputbytes, wallclock, maxvmem,
+        exitstatus):
+    """Records the resource usage of a job that has finished
+
+    Inputs:
+        stage: the pipeline stage the job belongs to
+        jobname: the name the job was submitted with
+        jobid: the scheduler's ID for the job
+        inputbytes: the total size of the job's input files in bytes
+        wallclock: the wall clock time of the job in seconds
+        maxvmem: the peak memory usage of the job in bytes
+        exitstatus: the exit status of the job
+    """
+    append_row(JOB_HISTORY, JOB_COLUMNS, [stage, jobname, jobid, inputbytes,
+        wallclock, maxvmem, exitstatus])
+
+
+def record_local_job(stage, jobname, jobid, inputbytes, wallclock, maxrss,
+        exitstatus):
+    """Records the resource usage of a job that has finished in the local
+    worker pool
+
+    Inputs:
+        stage: the pipeline stage the job belongs to
+        jobname: the name the job was run with
+        jobid: the worker pool's ID for the job
+        inputbytes: the total size of the job's input files in bytes
+        wallclock: the wall clock time of the job in seconds
+        maxrss: the peak resident set size of the job in bytes
+        exitstatus: the exit status of the job
+        NOTE: these are not used to size the requests of batch jobs
+    """
+    append_row(LOCAL_JOB_HISTORY, LOCAL_JOB_COLUMNS, [stage, jobname, jobid,
+        inputbytes, wallclock, maxrss, exitstatus])
+
+
+def record_stage(stage, inputbytes, outputbytes):
+    """Records the disk usage of a stage that has finished
+
+    Inputs:
+        stage: the name of the pipeline stage
+        inputbytes: the total size of the stage's input files in bytes
+        outputbytes: the total size of the stage's output files in bytes
+    """
+    append_row(STAGE_HISTORY, STAGE_COLUMNS, [stage, inputbytes, outputbytes])
+
+
+def fit_usage(points, peakpoints, fixed):
+    """Fits a fixed cost plus a rate per unit of input to previous jobs
+
+    Inputs:
+        points: a list of (input size, usage) pairs to fit
+        peakpoints: a list of further (input size, usage) pairs that only
+            count towards the slack
+        fixed: the fixed cost to assume if every job had the same input size
+
+    Output:
+        the fixed cost
+        the rate per unit of input
+        the slack, i.e. the most any job used beyond the fit
+    """
+    sizes = [size for size, usage in points]
+    usages = [usage for size, usage in points]
+
+    # With only one input size, the fixed cost cannot be separated from the
+    #   rate, so assume the default (but no more than the smallest usage)
+    if len(set(sizes)) < 2:
+        fixed = min(fixed, min(usages))
+        rate = statistics.median([(usage - fixed) / size
+            for size, usage in points])
+
+    # Otherwise fit a least squares line, without negative costs
+    else:
+        sizemean = statistics.mean(sizes)
+        usagemean = statistics.mean(usages)
+        rate = max(sum((size - sizemean) * (usage - usagemean)
+            for size, usage in points) /
+            sum((size - sizemean) ** 2 for size in sizes), 0)
+        fixed = max(usagemean - rate * sizemean, 0)
+
+    slack = max([0] + [usage - fixed - rate * size
+        for size, usage in points + peakpoints])
+    return(fixed, rate, slack)
+
+
+def learned_rates(stage, local = False):
+    """Learns resource usage rates for a stage from its recorded history
+
+    Inputs:
+        stage: the name of the pipeline stage
+        local: if True, learn from the jobs run in the local worker pool
+            instead of the batch jobs (default: False)
+
+    Output:
+        a dictionary with the same keys as the values of DEFAULT_RATES
+            Rates with no usable history fall back to DEFAULT_RATES
+            The runtime and memory are fitted to previous successful jobs,
+            and their slack covers every job (including failed ones), so
+            that requests based on it err on the side of caution. The disk
+            rate is the maximum seen for the same reason
+    """
+    # Start from the default rates for this stage
+    rates = dict(DEFAULT_RATES[stage])
+
+    # Collect the runtime and peak memory of each job of this stage
+    # Failed jobs (e.g. ones killed for running out of time or memory) used
+    #   at least as much as was recorded, so they count towards the slack
+    runtimes = []
+    memories = []
+    peakruntimes = []
+    peakmemories = []
+    historyfile = LOCAL_JOB_HISTORY if local else JOB_HISTORY
+    memorycolumn = 'maxrss' if local else 'maxvmem'
+    for row in read_rows(historyfile):
+        if row['stage'] != stage:
+            continue
+        if not row['input_bytes'] or float(row['input_bytes']) <= 0:
+            continue
+        inputbytes = float(row['input_bytes'])
+        succeeded = row['exit_status'] in ('0', None)
+        if row['wallclock'] is not None:
+            (runtimes if succeeded else peakruntimes).append(
+                    (inputbytes / 1024 ** 2, float(row['wallclock'])))
+        if row[memorycolumn] is not None:
+            (memories if succeeded else peakmemories).append(
+                    (inputbytes, float(row[memorycolumn])))
+
+    # Collect the rates observed for each previous run of this stage
+    disks = [float(row['output_bytes']) / float(row['input_bytes'])
+            for row in read_rows(STAGE_HISTORY) if row['stage'] == stage
+            and row['input_bytes'] and float(row['input_bytes']) > 0
+            and row['output_bytes'] is not None]
+
+    # Replace the defaults with any rates that could be learned
+    if runtimes:
+        rates['fixed_runtime'], rates['runtime'], rates['slack_runtime'] = \
+                fit_usage(runtimes, peakruntimes, rates['fixed_runtime'])
+        rates['runtime_jobs'] = len(runtimes)
+    if memories:
+        rates['fixed_memory'], rates['memory'], rates['slack_memory'] = \
+                fit_usage(memories, peakmemories, rates['fixed_memory'])
+    if disks:
+        rates['disk'] = max(disks)
+
+    # Return rates
+    return(rates)
+
+
+def estimate_job(stage, inputbytes, local = False):
+    """Estimates the runtime and peak memory of a job
+
+    Inputs:
+        stage: the pipeline stage the job belongs to
+        inputbytes: the total size of the job's input files in bytes
+        local: if True, estimate for the local worker pool instead of a
+            batch job (default: False)
+
+    Output:
+        the estimated wall clock time of the job in seconds
+        the estimated peak memory usage of the job in bytes
+    """
+    rates = learned_rates(stage, local)
+    return(rates['fixed_runtime'] + rates['runtime'] * inputbytes / 1024 ** 2,
+            rates['fixed_memory'] + rates['memory'] * inputbytes)
+
+
+def estimate_disk(stage, inputbytes):
+    """Estimates the disk space used by the output files of a stage
+
+    Inputs:
+        stage: the name of the pipeline stage
+        inputbytes: the total size of the stage's input files in bytes
+
+    Output:
+        the estimated total size of the stage's output files in bytes
+    """
+    return(learned_rates(stage)['disk'] * inputbytes)
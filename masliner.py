@@ -3,6 +3,9 @@ import glob
 import logging
 from natsort import natsorted
 from collections import Counter
+import submit_job
+import job_history
+import gpr_qc
 from prevent_overwrite import prevent_overwrite
 
 def to_488(gprdir):
@@ -10,56 +13,62 @@ def to_488(gprdir):
 
     Inputs:
         gprdir: the path to the directory where the gpr files are stored
+
+    Output:
+        a dictionary mapping the path to each gpr file to the quality control
+            statistics collected while converting it (see gpr_qc)
     """
     # Save a list of all files in gprdir that end in ".gpr"
     files = glob.glob(gprdir + '/*.gpr')
-    for filename in files:
-        # Replace "635" and "647" with "488" if they follow "B" or "F"
-        subprocess.run(['sed', '-i', '-E', 's/(B|F)(635|647)/\\1488/g',
-            filename])
 
+    # Replace "635" and "647" with "488" if they follow "B" or "F" and
+    #   collect quality control statistics in the same pass
+    return({filename: gpr_qc.rewrite_and_scan(filename) for filename in files})
 
-def make_experiment_description(gprdir, exclude):
-    """Makes experiment description file(s)
+
+def group_chambers(gprdir, exclude, perchamber = False):
+    """Groups chambers by which gpr files are used for them
 
     Inputs:
         gprdir: the path to the directory where the gpr files are stored
             NOTE: This function assumes that all files in this directory ending
                 in ".gpr" (except those listed in exclude) should be included
-                in the experiment description file
             NOTE: This function also assumes that all relevant files end in 
                 "[0-9]-8.gpr" and can therefore be separated into chambers by
                 looking at the last 7 characters of the filename
-        exclude: a list of files to exclude from the experiment description file
+        exclude: a list of files to exclude
+        perchamber: if True, put every chamber in a group of its own
+            (default: False)
 
     Output:
-        a list of all the experiment description files generated
+        a dictionary mapping the chamber numbers of each group (e.g. '1234')
+            to a list of (chamber, filenames) pairs, one for each chamber in
+            the group, where filenames is a sorted list of the gpr files for
+            that chamber
     """
-    # Navigate to gprdir after saving current directory
-    cwd = subprocess.os.getcwd()
-    subprocess.os.chdir(gprdir)
-
     # Save a sorted list of all files in gprdir that end in ".gpr"
-    files = glob.glob('*.gpr')
+    files = [subprocess.os.path.basename(filename)
+            for filename in glob.glob(gprdir + '/*.gpr')]
     files = natsorted(files)
 
     # Remove exclude from files
     if exclude is not None:
         files = [filename for filename in files if filename not in exclude]
 
-    # Navigate back to original directory
-    subprocess.os.chdir(cwd)
-
     # Store the possible file endings (chambers) in a set to get a unique list
     chamberset = set(filename[-7:] for filename in files)
 
     # Make a dictionary to group the chambers by which files are used
     chamberdict = {}
-    for chamber in chamberset:
+    for chamber in natsorted(chamberset):
         # Collapse the filenames into a string
         filenames = ''.join([filename[:-7] for filename in files
             if chamber in filename])
 
+        # Give every chamber its own key if chambers should not be grouped
+        if perchamber:
+            filenames = chamber
+
         # If filenames is already in the dictionary, add chamber to its value
         if filenames in chamberdict:
             chamberdict[filenames].append(chamber)
@@ -68,8 +77,8 @@ def make_experiment_description(gprdir, exclude):
         else:
             chamberdict[filenames] = [chamber]
 
-    # Initialize an array to store the experiment description filenames
-    expdescs = []
+    # Initialize a dictionary to store the groups of chambers
+    groups = {}
 
     # Loop through the values in chamberdict
     for chamberlist in chamberdict.values():
@@ -79,7 +88,43 @@ def make_experiment_description(gprdir, exclude):
         # Extract chamber numbers from chamberlist
         chambernums = ''.join([chamber[0] for chamber in chamberlist])
 
-        # Make an experiment description filename for chambers in chamberlist
+        # Find all the filenames for each chamber in this group
+        groups[chambernums] = [(chamber,
+            [filename for filename in files if chamber in filename])
+            for chamber in chamberlist]
+
+    # Return groups of chambers
+    return(groups)
+
+
+def make_experiment_description(gprdir, exclude, perchamber = False):
+    """Makes experiment description file(s)
+
+    Inputs:
+        gprdir: the path to the directory where the gpr files are stored
+            NOTE: This function assumes that all files in this directory ending
+                in ".gpr" (except those listed in exclude) should be included
+                in the experiment description file
+            NOTE: This function also assumes that all relevant files end in 
+                "[0-9]-8.gpr" and can therefore be separated into chambers by
+                looking at the last 7 characters of the filename
+        exclude: a list of files to exclude from the experiment description file
+        perchamber: if True, make a separate experiment description file for
+            every chamber instead of grouping chambers that use the same
+            scans (default: False)
+
+    Output:
+        a list of all the experiment description files generated
+    """
+    # Group the chambers that use the same gpr files
+    groups = group_chambers(gprdir, exclude, perchamber)
+
+    # Initialize an array to store the experiment description filenames
+    expdescs = []
+
+    # Loop through the groups of chambers
+    for chambernums, chamberfiles in groups.items():
+        # Make an experiment description filename for chambers in this group
         expdesc = gprdir + '/experiment_description_' + chambernums + '.txt'
 
         # Do not overwrite expdesc if it already exists
@@ -88,24 +133,52 @@ def make_experiment_description(gprdir, exclude):
         # Append this experiment description filename to expdescs
         expdescs.append(expdesc)
 
-        # Open experiment description file for writing
+        # Write experiment description file
         with open(expdesc, 'w') as f:
-            for chamber in chamberlist:
-                # Write the header for this chamber
-                f.write('Pbm=1\nConcentration=100\nCy3=FOO\n')
-
-                # Find all the filenames for this chamber and write to file
-                match = [filename for filename in files if chamber in filename]
-                for m in match:
-                    f.write(m + '\n')
-
-                # Add an empty line between chambers
-                f.write('\n')
+            f.write(experiment_description_text(chamberfiles))
 
     # Return list of experiment description filenames
     return(expdescs)
 
 
+def experiment_description_text(chamberfiles):
+    """Writes the contents of an experiment description file
+
+    Inputs:
+        chamberfiles: a list of (chamber, filenames) pairs, one for each
+            chamber in a group (see group_chambers)
+
+    Output:
+        the contents of the experiment description file for the group
+    """
+    text = ''
+    for chamber, match in chamberfiles:
+        # Write the header for this chamber
+        text += 'Pbm=1\nConcentration=100\nCy3=FOO\n'
+
+        # Write all the filenames for this chamber
+        for m in match:
+            text += m + '\n'
+
+        # Add an empty line between chambers
+        text += '\n'
+    return(text)
+
+
+def read_experiment_description(expdesc):
+    """Reads the gpr filenames listed in an experiment description file
+
+    Inputs:
+        expdesc: the path to the experiment description file to read
+
+    Output:
+        a list of the gpr filenames in the experiment description file
+    """
+    # Keep every non-empty line that is not part of a chamber header
+    with open(expdesc) as f:
+        return([l.strip() for l in f if l.strip() and '=' not in l])
+
+
 def make_masliner_comfile(expdesc, comfile):
     """Makes a comfile for running masliner
 
@@ -118,33 +191,38 @@ def make_masliner_comfile(expdesc, comfile):
 
     # Open file for writing
     with open(comfile, 'w') as f:
-        f.write('perl /project/siggers/perl/GENEPIX/masliner_list.pl\n')
-        f.write('-i ' + expdesc) 
+        f.write(masliner_command(expdesc))
 
 
-def run_masliner_comfile(gprdir, comfile):
-    """Runs a comfile for running masliner
+def masliner_command(expdesc):
+    """Writes the contents of a comfile for running masliner
 
     Inputs:
-        gprdir: the path to the directory where the gpr files are stored
-        comfile: the path to the comfile to run
+        expdesc: the path to the experiment description file to use
+
+    Output:
+        the contents of the comfile
     """
-    # Navigate to gprdir after saving current directory
-    cwd = subprocess.os.getcwd()
-    subprocess.os.chdir(gprdir)
+    return('perl /project/siggers/perl/GENEPIX/masliner_list.pl\n' +
+            '-i ' + expdesc)
+
 
-    # Read contents of comfile as single string on one line
-    with open(comfile) as f:
-        comfilecont = f.read().replace('\n', ' ')
+def masliner_job(gprdir, comfile, inputs):
+    """Describes a batch job for running a masliner comfile
 
-    # Run comfile
-    logging.info('qsub -sync y -P siggers -m a -cwd -N masliner -V -b y ' +
-            comfilecont)
-    subprocess.run(['qsub', '-sync', 'y', '-P', 'siggers', '-m', 'a', '-cwd',
-        '-N', 'masliner', '-V', '-b', 'y', comfilecont])
+    Inputs:
+        gprdir: the path to the directory where the gpr files are stored
+        comfile: the path to the comfile to run
+        inputs: a list of paths to the gpr files used by the comfile
 
-    # Navigate back to original directory
-    subprocess.os.chdir(cwd)
+    Output:
+        a dictionary of arguments for submit_job.submit_comfile
+    """
+    # Masliner should make adjusted gpr files for every chamber in the job
+    chambers = natsorted(set(filename[-7:] for filename in inputs))
+    return({'comfile': comfile, 'jobname': 'masliner', 'stage': 'masliner',
+        'inputs': inputs, 'cwd': gprdir,
+        'expected': [gprdir + '/madj*' + chamber for chamber in chambers]})
 
 
 def check_r2(ofile, r2cutoff):
@@ -175,7 +253,8 @@ def check_r2(ofile, r2cutoff):
                             '\nPlease select additional gpr files to exclude')
 
 
-def masliner_wrapper(gprdir, exclude, maslinerdir, r2cutoff):
+def masliner_wrapper(gprdir, exclude, maslinerdir, r2cutoff,
+        perchamber = False, convert = True):
     """Runs masliner on all gpr files (except exclude) in a given directory
 
     Inputs:
@@ -183,6 +262,12 @@ def masliner_wrapper(gprdir, exclude, maslinerdir, r2cutoff):
         exclude: the list of gpr files to exclude from analysis
         maslinerdir: the path to the directory in which to save the output files
         r2cutoff: the cutoff for the R^2 values in the masliner output
+        perchamber: if True, run a separate masliner job for every chamber
+            instead of grouping chambers that use the same scans
+            (default: False)
+        convert: if True, change the headers of the gpr files for masliner
+            compatibility first (default: True)
+            Set this to False if to_488 has already been run on gprdir
     """
     # If maslinerdir already exists, abort to prevent overwrite
     prevent_overwrite(maslinerdir)
@@ -191,18 +276,20 @@ def masliner_wrapper(gprdir, exclude, maslinerdir, r2cutoff):
     beforefiles = glob.glob(gprdir + '/*')
 
     # Change headers of gpr files so 635s and 647s become 488s
-    logging.info('Changing 635/647 to 488 in headers for ' +
-            'masliner compatibility')
-    to_488(gprdir)
+    if convert:
+        logging.info('Changing 635/647 to 488 in headers for ' +
+                'masliner compatibility')
+        to_488(gprdir)
 
     # Make experiment description file(s) in gprdir
     logging.info('Making experiment description file(s)')
-    expdescs = make_experiment_description(gprdir, exclude)
+    expdescs = make_experiment_description(gprdir, exclude, perchamber)
 
     # Make masliner comfile(s) in gprdir
     logging.info('Making masliner comfile(s)')
-    # Initialize an array to store the comfile name(s)
-    comfiles = []
+    # Initialize arrays to store the input files and jobs of the comfile(s)
+    comfileinputs = []
+    jobs = []
     for expdesc in expdescs:
         # Extract the file number from the experiment description filename
         start = expdesc.rfind('_') + 1
@@ -213,13 +300,14 @@ def masliner_wrapper(gprdir, exclude, maslinerdir, r2cutoff):
         comfile = gprdir + '/masliner_' + filenum + '.com'
         make_masliner_comfile(expdesc, comfile)
 
-        # Append comfile to list of comfiles
-        comfiles.append(comfile)
+        # Describe the job for comfile
+        comfileinputs.append([gprdir + '/' + filename
+            for filename in read_experiment_description(expdesc)])
+        jobs.append(masliner_job(gprdir, comfile, comfileinputs[-1]))
 
-    # Run masliner comfile(s)
+    # Run masliner comfile(s) at the same time
     logging.info('Running masliner comfile(s) (this may take a few minutes)')
-    for comfile in comfiles:
-        run_masliner_comfile(gprdir, comfile)
+    submit_job.submit_comfiles(jobs)
 
     # Get a list of all files in gprdir after running masliner
     afterfiles = glob.glob(gprdir + '/*')
@@ -234,6 +322,11 @@ def masliner_wrapper(gprdir, exclude, maslinerdir, r2cutoff):
     for filename in newfiles:
         subprocess.run(['mv', filename, maslinerdir])
 
+    # Record how much disk space the masliner output takes up
+    job_history.record_stage('masliner', job_history.total_size(
+        [filename for inputs in comfileinputs for filename in inputs]),
+        job_history.total_size(glob.glob(maslinerdir + '/*')))
+
     # Check R^2 values in masliner output files
     logging.info('Checking R^2 values in masliner output\n')
     ofiles = glob.glob(maslinerdir + '/masliner.o*')
@@ -0,0 +1,244 @@
+#!/usr/bin/env perl
+# Fork server that keeps Perl warm for the local worker pool (worker_pool.py)
+#
+# Usage: perl perl_fork_server.pl SOCKET PARENT_PID
+#
+# Listens on SOCKET for requests to run one of the pipeline's Perl scripts,
+# one JSON object per connection with the keys script, args, cwd, env,
+# stdout and stderr. Before forking for a request, the server loads the
+# modules the script uses and reads every file given with -a (the analysis
+# file) into memory, once for all the jobs it runs. Each job then runs in a
+# fork of the server with the caller's environment and directory, and reads
+# those files from memory instead of the shared file system. The reply is a
+# JSON object with the job's exit status and peak resident set size.
+#
+# The server exits once PARENT_PID (the worker pool) has gone away.
+use strict;
+use warnings;
+use IO::Socket::UNIX;
+use IO::Select;
+use JSON::PP;
+use Cwd qw(abs_path);
+use Symbol qw(gensym qualify_to_ref);
+
+package WarmPerl;
+
+# Contents of the files served from memory, with the size and modification
+#   time they were read at, by absolute path
+our %FILES;
+
+# Scripts whose modules have already been loaded
+our %PRELOADED;
+
+# Modules that must be loaded by each job itself, because they look at the
+#   script being run when they are loaded
+our %NO_PRELOAD = map { $_ => 1 } qw(FindBin);
+
+# In a job, the process ID of the job and the pipe on which to report its
+#   peak memory when it exits
+our $JOB_PID;
+our $MEMORY_PIPE;
+
+# Serve reads of cached files from memory
+#   Every other use of open is passed on unchanged
+BEGIN {
+    *CORE::GLOBAL::open = sub (*;$@) {
+        # Turn undefined (e.g. "my $fh") and bareword handles into handles
+        #   the caller can use
+        my $handle;
+        if (!defined $_[0]) {
+            $handle = $_[0] = Symbol::gensym();
+        }
+        elsif (ref $_[0]) {
+            $handle = $_[0];
+        }
+        else {
+            $handle = Symbol::qualify_to_ref($_[0], scalar caller);
+        }
+        return CORE::open($handle) if @_ == 1;
+        my ($mode, @rest) = @_[1 .. $#_];
+
+        # Find the path of a plain read of a file
+        my $path;
+        $mode = '' unless defined $mode;
+        if (@rest == 1 && $mode eq '<') {
+            $path = $rest[0];
+        }
+        elsif (!@rest && $mode =~ /^\s*<\s*(.*?)\s*$/) {
+            $path = $1;
+        }
+        elsif (!@rest && $mode =~ /\S/ && $mode !~ /^\s*[<>+|&-]/ &&
+                $mode !~ /\|\s*$/) {
+            ($path = $mode) =~ s/^\s+|\s+$//g;
+        }
+        if (defined $path && !ref $path && %FILES) {
+            my $fullpath = Cwd::abs_path($path);
+            if (defined $fullpath && exists $FILES{$fullpath}) {
+                return CORE::open($handle, '<',
+                    \$FILES{$fullpath}{contents});
+            }
+        }
+
+        return CORE::open($handle, $mode) unless @rest;
+        return CORE::open($handle, $mode, @rest);
+    };
+}
+
+# Load the modules a script uses, so that no job has to load them again
+sub preload_modules {
+    my ($script) = @_;
+    return if $PRELOADED{$script}++;
+    CORE::open(my $fh, '<', $script) or return;
+    while (my $line = <$fh>) {
+        last if $line =~ /^__(END|DATA)__\s*$/;
+        next unless $line =~ /^\s*(?:use|require)\s+([A-Z][\w:]*)/;
+        my $module = $1;
+        next if $NO_PRELOAD{$module};
+        # Modules that cannot be loaded yet (e.g. ones found through the
+        #   script's own "use lib") are left to the job
+        eval "require $module; 1";
+    }
+    close($fh);
+}
+
+# Read the files given with -a into memory, or again if they have changed
+sub cache_files {
+    my ($request) = @_;
+    my @args = @{$request->{args}};
+    for my $i (0 .. $#args - 1) {
+        next unless $args[$i] eq '-a';
+        my $path = $args[$i + 1];
+        $path = "$request->{cwd}/$path" unless $path =~ m{^/};
+        my $fullpath = Cwd::abs_path($path);
+        next unless defined $fullpath && -f $fullpath;
+        my ($size, $mtime) = (stat($fullpath))[7, 9];
+        next if exists $FILES{$fullpath} &&
+            $FILES{$fullpath}{size} == $size &&
+            $FILES{$fullpath}{mtime} == $mtime;
+        CORE::open(my $fh, '<:raw', $fullpath) or next;
+        local $/;
+        my $contents = <$fh>;
+        close($fh);
+        $FILES{$fullpath} = {contents => $contents, size => $size,
+            mtime => $mtime};
+    }
+}
+
+# Run a script in this process, as "perl SCRIPT ARGS" would
+sub run_script {
+    my ($request, $pipe) = @_;
+    $JOB_PID = $$;
+    $MEMORY_PIPE = $pipe;
+
+    # Take on the caller's environment and directory
+    %ENV = %{$request->{env}};
+    chdir($request->{cwd}) or do {
+        print STDERR "Cannot change to $request->{cwd}: $!\n";
+        exit(2);
+    };
+    CORE::open(STDIN, '<', '/dev/null');
+    CORE::open(STDOUT, '>', $request->{stdout}) or exit(2);
+    CORE::open(STDERR, '>', $request->{stderr}) or exit(2);
+
+    my $script = $request->{script};
+    $script = "./$script" unless $script =~ m{^/};
+    unless (-r $script) {
+        print STDERR "Can't open perl script \"$request->{script}\": $!\n";
+        exit(2);
+    }
+    @ARGV = @{$request->{args}};
+    $0 = $request->{script};
+    FindBin::again() if defined &FindBin::again;
+
+    # Run the script in package main, as perl would
+    package main;
+    do $script;
+    if ($@) {
+        print STDERR $@;
+        exit(255);
+    }
+    exit(0);
+}
+
+# Run a request in a child process and reply with how it went
+sub handle_request {
+    my ($request, $client) = @_;
+    pipe(my $reader, my $writer) or die "Cannot make a pipe: $!\n";
+    my $pid = fork();
+    die "Cannot fork: $!\n" unless defined $pid;
+    if ($pid == 0) {
+        close($reader);
+        close($client);
+        run_script($request, $writer);
+    }
+    close($writer);
+    waitpid($pid, 0);
+    my $status = $?;
+    my $maxrss = <$reader>;
+    close($reader);
+    my $exitstatus = ($status & 127) ? -($status & 127) : $status >> 8;
+    print $client JSON::PP::encode_json({pid => $pid,
+        exit_status => $exitstatus,
+        maxrss => (defined $maxrss && $maxrss =~ /^(\d+)/) ? $1 + 0 :
+            undef}) . "\n";
+}
+
+# Report the peak memory of a job when it exits, however it exits
+END {
+    if (defined $JOB_PID && $$ == $JOB_PID) {
+        my $status = $?;
+        if (CORE::open(my $fh, '<', '/proc/self/status')) {
+            while (my $line = <$fh>) {
+                if ($line =~ /^VmHWM:\s*(\d+)\s*kB/) {
+                    print $MEMORY_PIPE $1 * 1024, "\n";
+                    last;
+                }
+            }
+            close($fh);
+        }
+        close($MEMORY_PIPE);
+        $? = $status;
+    }
+}
+
+# Listen for requests until the worker pool goes away
+sub serve {
+    my ($path, $parent) = @_;
+    unlink($path);
+    my $server = IO::Socket::UNIX->new(Type => IO::Socket::UNIX::SOCK_STREAM(),
+        Local => $path, Listen => 64) or die "Cannot listen on $path: $!\n";
+    my $select = IO::Select->new($server);
+    local $SIG{CHLD} = 'IGNORE';
+    while (getppid() == $parent) {
+        next unless $select->can_read(10);
+        my $client = $server->accept() or next;
+        my $line = <$client>;
+        my $request = defined $line ? eval { JSON::PP::decode_json($line) } :
+            undef;
+        unless (ref $request eq 'HASH') {
+            close($client);
+            next;
+        }
+        preload_modules($request->{script});
+        cache_files($request);
+
+        # Answer every request in its own process, so jobs run concurrently
+        my $pid = fork();
+        if (!defined $pid) {
+            print $client JSON::PP::encode_json({error => "$!"}) . "\n";
+        }
+        elsif ($pid == 0) {
+            close($server);
+            $SIG{CHLD} = 'DEFAULT';
+            handle_request($request, $client);
+            close($client);
+            exit(0);
+        }
+        close($client);
+    }
+    unlink($path);
+}
+
+package main;
+
+WarmPerl::serve(@ARGV);
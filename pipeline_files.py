@@ -0,0 +1,116 @@
+# Names of the directories and files the pipeline makes, and how its gpr
+#   files are read
+#   These are kept here, with only standard library imports, so that the
+#   checks run before the pipeline starts and the scheduler simulator can use
+#   them without loading the pipeline steps
+import subprocess
+import re
+import hashlib
+import threading
+
+# The subdirectories of a gpr directory holding intermediate files
+STAGE_DIRS = ['masliner', 'spatial_detrend', 'average_probes']
+
+# Prefixes the Perl scripts add to the names of the gpr files they make
+#   Masliner writes an adjusted copy of every scan and spatial detrending a
+#   normalized copy of every adjusted file it is given
+ADJUSTED_PREFIX = 'madj_'
+NORMALIZED_PREFIX = 'norm_'
+
+# The types of probe averaging and the prefixes added to the names of the
+#   output files of each
+AVERAGE_TYPES = ['or', 'br', 'r']
+OUTPUT_PREFIXES = {'or': ['or_'], 'br': ['o1o2top_br_'],
+        'r': ['o1match_r_', 'o2match_r_']}
+
+# Types of data matrix made from the averaged gpr files and the averaged gpr
+#   files each is made from
+#   NOTE: averaging over orientations ('r') is separated into 'o1' and 'o2'
+AVG_TYPES = ['or', 'br', 'o1', 'o2']
+AVG_GPR_PATTERNS = {'or': 'or_norm_madj*.gpr',
+        'br': 'o1o2top_br_norm_madj*.gpr', 'o1': 'o1match_r_norm_madj*.gpr',
+        'o2': 'o2match_r_norm_madj*.gpr'}
+
+# Extension of the file recording which gpr file each data column came from
+MANIFEST_EXTENSION = '.manifest.tsv'
+
+# Gpr files are read as latin-1 so that every byte is kept as it is
+ENCODING = 'latin-1'
+
+# Names of the foreground median columns of gpr files (e.g. 'F532 Median')
+MEDIAN_COLUMN = re.compile(r'F[0-9]+ Median$')
+
+# Hashes of files that have already been read, keyed on path, size and
+#   modification time so that each file is only read once per run
+HASHES = {}
+HASHES_LOCK = threading.Lock()
+
+
+def split_gpr(lines):
+    """Splits the lines of a gpr file into its header and its spot rows
+
+    Inputs:
+        lines: an iterator over the lines of the gpr file
+            (e.g. a file opened with newline = '' and encoding = ENCODING)
+
+    Output:
+        a list of the header lines (including the column header line)
+        the rest of the iterator, which yields the spot rows
+        NOTE: a header that cannot be read raises ValueError, IndexError or
+            StopIteration
+    """
+    # The second line gives the number of header records, which are followed
+    #   by the column header line
+    header = [next(lines), next(lines)]
+    nrecords = int(header[1].split()[0])
+    for i in range(nrecords + 1):
+        header.append(next(lines))
+    return(header, lines)
+
+
+def gpr_columns(header):
+    """Finds the names of the columns of a gpr file
+
+    Inputs:
+        header: the header lines of the gpr file, as returned by split_gpr
+
+    Output:
+        a list of the column names, without quotes
+    """
+    return([column.strip().strip('"')
+        for column in header[-1].rstrip('\r\n').split('\t')])
+
+
+def content_hash(path, prefix = b'', offset = 0):
+    """Computes the SHA-256 hash of a file's contents
+
+    Inputs:
+        path: the path to the file
+        prefix: bytes to hash before the contents of the file (default: none)
+        offset: the number of bytes at the start of the file to leave out
+            (default: 0)
+            Together these give the hash the file would have if its first
+            offset bytes were replaced by prefix
+
+    Output:
+        the hexadecimal hash
+        NOTE: the hashes of whole files are remembered, so each file is only
+            read once unless it changes
+    """
+    whole = prefix == b'' and offset == 0
+    stat = subprocess.os.stat(path)
+    key = (subprocess.os.path.abspath(path), stat.st_size, stat.st_mtime)
+    with HASHES_LOCK:
+        if whole and key in HASHES:
+            return(HASHES[key])
+
+    sha = hashlib.sha256(prefix)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            sha.update(chunk)
+
+    if whole:
+        with HASHES_LOCK:
+            HASHES[key] = sha.hexdigest()
+    return(sha.hexdigest())
@@ -0,0 +1,609 @@
+import subprocess
+import glob
+import fnmatch
+from natsort import natsorted
+import analysis_file
+import masliner
+import gpr_qc
+import spatial_detrend
+import average_probes
+import data_matrix
+import job_history
+import pipeline_files
+import resource_model
+import result_cache
+import submit_job
+
+def make_job(stage, jobname, comfile, cwd, reads, writes, inputbytes):
+    """Describes a job that the pipeline would submit
+
+    Inputs:
+        stage: the pipeline stage the job belongs to
+        jobname: the name the job would be submitted with
+        comfile: the path to the comfile the job would run
+        cwd: the directory the job would run in
+        reads: a list of the files (or file patterns) the job would read
+        writes: a list of the files (or file patterns) the job would write
+        inputbytes: the (estimated) total size of the job's input files
+
+    Output:
+        a dictionary describing the job, including its estimated runtime,
+            peak memory usage and the resources that would be requested
+            (None if the job would run in the local worker pool)
+    """
+    local = submit_job.SETTINGS['backend'] == 'local'
+    runtime, memory = job_history.estimate_job(stage, inputbytes, local)
+    return({'stage': stage, 'jobname': jobname, 'comfile': comfile,
+        'cwd': cwd, 'reads': reads, 'writes': writes,
+        'input_bytes': inputbytes, 'runtime': runtime, 'memory': memory,
+        'request': None if local else
+            resource_model.request_resources(stage, inputbytes),
+        'cached': None, 'scratch': None})
+
+
+def planned_file_key(planned):
+    """Makes a function that describes files as they would be when the
+    pipeline's jobs run, for working out the jobs' cache keys
+
+    Inputs:
+        planned: a dictionary mapping the absolute paths of the files the
+            pipeline would make or change to what they would contain:
+                ('text', contents) for list files and experiment descriptions
+                ('file', path) for a copy of the file at path (e.g. an output
+                    file that would be copied from the cache)
+                ('hash', hash) for a gpr file whose header would be converted
+
+    Output:
+        a function that can be passed to result_cache.job_key as filekey
+            Files that are not in planned are described as they are now
+    """
+    def filekey(path, cwd):
+        path = subprocess.os.path.abspath(path)
+        name = subprocess.os.path.basename(path)
+        kind, value = planned.get(path, ('file', path))
+        if kind == 'text':
+            return(result_cache.text_key(name, value, cwd, filekey))
+        if kind == 'hash':
+            return(name + ':' + value)
+        key = result_cache.file_key(value, cwd, filekey)
+        if key is None:
+            return(None)
+        return(name + key[len(subprocess.os.path.basename(value)):])
+    return(filekey)
+
+
+def plan_job(job, command, reads, inputbytes, planned, cwd = None):
+    """Describes a job that the pipeline would submit and works out whether
+    its output would be copied from the cache instead
+
+    Inputs:
+        job: the dictionary of arguments for submit_job.submit_comfile that
+            the pipeline would submit the job with
+        command: the contents of the job's comfile
+        reads: a list of the files the job would read
+        inputbytes: the (estimated) total size of the job's input files
+        planned: the files the pipeline would make or change before the job
+            runs (see planned_file_key)
+        cwd: the directory the job would run in, if job does not say
+            (default: current directory)
+
+    Output:
+        a dictionary describing the job (see make_job), where 'cached' is
+            the cache entry its output would be copied from and 'scratch' is
+            the file describing the job for running it on scratch (or None)
+            NOTE: 'writes' is left for the caller to fill in, since the names
+                of the output files depend on whether they come from the cache
+        a list of (saved file, target path) pairs, one for every output file
+            that would be copied from the cache (or None if the job would run)
+    """
+    cwd = subprocess.os.path.abspath(job.get('cwd') or cwd or
+            subprocess.os.getcwd())
+    described = make_job(job['stage'], job['jobname'], job['comfile'], cwd,
+            reads, [], inputbytes)
+
+    # Look for the job in the cache, with its key worked out from its input
+    #   files as they would be when it runs
+    outputs = None
+    cachedir = submit_job.SETTINGS['cache_dir']
+    if cachedir is not None:
+        key = result_cache.job_key(job['stage'], command.replace('\n', ' '),
+                cwd, job['inputs'], planned_file_key(planned))
+        try:
+            manifest = None if key is None else \
+                    result_cache.read_entry(cachedir, key, job['expected'])
+        except (OSError, ValueError, KeyError):
+            manifest = None
+        if manifest is not None:
+            described['cached'] = cachedir + '/' + key
+            outputs = result_cache.expected_files(described['cached'],
+                    manifest, job['expected'])
+
+    # A job run on scratch is described in a file next to its comfile
+    if outputs is None and submit_job.SETTINGS['scratch']:
+        described['scratch'] = subprocess.os.path.splitext(
+                job['comfile'])[0] + '.scratch.json'
+
+    return(described, outputs)
+
+
+def made_files(outputs, names):
+    """Finds the names of the output files of a job
+
+    Inputs:
+        outputs: the output files that would be copied from the cache, as
+            returned by plan_job (or None if the job would run)
+        names: a dictionary mapping the names the job's output files would
+            have if it ran to the files they would be about as big as
+
+    Output:
+        a dictionary mapping the name of each output file to a file about as
+            big as it (the cached file itself if it comes from the cache)
+    """
+    if outputs is None:
+        return(names)
+    return({subprocess.os.path.basename(target): source
+        for source, target in outputs})
+
+
+def plan_analysis_file(analysisdir):
+    """Plans the analysis file step
+
+    Inputs:
+        analysisdir: the directory to check for an analysis file
+
+    Output:
+        a dictionary describing the step
+        the path to the analysis file the pipeline would use
+    """
+    analysis = analysis_file.check_analysis_file(analysisdir)
+
+    # If there's already an analysis file, nothing needs to be done
+    if len(analysis) == 1:
+        return({'title': 'Analysis file: found ' + analysis[0],
+            'files': [], 'jobs': [], 'concurrent': False, 'disk': 0},
+            analysis[0])
+
+    # Otherwise a new analysis file is made locally (not as a batch job)
+    analysisfile = analysis_file.analysis_file_name(analysisdir, analysis[0])
+    return({'title': 'Analysis file: make ' + analysisfile,
+        'files': [analysisdir + '/make_analysis_file.com', analysisfile],
+        'jobs': [], 'concurrent': False, 'disk': 0}, analysisfile)
+
+
+def plan_quality_control(gprdirs, outdir, matprefix, planned):
+    """Plans the conversion of the gpr file headers and the quality control
+    of the scans
+
+    Inputs:
+        gprdirs: a list of the paths to the directories containing the gpr files
+        outdir: the path to the directory where the report would be saved
+        matprefix: the prefix of the names of the pipeline's output files
+        planned: the files the pipeline would make or change
+            If the cache is used, the hash each gpr file would have once its
+            header is converted is added to it
+
+    Output:
+        a dictionary describing the step
+    """
+    gprfiles = [filename for gprdir in gprdirs
+            for filename in natsorted(glob.glob(gprdir + '/*.gpr'))]
+    if submit_job.SETTINGS['cache_dir'] is not None:
+        for filename in gprfiles:
+            planned[subprocess.os.path.abspath(filename)] = ('hash',
+                    gpr_qc.converted_hash(filename))
+
+    return({'title': 'Quality control: convert and check ' +
+        str(len(gprfiles)) + ' gpr file(s)',
+        'files': [outdir + '/' + matprefix + '_qc_report.tsv'], 'jobs': [],
+        'concurrent': False, 'disk': 0})
+
+
+def plan_masliner(gprdir, exclude, perchamber, planned):
+    """Plans the masliner step for one gpr directory
+
+    Inputs:
+        gprdir: the path to the directory where the gpr files are saved
+        exclude: the list of gpr files to exclude from analysis
+        perchamber: if True, every chamber gets a masliner job of its own
+        planned: the files the pipeline would make or change
+            The experiment descriptions and any adjusted gpr files that would
+            be copied from the cache are added to it
+
+    Output:
+        a dictionary describing the step
+        a dictionary mapping the name of every adjusted gpr file the step
+            would make to a file about as big as it
+    """
+    maslinerdir = gprdir + '/masliner'
+    files = []
+    jobs = []
+    madjfiles = {}
+    for chambernums, chamberfiles in masliner.group_chambers(gprdir,
+            exclude, perchamber).items():
+        expdesc = gprdir + '/experiment_description_' + chambernums + '.txt'
+        comfile = gprdir + '/masliner_' + chambernums + '.com'
+        files += [expdesc, comfile]
+        planned[subprocess.os.path.abspath(expdesc)] = ('text',
+                masliner.experiment_description_text(chamberfiles))
+
+        # The job reads every scan of every chamber in the group
+        scans = [filename for chamber, filenames in chamberfiles
+                for filename in filenames]
+        reads = [gprdir + '/' + filename for filename in scans]
+        job, outputs = plan_job(masliner.masliner_job(gprdir, comfile, reads),
+                masliner.masliner_command(expdesc), [expdesc] + reads,
+                job_history.total_size(reads), planned)
+
+        # The job writes an adjusted copy of every scan, which
+        #   masliner_wrapper moves to maslinerdir
+        made = made_files(outputs, {pipeline_files.ADJUSTED_PREFIX + filename:
+            gprdir + '/' + filename for filename in scans})
+        job['writes'] = [maslinerdir + '/' + name for name in natsorted(made)]
+        if outputs is not None:
+            for name, source in made.items():
+                planned[subprocess.os.path.abspath(maslinerdir + '/' +
+                    name)] = ('file', source)
+        madjfiles.update(made)
+        jobs.append(job)
+
+    return({'title': 'Masliner: ' + gprdir, 'files': files, 'jobs': jobs,
+        'concurrent': True, 'disk': job_history.estimate_disk('masliner',
+            sum(job['input_bytes'] for job in jobs))}, madjfiles)
+
+
+def plan_spatial_detrend(gprdir, madjfiles, analysisfile, chunksize,
+        planned):
+    """Plans the spatial detrending step for one gpr directory
+
+    Inputs:
+        gprdir: the path to the directory where the gpr files are saved
+        madjfiles: the adjusted gpr files the masliner step would make, as
+            returned by plan_masliner
+        analysisfile: the path to the analysis file to use
+        chunksize: the number of chambers to detrend in each batch job
+        planned: the files the pipeline would make or change
+            The lists of adjusted gpr files, the links to them and any
+            normalized gpr files that would be copied from the cache are
+            added to it
+
+    Output:
+        a dictionary describing the step
+        a dictionary mapping the name of every normalized gpr file the step
+            would make to a file about as big as it
+    """
+    madjgprdir = gprdir + '/masliner'
+    normgprdir = gprdir + '/spatial_detrend'
+
+    # Only the highest intensity scan of each chamber is detrended
+    highintfiles = spatial_detrend.highest_intensity_scans(list(madjfiles))
+
+    files = []
+    jobs = []
+    normfiles = {}
+    for chambernums, shard in spatial_detrend.shard_chambers(highintfiles,
+            chunksize).items():
+        sharddir = madjgprdir + '/shard_' + chambernums
+        madjgprlist = sharddir + '/madj_gpr_' + chambernums + '.list'
+        comfile = sharddir + '/process_custom_probes_' + chambernums + '.com'
+        files += [madjgprlist, comfile]
+        planned[subprocess.os.path.abspath(madjgprlist)] = ('text',
+                ''.join([filename + '\n' for filename in shard]))
+
+        # The shard directory links to the files in the shard
+        inputs = [madjgprdir + '/' + filename for filename in shard]
+        for filename in shard:
+            source = subprocess.os.path.abspath(madjgprdir + '/' + filename)
+            if source in planned:
+                planned[subprocess.os.path.abspath(sharddir + '/' +
+                    filename)] = planned[source]
+
+        job, outputs = plan_job(spatial_detrend.spatial_detrend_job(comfile,
+            sharddir, inputs), spatial_detrend.spatial_detrend_command(
+                madjgprlist, analysisfile), [madjgprlist, analysisfile] +
+            inputs, job_history.total_size([madjfiles[filename]
+                for filename in shard]), planned)
+
+        # The job writes a normalized copy of every file in the shard, which
+        #   spatial_detrend_wrapper moves to normgprdir
+        made = made_files(outputs, {pipeline_files.NORMALIZED_PREFIX +
+            filename: madjfiles[filename] for filename in shard})
+        job['writes'] = [normgprdir + '/' + name for name in natsorted(made)]
+        if outputs is not None:
+            for name, source in made.items():
+                planned[subprocess.os.path.abspath(normgprdir + '/' +
+                    name)] = ('file', source)
+        normfiles.update(made)
+        jobs.append(job)
+
+    return({'title': 'Spatial detrending: ' + gprdir, 'files': files,
+        'jobs': jobs, 'concurrent': True,
+        'disk': job_history.estimate_disk('spatial_detrend',
+            sum(job['input_bytes'] for job in jobs))}, normfiles)
+
+
+def plan_average_probes(gprdir, normfiles, inputbytes, planned):
+    """Plans the probe averaging step for one gpr directory
+
+    Inputs:
+        gprdir: the path to the directory where the gpr files are saved
+        normfiles: the normalized gpr files the spatial detrending step would
+            make, as returned by plan_spatial_detrend
+        inputbytes: the estimated total size of the normalized gpr files
+        planned: the files the pipeline would make or change
+            The list of normalized gpr files and any averaged gpr files that
+            would be copied from the cache are added to it
+
+    Output:
+        a dictionary describing the step
+        a dictionary mapping the name of every averaged gpr file the step
+            would make to a file about as big as it
+    """
+    normgprdir = gprdir + '/spatial_detrend'
+    avggprdir = gprdir + '/average_probes'
+    normgprlist = avggprdir + '/norm_gpr.list'
+
+    # The list has the full path of every normalized gpr file, like the one
+    #   make_norm_gpr_list makes
+    inputs = natsorted([normgprdir + '/' + name for name in normfiles
+        if fnmatch.fnmatch(name, 'norm_madj*.gpr')])
+    planned[subprocess.os.path.abspath(normgprlist)] = ('text',
+            ''.join([filename + '\n' for filename in inputs]))
+
+    files = [normgprlist]
+    jobs = []
+    avgfiles = {}
+    for avgtype in pipeline_files.AVERAGE_TYPES:
+        comfile = avggprdir + '/average_probes_' + avgtype + '.com'
+        files.append(comfile)
+        job, outputs = plan_job(average_probes.average_probes_job(comfile,
+            avgtype, inputs, avggprdir),
+            average_probes.average_probes_command(normgprlist, avgtype),
+            [normgprlist] + inputs, inputbytes, planned)
+
+        # The job writes an averaged copy of every normalized gpr file for
+        #   every type of output
+        made = made_files(outputs, {prefix + subprocess.os.path.basename(
+            filename): normfiles[subprocess.os.path.basename(filename)]
+            for prefix in pipeline_files.OUTPUT_PREFIXES[avgtype]
+            for filename in inputs})
+        job['writes'] = [avggprdir + '/' + name for name in natsorted(made)]
+        if outputs is not None:
+            for name, source in made.items():
+                planned[subprocess.os.path.abspath(avggprdir + '/' +
+                    name)] = ('file', source)
+        avgfiles.update(made)
+        jobs.append(job)
+
+    return({'title': 'Average probes: ' + gprdir, 'files': files,
+        'jobs': jobs, 'concurrent': False,
+        'disk': job_history.estimate_disk('average_probes', inputbytes)},
+        avgfiles)
+
+
+def plan_data_matrix(avgfiles, outdir, matprefix, inputbytes, planned):
+    """Plans the data matrix step
+
+    Inputs:
+        avgfiles: a dictionary mapping the path to each directory of averaged
+            gpr files to the files the probe averaging step would make in it,
+            as returned by plan_average_probes
+        outdir: the path to the directory in which to save the data matrices
+        matprefix: a prefix for the names of the data matrices
+        inputbytes: the estimated total size of the averaged gpr files for
+            each averaging type
+        planned: the files the pipeline would make or change
+            The lists of averaged gpr files are added to it
+
+    Output:
+        a dictionary describing the step
+    """
+    files = []
+    jobs = []
+    for avgtype in pipeline_files.AVG_TYPES:
+        avggprlist = outdir + '/' + avgtype + '_gpr.list'
+        comfile = outdir + '/make_datamatrix_' + avgtype + '.com'
+        datmat = outdir + '/' + matprefix + '_' + avgtype + '.dat'
+        files += [avggprlist, comfile, data_matrix.manifest_name(datmat)]
+
+        # The list has the matching files of each directory in turn, sorted
+        #   by chamber, like the one make_avg_gpr_list makes
+        inputs = []
+        for avggprdir in sorted(avgfiles):
+            inputs += sorted([avggprdir + '/' + name
+                for name in avgfiles[avggprdir] if fnmatch.fnmatch(name,
+                    pipeline_files.AVG_GPR_PATTERNS[avgtype])],
+                key = lambda x: x[-7:])
+        planned[subprocess.os.path.abspath(avggprlist)] = ('text',
+                ''.join([filename + '\n' for filename in inputs]))
+
+        # data_matrix_wrapper runs the jobs in outdir
+        job, outputs = plan_job(data_matrix.data_matrix_job(comfile, avgtype,
+            inputs, datmat), data_matrix.data_matrix_command(avggprlist,
+                datmat), [avggprlist] + inputs, inputbytes, planned,
+            cwd = outdir)
+        job['writes'] = [datmat]
+        jobs.append(job)
+
+    return({'title': 'Data matrices: ' + outdir, 'files': files,
+        'jobs': jobs, 'concurrent': False,
+        'disk': job_history.estimate_disk('data_matrix',
+            inputbytes * len(jobs))})
+
+
+def plan_pipeline(analysisdir, gprdirs, exclude, outdir, matprefix,
+        chunksize = 1, perchamber = False):
+    """Plans the full PBM preprocessing pipeline without running anything
+
+    Inputs:
+        analysisdir: the path to the directory where the analysis file is stored
+            OR the path to the directory where a new analysis file should be made
+        gprdirs: a list of the paths to the directories containing the gpr files
+        exclude: a list of gpr files to exclude from analysis
+        outdir: the path to the directory where the output data matrices
+            should be saved
+        matprefix: the prefix to add to the filenames of the output
+            data matrices
+        chunksize: the number of chambers to spatially detrend in each
+            batch job (default: 1)
+        perchamber: if True, run a separate masliner job for every chamber
+            (default: False)
+
+    Output:
+        a list of dictionaries describing each step, in the order they run
+        NOTE: the settings of submit_job decide whether each job would be
+            submitted, run in the local worker pool, run on scratch or copied
+            from the cache
+    """
+    steps = []
+
+    # The files the pipeline would make or change, for working out which jobs
+    #   would be copied from the cache
+    planned = {}
+
+    # Create a logfile
+    steps.append({'title': 'Log file', 'files': [outdir + '/' + matprefix +
+        '_logfile'], 'jobs': [], 'concurrent': False, 'disk': 0})
+
+    # Check for analysis file
+    step, analysisfile = plan_analysis_file(analysisdir)
+    steps.append(step)
+
+    # Convert the gpr file headers and check the quality of the scans
+    steps.append(plan_quality_control(gprdirs, outdir, matprefix, planned))
+
+    # Run masliner
+    madjfiles = {}
+    for gprdir in gprdirs:
+        step, madjfiles[gprdir] = plan_masliner(gprdir, exclude, perchamber,
+                planned)
+        steps.append(step)
+
+    # Perform spatial detrending
+    normbytes = {}
+    normfiles = {}
+    for gprdir in gprdirs:
+        step, normfiles[gprdir] = plan_spatial_detrend(gprdir,
+                madjfiles[gprdir], analysisfile, chunksize, planned)
+        steps.append(step)
+        normbytes[gprdir] = step['disk']
+
+    # Average probe intensities
+    avgbytes = 0
+    avgfiles = {}
+    for gprdir in gprdirs:
+        step, avgfiles[gprdir + '/average_probes'] = plan_average_probes(
+                gprdir, normfiles[gprdir], normbytes[gprdir], planned)
+        steps.append(step)
+        avgbytes += step['disk'] / 4
+
+    # Create data matrices
+    steps.append(plan_data_matrix(avgfiles, outdir, matprefix, avgbytes,
+        planned))
+
+    # Jobs run on scratch also write a description of themselves
+    for step in steps:
+        step['files'] += [job['scratch'] for job in step['jobs']
+                if job['scratch'] is not None]
+
+    return(steps)
+
+
+def format_bytes(nbytes):
+    """Formats a number of bytes for printing (e.g. '1.2 GB')"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return('%.1f %s' % (nbytes, unit))
+        nbytes /= 1024
+    return('%.1f TB' % nbytes)
+
+
+def format_seconds(seconds):
+    """Formats a number of seconds for printing (e.g. '1h 02m 03s')"""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return('%dh %02dm %02ds' % (hours, minutes, seconds))
+
+
+def step_runtime(step):
+    """Estimates the wall clock time of a step from the runtimes of its jobs
+
+    Inputs:
+        step: a dictionary describing the step
+
+    Output:
+        the estimated wall clock time of the step in seconds
+        NOTE: jobs whose output would be copied from the cache take no time
+    """
+    runtimes = [job['runtime'] for job in step['jobs']
+            if job['cached'] is None]
+    if not step['concurrent']:
+        return(sum(runtimes))
+
+    # The local worker pool only runs so many jobs at the same time, so give
+    #   each job to the worker that would be free first
+    if submit_job.SETTINGS['backend'] == 'local':
+        workers = [0] * submit_job.SETTINGS['workers']
+        for runtime in runtimes:
+            workers[workers.index(min(workers))] += runtime
+        runtimes = workers
+    return(max(runtimes + [0]))
+
+
+def format_plan(steps):
+    """Formats a pipeline plan for printing
+
+    Inputs:
+        steps: the list of steps returned by plan_pipeline
+
+    Output:
+        a string describing every file and job the pipeline would make,
+            with estimated runtime, peak memory and disk usage
+    """
+    lines = []
+    for step in steps:
+        lines.append(step['title'])
+        for filename in step['files']:
+            lines.append('  file: ' + filename)
+        for job in step['jobs']:
+            lines.append('  job: ' + job['jobname'] + ' (' + job['comfile'] +
+                    ')')
+            lines.append('    runs in: ' + job['cwd'])
+            for filename in job['reads']:
+                lines.append('    reads: ' + filename)
+            for filename in job['writes']:
+                lines.append('    writes: ' + filename)
+            if job['cached'] is not None:
+                lines.append('    copied from the cache: ' + job['cached'])
+                continue
+            lines.append('    estimated runtime: ' +
+                    format_seconds(job['runtime']) + ', peak memory: ' +
+                    format_bytes(job['memory']))
+            if job['request'] is None:
+                lines.append('    runs in the local worker pool')
+            elif submit_job.SETTINGS['sizing']:
+                lines.append('    requests: ' +
+                        ' '.join(resource_model.qsub_flags(job['request'])))
+        if step['jobs']:
+            lines.append('  estimated runtime: ' +
+                    format_seconds(step_runtime(step)) +
+                    (' (jobs run at the same time)' if step['concurrent']
+                        else ' (jobs run one after the other)') +
+                    ', disk usage: ' + format_bytes(step['disk']))
+        if not step['jobs'] and not step['files']:
+            lines.append('  nothing to do')
+        lines.append('')
+
+    # Summarize the whole run (steps are run one after the other)
+    jobs = [job for step in steps for job in step['jobs']]
+    running = [job for job in jobs if job['cached'] is None]
+    lines.append('Total: ' + str(len(jobs)) + ' jobs' +
+            (' (' + str(len(jobs) - len(running)) + ' copied from the cache)'
+                if len(running) < len(jobs) else '') +
+            ', estimated runtime ' +
+            format_seconds(sum(step_runtime(step) for step in steps)) +
+            ', peak memory ' +
+            format_bytes(max([job['memory'] for job in running] + [0])) +
+            ', disk usage ' +
+            format_bytes(sum(step['disk'] for step in steps)))
+
+    return('\n'.join(lines))
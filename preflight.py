@@ -0,0 +1,194 @@
+import subprocess
+import glob
+import pipeline_files
+
+
+def check_analysis_dir(analysisdir):
+    """Checks that a directory holds an analysis file or the files to make one
+
+    Inputs:
+        analysisdir: the path to the analysis directory
+
+    Output:
+        a list of problems found (empty if there are none)
+    """
+    if not subprocess.os.path.isdir(analysisdir):
+        return(['The analysis directory ' + analysisdir + ' does not exist'])
+
+    # One analysis file is enough
+    analysisfiles = glob.glob(analysisdir + '/*analysis*.txt')
+    if len(analysisfiles) == 1:
+        return([])
+    if len(analysisfiles) > 1:
+        return(['There is more than one file of the form "*analysis*.txt" ' +
+            'in ' + analysisdir])
+
+    # Otherwise the files needed to make one must be there
+    problems = []
+    for pattern in ['*DNAFront_BCBottom*.tdt', '*SequenceList*.txt']:
+        matches = glob.glob(analysisdir + '/' + pattern)
+        if len(matches) != 1:
+            problems.append('There must be exactly one file of the form "' +
+                    pattern + '" in ' + analysisdir + ' (found ' +
+                    str(len(matches)) + ')')
+    if not glob.glob(analysisdir + '/*.gpr'):
+        problems.append('There is no file of the form "*.gpr" in ' +
+                analysisdir)
+    return(problems)
+
+
+def sniff_gpr(filename):
+    """Checks that the header of a gpr file can be read, without reading spots
+
+    Inputs:
+        filename: the path to the gpr file
+
+    Output:
+        a description of the problem with the header (or None if it is fine)
+    """
+    try:
+        with open(filename, newline = '',
+                encoding = pipeline_files.ENCODING) as f:
+            if not f.readline().startswith('ATF'):
+                return('does not start with "ATF"')
+            f.seek(0)
+            header, rows = pipeline_files.split_gpr(iter(f))
+    except (OSError, ValueError, IndexError, StopIteration):
+        return('does not have a readable gpr header')
+    if not any(pipeline_files.MEDIAN_COLUMN.match(column)
+            for column in pipeline_files.gpr_columns(header)):
+        return('has no foreground median column')
+    return(None)
+
+
+def check_gpr_dirs(gprdirs):
+    """Checks that every gpr directory exists and holds readable gpr files
+
+    Inputs:
+        gprdirs: a list of the paths to the gpr directories
+
+    Output:
+        a list of problems found (empty if there are none)
+    """
+    problems = []
+    seen = set()
+    for gprdir in gprdirs:
+        if not subprocess.os.path.isdir(gprdir):
+            problems.append('The gpr directory ' + gprdir + ' does not exist')
+            continue
+
+        # The same directory twice would make every output twice
+        realpath = subprocess.os.path.realpath(gprdir)
+        if realpath in seen:
+            problems.append('The gpr directory ' + gprdir + ' is given ' +
+                    'more than once')
+        seen.add(realpath)
+
+        gprfiles = sorted(glob.glob(gprdir + '/*.gpr'))
+        if not gprfiles:
+            problems.append('There is no file of the form "*.gpr" in ' +
+                    gprdir)
+        for filename in gprfiles:
+            problem = sniff_gpr(filename)
+            if problem is not None:
+                problems.append(filename + ' ' + problem)
+    return(problems)
+
+
+def check_exclude(exclude, gprdirs):
+    """Checks that every gpr file to exclude is the name of a gpr file
+
+    Inputs:
+        exclude: the list of gpr files to exclude (or None)
+        gprdirs: a list of the paths to the gpr directories
+
+    Output:
+        a list of problems found (empty if there are none)
+    """
+    if exclude is None:
+        return([])
+    names = set(subprocess.os.path.basename(filename) for gprdir in gprdirs
+            for filename in glob.glob(gprdir + '/*.gpr'))
+    problems = []
+    for name in exclude:
+        if '/' in name:
+            problems.append('The gpr file to exclude ' + name + ' must be ' +
+                    'given without its path')
+        elif name not in names:
+            problems.append('The gpr file to exclude ' + name + ' is not in ' +
+                    'any of the gpr directories')
+    return(problems)
+
+
+def check_outputs(gprdirs, outdir, matprefix, appendto):
+    """Checks that no step would stop to avoid overwriting an existing file
+
+    Inputs:
+        gprdirs: a list of the paths to the gpr directories
+        outdir: the path to the output directory
+        matprefix: the prefix of the data matrices
+        appendto: the path and prefix of existing data matrices to append
+            to (or None)
+
+    Output:
+        a list of problems found (empty if there are none)
+    """
+    # Files and directories made in each gpr directory
+    existing = []
+    seen = set()
+    for gprdir in gprdirs:
+        # Directories given twice are already reported by check_gpr_dirs
+        if subprocess.os.path.realpath(gprdir) in seen:
+            continue
+        seen.add(subprocess.os.path.realpath(gprdir))
+        existing += [gprdir + '/' + stagedir for stagedir in
+                pipeline_files.STAGE_DIRS]
+        existing += sorted(glob.glob(gprdir + '/experiment_description_*.txt'))
+        existing += sorted(glob.glob(gprdir + '/masliner_*.com'))
+
+    # Files made in the output directory
+    if subprocess.os.path.exists(outdir) and \
+            not subprocess.os.path.isdir(outdir):
+        return(['The output directory ' + outdir + ' is not a directory'])
+    existing += [outdir + '/' + matprefix + '_logfile',
+            outdir + '/' + matprefix + '_qc_report.tsv']
+    for avgtype in pipeline_files.AVG_TYPES:
+        existing += [outdir + '/' + avgtype + '_gpr.list',
+                outdir + '/make_datamatrix_' + avgtype + '.com',
+                outdir + '/' + matprefix + '_' + avgtype + '.dat',
+                outdir + '/' + matprefix + '_' + avgtype +
+                pipeline_files.MANIFEST_EXTENSION]
+    problems = ['This file/directory already exists: ' + path
+            for path in existing if subprocess.os.path.exists(path)]
+
+    # The data matrices to append to must already exist
+    if appendto is not None:
+        for avgtype in pipeline_files.AVG_TYPES:
+            if not subprocess.os.path.isfile(appendto + '_' + avgtype +
+                    '.dat'):
+                problems.append('The data matrix to append to ' + appendto +
+                        '_' + avgtype + '.dat does not exist')
+    return(problems)
+
+
+def preflight(analysisdir, gprdirs, exclude, outdir, matprefix,
+        appendto = None):
+    """Checks the pipeline's inputs and outputs before anything is started
+
+    Inputs:
+        analysisdir: the path to the analysis directory
+        gprdirs: a list of the paths to the gpr directories
+        exclude: the list of gpr files to exclude (or None)
+        outdir: the path to the output directory
+        matprefix: the prefix of the data matrices
+        appendto: the path and prefix of existing data matrices to append
+            to (default: None)
+
+    Output:
+        a list of every problem found (empty if there are none)
+        NOTE: only the headers of the gpr files are read, so this takes well
+            under a second even for many slides
+    """
+    return(check_analysis_dir(analysisdir) + check_gpr_dirs(gprdirs) +
+            check_exclude(exclude, gprdirs) +
+            check_outputs(gprdirs, outdir, matprefix, appendto))
@@ -1,12 +1,8 @@
 import subprocess
-import analysis_file
-import masliner
-import spatial_detrend
-import average_probes
-import data_matrix
 import argparse
 import logging
 import sys
+import preflight
 from prevent_overwrite import prevent_overwrite
 
 # Make sure Python 3 is being used
@@ -16,7 +12,9 @@ if sys.version_info[0] != 3:
             "module load python3")
     sys.exit(1)
 
-def run_pipeline(analysisdir, gprdirs, exclude, r2cutoff, outdir, matprefix):
+def run_pipeline(analysisdir, gprdirs, exclude, r2cutoff, outdir, matprefix,
+        chunksize = 1, perchamber = False, qcblock = False, compact = False,
+        appendto = None):
     """Wrapper that runs the full PBM preprocessing pipeline
 
     Inputs:
@@ -34,7 +32,27 @@ def run_pipeline(analysisdir, gprdirs, exclude, r2cutoff, outdir, matprefix):
             should be saved
         matprefix: the prefix to add to the filenames of the output
             data matrices
+        chunksize: the number of chambers to spatially detrend in each
+            batch job (default: 1)
+        perchamber: if True, run a separate masliner job for every chamber
+            (default: False)
+        qcblock: if True, abort before submitting any jobs if quality control
+            finds problems in any of the gpr files (default: False)
+        compact: if True, compact the intermediate files in each gpr
+            directory once the data matrices have been made (default: False)
+        appendto: the path and prefix of existing data matrices to add the
+            columns of the new data matrices to (default: None)
     """
+    # Load the stage modules (and natsort) only once the pipeline runs, so
+    #   that problems with the arguments are reported without waiting for them
+    import analysis_file
+    import masliner
+    import gpr_qc
+    import spatial_detrend
+    import average_probes
+    import data_matrix
+    import compact_storage
+
     # Create outdir if it doesn't already exist
     if not subprocess.os.path.exists(outdir):
         subprocess.run(['mkdir', outdir])
@@ -56,16 +74,28 @@ def run_pipeline(analysisdir, gprdirs, exclude, r2cutoff, outdir, matprefix):
     # Save path to analysis file
     analysisfile = analysis_file.analysis_file_wrapper(analysisdir)
 
+    # Change headers of gpr files so 635s and 647s become 488s and check the
+    #   quality of every scan in the same pass, before any jobs are submitted
+    logging.info('Changing 635/647 to 488 in headers for ' +
+            'masliner compatibility and checking scan quality')
+    scans = {}
+    for gprdir in gprdirs:
+        scans.update(masliner.to_488(gprdir))
+    qcreport = outdir + '/' + matprefix + '_qc_report.tsv'
+    gpr_qc.qc_wrapper(scans, exclude, qcreport, qcblock)
+    logging.info('Finished quality control\n')
+
     # Run masliner
     madjgprdirs = [gprdir + '/masliner' for gprdir in gprdirs]
     for i in range(len(gprdirs)):
-        masliner.masliner_wrapper(gprdirs[i], exclude, madjgprdirs[i], r2cutoff)
+        masliner.masliner_wrapper(gprdirs[i], exclude, madjgprdirs[i], r2cutoff,
+                perchamber, convert = False)
 
     # Perform spatial detrending
     normgprdirs = [gprdir + '/spatial_detrend' for gprdir in gprdirs]
     for i in range(len(gprdirs)):
         spatial_detrend.spatial_detrend_wrapper(madjgprdirs[i], analysisfile,
-                normgprdirs[i])
+                normgprdirs[i], chunksize)
 
     # Average probe intensities
     avggprdirs = [gprdir + '/average_probes' for gprdir in gprdirs]
@@ -75,6 +105,17 @@ def run_pipeline(analysisdir, gprdirs, exclude, r2cutoff, outdir, matprefix):
     # Create data matrices
     data_matrix.data_matrix_wrapper(avggprdirs, outdir, matprefix)
 
+    # Add the new columns to existing data matrices
+    if appendto is not None:
+        data_matrix.append_matrix_wrapper(outdir, matprefix, appendto)
+
+    # Compact intermediate files
+    if compact:
+        for gprdir in gprdirs:
+            logging.info('Compacting intermediate files in ' + gprdir)
+            freed = compact_storage.compact_gpr_dir(gprdir)
+            logging.info('Freed %.1f MB\n' % (freed / 1024 ** 2))
+
 
 # Create object for handling command line arguments
 # Setting add_help to False allows required arguments to be printed before
@@ -120,15 +161,122 @@ optionalargs.add_argument('-r', '--r2cutoff', default = 0.9, type = float,
         help = 'the minimum acceptable value for the R^2 values in ' +
         'the masliner output (default: 0.9)')
 
+# Add optional argument for number of chambers per spatial detrending job
+optionalargs.add_argument('-c', '--chunk_size', default = 1, type = int,
+        help = 'the number of chambers to spatially detrend in each batch ' +
+        'job; the jobs run at the same time (default: 1)')
+
+# Add optional argument for running masliner separately for each chamber
+optionalargs.add_argument('-s', '--split_chambers', action = 'store_true',
+        help = 'run a separate masliner job for every chamber instead of ' +
+        'grouping chambers that use the same scans; the jobs run at the ' +
+        'same time')
+
+# Add optional argument for adding the new columns to existing data matrices
+optionalargs.add_argument('--append_to', default = None,
+        help = 'the path and prefix of existing data matrices (e.g. ' +
+        '/path/to/STUDY for /path/to/STUDY_or.dat) to which to add the ' +
+        'columns of the new data matrices, without reprocessing the gpr ' +
+        'files they were made from (default: None)')
+
+# Add optional argument for compacting intermediate files after the run
+optionalargs.add_argument('--compact', action = 'store_true',
+        help = 'store intermediate gpr files as the columns that differ ' +
+        'from the raw gpr files, and hard link identical files, once the ' +
+        'data matrices have been made')
+
+# Add optional argument for stopping the run if quality control fails
+optionalargs.add_argument('-q', '--qc_block', action = 'store_true',
+        help = 'abort before submitting any jobs if quality control finds ' +
+        'saturated scans, dead blocks, many flagged spots or poor ' +
+        'gain-to-gain correlation in any gpr file')
+
+# Add optional argument for number of times to resubmit failed jobs
+optionalargs.add_argument('--retries', default = 2, type = int,
+        help = 'the number of times to resubmit a batch job that fails or ' +
+        'does not make its expected output files (default: 2)')
+
+# Add optional argument for running jobs on node-local scratch
+optionalargs.add_argument('--scratch', action = 'store_true',
+        help = 'copy the input files of each batch job to node-local ' +
+        'scratch ($TMPDIR), run the job there and copy its output back in ' +
+        'one transfer')
+
+# Add optional arguments for caching the output of jobs
+optionalargs.add_argument('--cache_dir', default = None,
+        help = 'a shared directory in which to cache the output of every ' +
+        'batch job, so that identical jobs in later runs are not ' +
+        'resubmitted (default: None)')
+optionalargs.add_argument('--cache_size', default = 100, type = float,
+        help = 'the largest the cache may grow in GB before the least ' +
+        'recently used output is removed (default: 100)')
+
+# Add optional argument for running jobs in a local worker pool
+optionalargs.add_argument('--local_workers', default = 0, type = int,
+        help = 'run batch jobs in a persistent pool of this many local ' +
+        'workers instead of submitting them with qsub; the pool is started ' +
+        'if it is not already running and is reused by later runs ' +
+        '(default: 0, use qsub)')
+
+# Add optional argument for turning off sized resource requests
+optionalargs.add_argument('--no_sizing', action = 'store_true',
+        help = 'submit jobs with the scheduler\'s default resources instead ' +
+        'of wall time and memory requests sized to their input files')
+
+# Add optional argument for printing a plan instead of running the pipeline
+optionalargs.add_argument('--plan', action = 'store_true',
+        help = 'print every file and job the pipeline would make, with ' +
+        'estimated runtime, peak memory and disk usage, and exit without ' +
+        'running anything')
+
 # Add optional help argument back in
 optionalargs.add_argument('-h', '--help', action = 'help',
         default = argparse.SUPPRESS, help = 'show this help message and exit')
 
-# Parse out arguments
-args = parser.parse_args()
+# Only parse arguments and run when called as a script, so that other
+#   scripts (e.g. benchmark_pipeline.py) can import run_pipeline
+if __name__ == '__main__':
+    # Parse out arguments
+    args = parser.parse_args()
+
+    # Make sure chunk size is positive
+    if args.chunk_size < 1:
+        parser.error('argument -c/--chunk_size: must be at least 1')
+
+    # Make sure number of retries is not negative
+    if args.retries < 0:
+        parser.error('argument --retries: must be at least 0')
+
+    # Make sure number of local workers is not negative
+    if args.local_workers < 0:
+        parser.error('argument --local_workers: must be at least 0')
+
+    # Check every input and output before loading the stage modules or making
+    #   the logfile, and report all the problems at once
+    problems = preflight.preflight(args.analysis_dir, args.gpr_dirs,
+            args.exclude, args.output_dir, args.prefix, args.append_to)
+    if problems:
+        parser.error('found ' + str(len(problems)) + ' problem(s) before ' +
+                'starting:\n  ' + '\n  '.join(problems))
 
-# Call pipeline wrapper function on arguments
-run_pipeline(args.analysis_dir, args.gpr_dirs, args.exclude, args.r2cutoff,
-        args.output_dir, args.prefix)
+    # Apply settings for submitting batch jobs
+    import submit_job
+    submit_job.configure(sizing = not args.no_sizing, retries = args.retries,
+            scratch = args.scratch, cache_dir = args.cache_dir,
+            cache_size = args.cache_size * 1024 ** 3)
+    if args.local_workers > 0:
+        submit_job.configure(backend = 'local', workers = args.local_workers)
 
+    # Print the plan for the pipeline if requested
+    if args.plan:
+        import plan_pipeline
+        print(plan_pipeline.format_plan(plan_pipeline.plan_pipeline(
+            args.analysis_dir, args.gpr_dirs, args.exclude, args.output_dir,
+            args.prefix, args.chunk_size, args.split_chambers)))
 
+    # Otherwise call pipeline wrapper function on arguments
+    else:
+        run_pipeline(args.analysis_dir, args.gpr_dirs, args.exclude,
+                args.r2cutoff, args.output_dir, args.prefix, args.chunk_size,
+                args.split_chambers, args.qc_block, args.compact,
+                args.append_to)
@@ -0,0 +1,83 @@
+import math
+import job_history
+
+# The most memory a single slot (core) can be given on a compute node
+MEMORY_PER_SLOT = 4 * 1024 ** 3
+
+# Margins added on top of the learned rates so jobs are not killed for
+#   going slightly over their requests
+WALLTIME_FACTOR = 2.0
+MEMORY_FACTOR = 1.5
+
+# Smallest requests ever made, so short jobs are not killed by noise
+MIN_WALLTIME = 15 * 60
+MIN_MEMORY = 1024 ** 3
+
+
+def request_resources(stage, inputbytes, attempt = 0):
+    """Sizes the resource request for a job from the size of its input
+
+    Inputs:
+        stage: the pipeline stage the job belongs to
+        inputbytes: the total size of the job's input files in bytes
+        attempt: the number of times the job has already failed
+            (default: 0)
+            Every failure doubles the request, in case the job was killed
+            for going over it
+
+    Output:
+        a dictionary with the wall time ('walltime', in seconds), the number
+            of slots ('slots') and the memory per slot ('memory', in bytes)
+            to request for the job
+            NOTE: the wall time and memory include the slack of the slowest
+                and largest jobs recorded for the stage, so requests cover
+                the worst case seen
+            NOTE: the wall time is None (so the scheduler's default is used)
+                until a job of the stage has been recorded
+    """
+    rates = job_history.learned_rates(stage)
+    scale = 2 ** attempt
+
+    # Request enough wall time for the slowest job seen so far
+    walltime = None
+    if rates['runtime_jobs'] > 0:
+        walltime = scale * max(MIN_WALLTIME, WALLTIME_FACTOR *
+                (rates['fixed_runtime'] + rates['slack_runtime'] +
+                    rates['runtime'] * inputbytes / 1024 ** 2))
+        walltime = int(math.ceil(walltime))
+
+    # Request enough memory for the largest peak seen so far, spread over
+    #   as many slots as necessary
+    memory = scale * max(MIN_MEMORY, MEMORY_FACTOR *
+            (rates['fixed_memory'] + rates['slack_memory'] +
+                rates['memory'] * inputbytes))
+    slots = math.ceil(memory / MEMORY_PER_SLOT)
+
+    return({'walltime': walltime, 'slots': slots,
+        'memory': int(math.ceil(memory / slots))})
+
+
+def format_walltime(seconds):
+    """Formats a wall time as HH:MM:SS for the scheduler"""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return('%02d:%02d:%02d' % (hours, minutes, seconds))
+
+
+def qsub_flags(request):
+    """Converts a resource request to qsub flags
+
+    Inputs:
+        request: a dictionary returned by request_resources
+
+    Output:
+        a list of the qsub flags making the request
+    """
+    flags = []
+    if request['walltime'] is not None:
+        flags += ['-l', 'h_rt=' + format_walltime(request['walltime'])]
+    flags += ['-l', 'mem_per_core=' +
+            str(math.ceil(request['memory'] / 1024 ** 3)) + 'G']
+    if request['slots'] > 1:
+        flags += ['-pe', 'omp', str(request['slots'])]
+    return(flags)
@@ -0,0 +1,325 @@
+import subprocess
+import io
+import glob
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+import pipeline_files
+
+# Text files smaller than this are checked for lines naming other files
+#   (list files and experiment descriptions)
+MAX_LIST_SIZE = 1024 ** 2
+
+# Permissions given to cache entries, so that every user sharing the cache
+#   can read them and remove them when they are least recently used
+DIR_MODE = 0o775
+FILE_MODE = 0o664
+
+# Version of the layout of cache entries
+#   Entries with any other version are treated as missing, since they may
+#   not hold every file their job made
+ENTRY_VERSION = 2
+
+
+def file_key(path, cwd, filekey = None):
+    """Describes a file by its name and contents, but not its location
+
+    Inputs:
+        path: the path to the file
+        cwd: the directory relative paths in the file are relative to
+        filekey: the function used to describe the files named in list files
+            (default: file_key)
+
+    Output:
+        a string that is the same for any copy of the file with the same
+            name and contents, wherever it is saved (or None if there is no
+            such file)
+        NOTE: in list files and experiment descriptions, lines naming other
+            files are replaced with those files' keys, so lists pointing at
+            identical files in different directories get the same key
+    """
+    if not subprocess.os.path.isfile(path):
+        return(None)
+    name = subprocess.os.path.basename(path)
+    if path.endswith('.gpr') or \
+            subprocess.os.path.getsize(path) > MAX_LIST_SIZE:
+        return(name + ':' + pipeline_files.content_hash(path))
+
+    with open(path, errors = 'replace') as f:
+        return(text_key(name, f.read(), cwd, filekey))
+
+
+def text_key(name, text, cwd, filekey = None):
+    """Describes a list file by its name and contents (see file_key)
+
+    Inputs:
+        name: the name of the file
+        text: the contents of the file
+        cwd: the directory relative paths in the file are relative to
+        filekey: the function used to describe the files named in the file
+            (default: file_key)
+
+    Output:
+        a string that is the same for any list with the same name that
+            names files with the same names and contents
+    """
+    filekey = filekey or file_key
+    lines = []
+    for l in io.StringIO(text):
+        key = filekey(subprocess.os.path.join(cwd, l.strip()), cwd) \
+                if l.strip() else None
+        lines.append(l if key is None else key + '\n')
+    return(name + ':' + hashlib.sha256(''.join(lines).encode()).hexdigest())
+
+
+def job_key(stage, command, cwd, inputs, filekey = None):
+    """Computes the cache key of a job
+
+    Inputs:
+        stage: the pipeline stage the job belongs to
+        command: the command the job runs
+        cwd: the directory the job runs in
+        inputs: a list of paths to the job's input files
+        filekey: the function used to describe each file (default: file_key)
+            This lets the key of a job be worked out before its input files
+            have been made (see plan_pipeline)
+
+    Output:
+        the hexadecimal cache key, which depends only on the stage, the
+            command's options, the perl script and the names and contents of
+            the files the job reads, not on where they are saved or on where
+            the job's output is written (or None if an input file is missing)
+    """
+    filekey = filekey or file_key
+    parts = [stage]
+    for token in command.split():
+        key = filekey(subprocess.os.path.join(cwd, token), cwd)
+        if key is not None:
+            parts.append(key)
+        elif '/' in token and not token.endswith('.pl'):
+            # Output paths (e.g. the data matrix) do not change the result
+            parts.append('<output>')
+        else:
+            parts.append(token)
+    for path in inputs:
+        key = filekey(subprocess.os.path.join(cwd, path), cwd)
+        if key is None:
+            return(None)
+        parts.append(key)
+    return(hashlib.sha256('\n'.join(parts).encode()).hexdigest())
+
+
+def has_glob(pattern):
+    """Checks whether a path is a glob pattern rather than a single file"""
+    return(any(c in pattern for c in '*?['))
+
+
+def entry_size(entrydir):
+    """Adds up the sizes of the files in a cache entry"""
+    return(sum(subprocess.os.path.getsize(subprocess.os.path.join(d, name))
+        for d, subdirs, names in subprocess.os.walk(entrydir)
+        for name in names))
+
+
+def share_entry(entrydir):
+    """Makes a cache entry readable and removable by every user of the cache
+
+    Inputs:
+        entrydir: the path to the cache entry
+    """
+    subprocess.os.chmod(entrydir, DIR_MODE)
+    for d, subdirs, names in subprocess.os.walk(entrydir):
+        for name in subdirs:
+            subprocess.os.chmod(subprocess.os.path.join(d, name), DIR_MODE)
+        for name in names:
+            subprocess.os.chmod(subprocess.os.path.join(d, name), FILE_MODE)
+
+
+def read_entry(cachedir, key, expected):
+    """Reads the manifest of a cache entry
+
+    Inputs:
+        cachedir: the path to the cache directory
+        key: the job's cache key
+        expected: a list of paths (or glob patterns) of the files the job
+            should make
+
+    Output:
+        the manifest of the entry, or None if there is no entry for the job
+            or it has a different layout
+        NOTE: an entry that cannot be read raises OSError, ValueError or
+            KeyError
+    """
+    manifestfile = cachedir + '/' + key + '/manifest.json'
+    if not subprocess.os.path.exists(manifestfile):
+        return(None)
+    with open(manifestfile) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != ENTRY_VERSION or \
+            len(manifest['expected']) != len(expected):
+        return(None)
+    return(manifest)
+
+
+def expected_files(entrydir, manifest, expected):
+    """Pairs the expected files saved in a cache entry with where they go
+
+    Inputs:
+        entrydir: the path to the cache entry
+        manifest: the manifest of the entry
+        expected: a list of paths (or glob patterns) of the files the job
+            should make
+
+    Output:
+        a list of (saved file, target path) pairs, one for every file
+            matching an expected pattern
+        NOTE: single files (e.g. the data matrix) are renamed to the new
+            expected name
+    """
+    files = []
+    for i, pattern in enumerate(expected):
+        for name in manifest['expected'][i]:
+            if has_glob(pattern):
+                target = subprocess.os.path.dirname(pattern) + '/' + name
+            else:
+                target = pattern
+            files.append((entrydir + '/' + str(i) + '/' + name, target))
+    return(files)
+
+
+def fetch(cachedir, key, cwd, expected):
+    """Copies a job's cached output files to where the job would make them
+
+    Inputs:
+        cachedir: the path to the cache directory
+        key: the job's cache key
+        cwd: the directory the job runs in
+        expected: a list of paths (or glob patterns) of the files the job
+            should make
+
+    Output:
+        True if the job's output was found in the cache, otherwise False
+        NOTE: an entry that cannot be read (e.g. because another user's run
+            removed it while it was being copied) is treated as a miss
+    """
+    entrydir = cachedir + '/' + key
+    manifestfile = entrydir + '/manifest.json'
+    try:
+        manifest = read_entry(cachedir, key, expected)
+        if manifest is None:
+            return(False)
+
+        # Copy the files matching each expected pattern
+        for source, target in expected_files(entrydir, manifest, expected):
+            shutil.copy2(source, target)
+
+        # Copy every other file the job made (e.g. the job's output with the
+        #   R^2 values or the summary of the normalization)
+        for name in manifest['other']:
+            if subprocess.os.path.isdir(entrydir + '/other/' + name):
+                shutil.copytree(entrydir + '/other/' + name, cwd + '/' + name,
+                        dirs_exist_ok = True)
+            else:
+                shutil.copy2(entrydir + '/other/' + name, cwd + '/' + name)
+
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning('Could not use cache entry ' + entrydir + ': ' +
+                str(e))
+        return(False)
+
+    # Mark the entry as recently used (only its owner may be able to)
+    try:
+        subprocess.os.utime(manifestfile)
+    except OSError:
+        pass
+    return(True)
+
+
+def store(cachedir, key, cwd, expected, other, maxbytes):
+    """Saves a job's output files in the cache
+
+    Inputs:
+        cachedir: the path to the cache directory
+        key: the job's cache key
+        cwd: the directory the job ran in
+        expected: a list of paths (or glob patterns) of the files the job made
+        other: a list of the names of every new file (or directory) the job
+            made in cwd
+            NOTE: names that match expected are only saved once
+        maxbytes: the largest the cache may grow before the least recently
+            used entries are removed
+    """
+    entrydir = cachedir + '/' + key
+    if subprocess.os.path.exists(entrydir):
+        return
+
+    # Build the entry in a temporary directory so that other runs never see
+    #   a partial entry
+    subprocess.os.makedirs(cachedir, exist_ok = True)
+    tmpdir = tempfile.mkdtemp(prefix = '.tmp_', dir = cachedir)
+    manifest = {'version': ENTRY_VERSION, 'expected': [], 'other': []}
+    saved = set()
+    for i, pattern in enumerate(expected):
+        subprocess.os.mkdir(tmpdir + '/' + str(i))
+        names = []
+        for filename in sorted(glob.glob(pattern)):
+            names.append(subprocess.os.path.basename(filename))
+            shutil.copy2(filename, tmpdir + '/' + str(i) + '/' + names[-1])
+            saved.add(subprocess.os.path.abspath(filename))
+        manifest['expected'].append(names)
+    subprocess.os.mkdir(tmpdir + '/other')
+    for name in other:
+        path = subprocess.os.path.abspath(cwd + '/' + name)
+        if path in saved:
+            continue
+        if subprocess.os.path.isdir(path):
+            shutil.copytree(path, tmpdir + '/other/' + name)
+        elif subprocess.os.path.isfile(path):
+            shutil.copy2(path, tmpdir + '/other/' + name)
+        else:
+            continue
+        manifest['other'].append(name)
+    with open(tmpdir + '/manifest.json', 'w') as f:
+        json.dump(manifest, f, indent = 1)
+
+    # mkdtemp makes the entry private to this user, so open it up before it
+    #   becomes visible to other runs
+    share_entry(tmpdir)
+
+    # Another run may have stored the same entry in the meantime
+    try:
+        subprocess.os.rename(tmpdir, entrydir)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors = True)
+
+    evict(cachedir, maxbytes)
+
+
+def evict(cachedir, maxbytes):
+    """Removes the least recently used cache entries until the cache fits
+
+    Inputs:
+        cachedir: the path to the cache directory
+        maxbytes: the largest the cache may be in bytes
+    """
+    # Find every complete entry with its size and when it was last used
+    #   (skipping any that another run removes in the meantime)
+    entries = []
+    for entrydir in glob.glob(cachedir + '/*/manifest.json'):
+        entrydir = subprocess.os.path.dirname(entrydir)
+        try:
+            entries.append((subprocess.os.path.getmtime(entrydir +
+                '/manifest.json'), entry_size(entrydir), entrydir))
+        except OSError:
+            continue
+
+    # Remove the oldest entries first
+    total = sum(size for used, size, entrydir in entries)
+    for used, size, entrydir in sorted(entries):
+        if total <= maxbytes:
+            break
+        logging.info('Removing least recently used cache entry ' + entrydir)
+        shutil.rmtree(entrydir, ignore_errors = True)
+        total -= size
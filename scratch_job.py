@@ -0,0 +1,163 @@
+import subprocess
+import sys
+import json
+import shutil
+import tempfile
+import pipeline_files
+
+# Options naming the list files and experiment descriptions a command reads
+LIST_FLAGS = ['-i', '-l']
+
+# Option naming the output file a command writes
+OUTPUT_FLAG = '-o'
+
+
+def write_scratch_spec(specfile, command, cwd, inputs):
+    """Writes the description of a job to run on node-local scratch
+
+    Inputs:
+        specfile: the path to the file to write
+        command: the command the job runs
+        cwd: the directory the job would otherwise run in, to which its
+            output files are copied back
+        inputs: a list of paths to the job's input files
+            NOTE: any other existing files named in the command (except the
+                perl scripts themselves) are copied to scratch as well
+
+    Output:
+        the command that runs the job on scratch
+    """
+    # Add the list files, experiment description and analysis file
+    stage = list(inputs)
+    for token in command.split():
+        if token.endswith('.pl') or token in stage:
+            continue
+        if subprocess.os.path.isfile(token):
+            stage.append(token)
+
+    # Write the description of the job
+    with open(specfile, 'w') as f:
+        json.dump({'command': command, 'cwd': cwd, 'inputs': stage}, f,
+                indent = 1)
+
+    # Run this script on the compute node with the same Python
+    return(sys.executable + ' ' + subprocess.os.path.abspath(__file__) + ' ' +
+            specfile)
+
+
+def stage_in(spec, scratchdir):
+    """Copies a job's input files to scratch and points the job at them
+
+    Inputs:
+        spec: the description of the job written by write_scratch_spec
+        scratchdir: the scratch directory in which to run the job
+
+    Output:
+        the command to run in scratchdir
+        the names of the files copied to scratchdir
+    """
+    cwd = spec['cwd']
+    staged = {}
+    for path in spec['inputs']:
+        # Relative paths are relative to the directory the job would run in
+        fullpath = subprocess.os.path.join(cwd, path)
+        name = subprocess.os.path.basename(path)
+
+        # Leave files on the shared file system if their names would clash
+        if name in staged.values():
+            continue
+        shutil.copy(fullpath, scratchdir + '/' + name)
+        staged[path] = name
+        staged[fullpath] = name
+
+    # Point the copied list files and experiment descriptions at the copied
+    #   gpr files, keeping every other byte (and line ending) as it is
+    tokens = spec['command'].split()
+    for flag, path in zip(tokens, tokens[1:]):
+        if flag not in LIST_FLAGS or path not in staged:
+            continue
+        listfile = scratchdir + '/' + staged[path]
+        with open(listfile, newline = '',
+                encoding = pipeline_files.ENCODING) as f:
+            contents = f.read()
+        lines = []
+        for l in contents.split('\n'):
+            listed = l.rstrip('\r')
+            lines.append(staged.get(listed, listed) + l[len(listed):])
+        rewritten = '\n'.join(lines)
+        if rewritten != contents:
+            with open(listfile, 'w', newline = '',
+                    encoding = pipeline_files.ENCODING) as f:
+                f.write(rewritten)
+
+    # Write an output file named in the command to scratch if it belongs in
+    #   the directory the job would run in, so it is copied back with the
+    #   rest of the output (e.g. the data matrix)
+    for i in range(len(tokens) - 1):
+        if tokens[i] != OUTPUT_FLAG or '/' not in tokens[i + 1]:
+            continue
+        target = subprocess.os.path.normpath(subprocess.os.path.join(cwd,
+            tokens[i + 1]))
+        name = subprocess.os.path.basename(target)
+        if subprocess.os.path.dirname(target) == \
+                subprocess.os.path.normpath(cwd) and \
+                name not in staged.values():
+            tokens[i + 1] = name
+
+    # Point the command at the copied files
+    command = ' '.join([staged.get(token, token) for token in tokens])
+
+    return(command, set(staged.values()))
+
+
+def run_command(command, cwd):
+    """Runs a command in a shell and returns its exit status"""
+    return(subprocess.run(command, shell = True, cwd = cwd).returncode)
+
+
+def run_scratch_job(specfile, run = run_command):
+    """Runs a job on node-local scratch and copies its output back
+
+    Inputs:
+        specfile: the path to the description of the job
+        run: the function that runs the job's command in the scratch
+            directory and returns its exit status (default: run_command)
+
+    Output:
+        the exit status of the job
+    """
+    with open(specfile) as f:
+        spec = json.load(f)
+
+    # Make a scratch directory on the node ($TMPDIR is set by the scheduler)
+    scratchdir = tempfile.mkdtemp(prefix = 'auto_PBM_prepro_')
+    try:
+        # Copy inputs to scratch and run the job there
+        command, staged = stage_in(spec, scratchdir)
+        exitstatus = run(command, scratchdir)
+
+        # Copy every new file (or directory) back in a single transfer
+        # The job has failed if its output could not all be copied back,
+        #   even if the command itself succeeded
+        outputs = [scratchdir + '/' + name
+                for name in sorted(subprocess.os.listdir(scratchdir))
+                if name not in staged]
+        if outputs:
+            copystatus = subprocess.run(['cp', '-pr'] + outputs +
+                    [spec['cwd']]).returncode
+            if copystatus != 0:
+                sys.stderr.write('Could not copy the output of the job ' +
+                        'back to ' + spec['cwd'] + ' (cp exit status ' +
+                        str(copystatus) + ')\n')
+                if exitstatus == 0:
+                    exitstatus = copystatus
+
+    # Always clean up scratch, even if the job fails
+    finally:
+        shutil.rmtree(scratchdir, ignore_errors = True)
+
+    return(exitstatus)
+
+
+if __name__ == '__main__':
+    sys.exit(run_scratch_job(sys.argv[1]))
@@ -0,0 +1,307 @@
+import subprocess
+import sys
+import json
+import time
+import random
+import fcntl
+import shlex
+import scratch_job
+import pipeline_files
+
+# The directory in which the simulator keeps its configuration and records
+STATE_DIR = subprocess.os.environ.get('SIM_SCHEDULER_DIR', '.sim_scheduler')
+
+# Default configuration of the simulated cluster
+#   time_scale: real seconds slept per simulated second
+#   queue_wait: mean simulated seconds a job waits in the queue
+#   runtime: median simulated seconds per input file for each perl script
+#   runtime_sigma: spread of the (lognormal) runtime distribution
+#   failure_rate: probability that a job fails without making any output
+#   seed: seed for the random number generator (None for a random seed)
+DEFAULT_CONFIG = {'time_scale': 0.01, 'queue_wait': 30, 'runtime': {
+    'masliner_list.pl': 40, 'gpr_file_process_conc_series.pl': 120,
+    'average_replicate_rc_custom_probes.pl': 15,
+    'control_sequence_process.pl': 5}, 'runtime_sigma': 0.3,
+    'failure_rate': 0.0, 'seed': None}
+
+
+def load_config():
+    """Loads the configuration of the simulated cluster
+
+    Output:
+        a dictionary with the keys of DEFAULT_CONFIG
+    """
+    config = dict(DEFAULT_CONFIG)
+    if subprocess.os.path.exists(STATE_DIR + '/config.json'):
+        with open(STATE_DIR + '/config.json') as f:
+            config.update(json.load(f))
+    return(config)
+
+
+def next_job_id():
+    """Allocates a new job ID, even if several qsubs run at the same time
+
+    Output:
+        the new job ID
+    """
+    subprocess.os.makedirs(STATE_DIR, exist_ok = True)
+    with open(STATE_DIR + '/next_id', 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        jobid = int(f.read() or 1)
+        f.seek(0)
+        f.truncate()
+        f.write(str(jobid + 1))
+    return(jobid)
+
+
+def record(job):
+    """Appends the record of a job to the simulator's job log
+
+    Inputs:
+        job: a dictionary describing the job
+    """
+    with open(STATE_DIR + '/jobs.jsonl', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(job) + '\n')
+
+
+def read_records():
+    """Reads the records of every job (the latest record of each job wins)
+
+    Output:
+        a dictionary mapping job IDs to job records
+    """
+    jobs = {}
+    if subprocess.os.path.exists(STATE_DIR + '/jobs.jsonl'):
+        with open(STATE_DIR + '/jobs.jsonl') as f:
+            for l in f:
+                job = json.loads(l)
+                jobs[job['id']] = job
+    return(jobs)
+
+
+def option(tokens, flag):
+    """Finds the value following a flag in a list of command tokens"""
+    if flag in tokens and tokens.index(flag) + 1 < len(tokens):
+        return(tokens[tokens.index(flag) + 1])
+    return(None)
+
+
+def read_list(listfile, cwd):
+    """Reads the file paths in a list file, relative to cwd"""
+    with open(subprocess.os.path.join(cwd, listfile)) as f:
+        return([subprocess.os.path.join(cwd, l.strip()) for l in f
+            if l.strip()])
+
+
+def read_intensities(filename):
+    """Reads the foreground median of every probe in a gpr file
+
+    Inputs:
+        filename: the path to the gpr file
+
+    Output:
+        a dictionary mapping probe names to intensities, in file order
+    """
+    with open(filename, newline = '',
+            encoding = pipeline_files.ENCODING) as f:
+        header, rows = pipeline_files.split_gpr(iter(f))
+        columns = pipeline_files.gpr_columns(header)
+        name = columns.index('Name')
+        median = [i for i, column in enumerate(columns)
+                if pipeline_files.MEDIAN_COLUMN.match(column)][0]
+        return({fields[name]: fields[median] for fields in
+            (l.rstrip('\r\n').split('\t') for l in rows)})
+
+
+def emulate(command, cwd):
+    """Makes the output files that a pipeline command would make
+
+    Inputs:
+        command: the command the job runs
+        cwd: the directory the job runs in
+
+    Output:
+        the name of the perl script the command runs (or None)
+        the number of input files the command reads
+        the text the command prints
+        the exit status of the command
+    """
+    tokens = shlex.split(command)
+
+    # Jobs run on scratch go through the real staging and copying back, and
+    #   only the command they run in the scratch directory is emulated
+    if len(tokens) > 1 and tokens[1].endswith('scratch_job.py'):
+        result = []
+        def run(scratchcommand, scratchdir):
+            result.extend(emulate(scratchcommand, scratchdir))
+            return(result[3])
+        exitstatus = scratch_job.run_scratch_job(tokens[2], run)
+        return(tuple(result[:3]) + (exitstatus,))
+
+    script = subprocess.os.path.basename(tokens[1]) if len(tokens) > 1 \
+            else None
+    output = ''
+
+    # Masliner writes an adjusted copy of every scan and the R^2 values
+    if script == 'masliner_list.pl':
+        inputs = [filename for filename in read_list(option(tokens, '-i'),
+            cwd) if filename.endswith('.gpr')]
+        for filename in inputs:
+            name = subprocess.os.path.basename(filename)
+            subprocess.run(['cp', filename, cwd + '/' +
+                pipeline_files.ADJUSTED_PREFIX + name])
+            output += 'Fit for ' + name + ': R^2=0.99 slope=1.0\n'
+
+    # Spatial detrending writes a normalized copy of every listed file
+    elif script == 'gpr_file_process_conc_series.pl':
+        inputs = read_list(option(tokens, '-i'), cwd)
+        for filename in inputs:
+            subprocess.run(['cp', filename, cwd + '/' +
+                pipeline_files.NORMALIZED_PREFIX +
+                subprocess.os.path.basename(filename)])
+
+    # Probe averaging writes one or two averaged copies of every listed file
+    elif script == 'average_replicate_rc_custom_probes.pl':
+        inputs = read_list(option(tokens, '-l'), cwd)
+        for filename in inputs:
+            for prefix in pipeline_files.OUTPUT_PREFIXES[option(tokens,
+                '-avg')]:
+                subprocess.run(['cp', filename, cwd + '/' + prefix +
+                    subprocess.os.path.basename(filename)])
+
+    # The data matrix has a row for every probe and a column for every listed
+    #   file
+    elif script == 'control_sequence_process.pl':
+        inputs = read_list(option(tokens, '-l'), cwd)
+        columns = [read_intensities(filename) for filename in inputs]
+        with open(subprocess.os.path.join(cwd, option(tokens, '-o')),
+                'w') as f:
+            f.write('\t'.join(['ID', 'Sequence'] +
+                [subprocess.os.path.basename(filename)
+                    for filename in inputs]) + '\n')
+            for probe in (columns[0] if columns else []):
+                f.write('\t'.join([probe, 'ACGT'] + [column.get(probe, 'NA')
+                    for column in columns]) + '\n')
+
+    # Anything else is run for real
+    else:
+        inputs = []
+        process = subprocess.run(command, shell = True, cwd = cwd,
+                stdout = subprocess.PIPE, universal_newlines = True)
+        return(script, 0, process.stdout, process.returncode)
+
+    return(script, len(inputs), output, 0)
+
+
+def qsub(args):
+    """Simulates qsub -sync y: waits in the queue, runs the job and reports
+
+    Inputs:
+        args: the command line arguments given to qsub
+
+    Output:
+        the exit status of the job
+    """
+    config = load_config()
+
+    # Separate the flags from the command
+    name = 'job'
+    i = 0
+    while i < len(args) - 1:
+        if args[i] == '-N':
+            name = args[i + 1]
+        if args[i] in ('-cwd', '-V'):
+            i += 1
+        elif args[i] == '-pe':
+            i += 3
+        else:
+            i += 2
+    command = ' '.join(args[i:])
+    cwd = subprocess.os.getcwd()
+
+    jobid = next_job_id()
+
+    # Give every job its own random numbers, repeatable if a seed is set
+    rng = random.Random(None if config['seed'] is None else
+            str(config['seed']) + '_' + str(jobid))
+
+    print('Your job ' + str(jobid) + ' ("' + name + '") has been submitted')
+    sys.stdout.flush()
+    job = {'id': jobid, 'name': name, 'cwd': cwd, 'command': command,
+            'submit': time.time(), 'state': 'qw'}
+    record(job)
+
+    # Wait in the queue
+    wait = rng.expovariate(1 / config['queue_wait']) \
+            if config['queue_wait'] > 0 else 0
+    time.sleep(wait * config['time_scale'])
+    job.update({'start': time.time(), 'state': 'r', 'wait': wait})
+    record(job)
+
+    # Fail without making any output, as if the node had been lost
+    failed = rng.random() < config['failure_rate']
+    script = None
+    ninputs = 1
+    output = ''
+    exitstatus = 1
+    started = time.time()
+    if not failed:
+        script, ninputs, output, exitstatus = emulate(command, cwd)
+
+    # Run for a random time that grows with the number of input files
+    median = config['runtime'].get(script, 10) * max(ninputs, 1)
+    runtime = rng.lognormvariate(0, config['runtime_sigma']) * median
+    time.sleep(runtime * config['time_scale'])
+
+    # The files really copied while emulating the job (e.g. to and from
+    #   scratch) took real time, which is added unscaled
+    runtime += time.time() - started - runtime * config['time_scale']
+
+    # Write the job's output and error files as the scheduler would
+    with open(cwd + '/' + name + '.o' + str(jobid), 'w') as f:
+        f.write(output)
+    with open(cwd + '/' + name + '.e' + str(jobid), 'w') as f:
+        f.write('Simulated node failure\n' if failed else '')
+
+    job.update({'end': time.time(), 'state': 'done', 'script': script,
+        'exit_status': exitstatus, 'runtime': runtime})
+    record(job)
+    print('Job ' + str(jobid) + ' exited with exit code ' + str(exitstatus) +
+            '.')
+    return(exitstatus)
+
+
+def qstat():
+    """Simulates qstat: lists the jobs that have not finished"""
+    jobs = [job for job in read_records().values() if job['state'] != 'done']
+    if jobs:
+        print('job-ID  name            state')
+        for job in sorted(jobs, key = lambda x: x['id']):
+            print('%-7d %-15s %s' % (job['id'], job['name'][:15],
+                job['state']))
+    return(0)
+
+
+def qacct(args):
+    """Simulates qacct -j: reports the simulated wall clock time of a job"""
+    job = read_records().get(int(option(args, '-j') or 0))
+    if job is None or job['state'] != 'done':
+        print('error: job id ' + str(option(args, '-j')) + ' not found')
+        return(1)
+    print('jobname      ' + job['name'])
+    print('jobnumber    ' + str(job['id']))
+    print('ru_wallclock ' + '%.0fs' % job['runtime'])
+    print('maxvmem      100.000M')
+    print('exit_status  ' + str(job['exit_status']))
+    return(0)
+
+
+if __name__ == '__main__':
+    if sys.argv[1] == 'qsub':
+        sys.exit(qsub(sys.argv[2:]))
+    elif sys.argv[1] == 'qstat':
+        sys.exit(qstat())
+    elif sys.argv[1] == 'qacct':
+        sys.exit(qacct(sys.argv[2:]))
@@ -2,30 +2,42 @@ import subprocess
 import glob
 import logging
 from natsort import natsorted
+import submit_job
+import job_history
 from prevent_overwrite import prevent_overwrite
 
-def make_madj_gpr_list(madjgprdir, madjgprlist):
-    """Makes a list of all masliner adjusted gpr files at highest scan intensity
+def find_highest_intensity_scans(madjgprdir):
+    """Finds the masliner adjusted gpr file at highest scan intensity for
+    each chamber
 
     Inputs:
         madjgprdir: the directory where the masliner adjusted gpr files are
             NOTE: assumes that all files of the form "madj*.gpr" in this
                 directory should be used
-        madjgprlist: the path to the output list file
+
+    Output:
+        a list of the highest intensity filenames (without the path),
+            sorted by chamber
     """
-    # Do not overwrite madjgprlist if it already exists
-    prevent_overwrite(madjgprlist)
+    # Get a list of all masliner adjusted gpr files
+    files = [subprocess.os.path.basename(filename)
+            for filename in glob.glob(madjgprdir + '/madj*.gpr')]
 
-    # Navigate to madjgprdir after saving current working directory
-    cwd = subprocess.os.getcwd()
-    subprocess.os.chdir(madjgprdir)
+    # Return highest intensity files
+    return(highest_intensity_scans(files))
 
-    # Get a list of all masliner adjusted gpr files and make sure they're sorted
-    files = glob.glob("madj*.gpr")
-    files = natsorted(files)
 
-    # Navigate back to original directory
-    subprocess.os.chdir(cwd)
+def highest_intensity_scans(files):
+    """Picks the highest intensity scan of each chamber from a list of scans
+
+    Inputs:
+        files: a list of masliner adjusted gpr filenames (without the path)
+
+    Output:
+        a list of the highest intensity filenames, sorted by chamber
+    """
+    # Make sure the files are sorted
+    files = natsorted(files)
 
     # Store the possible file endings (chambers) in a set to get a unique list
     chamberset = set(filename[-7:] for filename in files)
@@ -44,12 +56,131 @@ def make_madj_gpr_list(madjgprdir, madjgprlist):
         # The files are sorted, so the last one should be the highest intensity
         highintfiles.append(matches[-1])
 
+    # Return highest intensity files
+    return(highintfiles)
+
+
+def shard_chambers(highintfiles, chunksize):
+    """Splits the highest intensity scans into shards of a few chambers each
+
+    Inputs:
+        highintfiles: a list of the highest intensity filenames, sorted by
+            chamber
+        chunksize: the number of chambers to put in each shard
+
+    Output:
+        a dictionary mapping the chamber numbers of each shard (e.g. '12')
+            to the list of filenames in that shard
+    """
+    shards = {}
+    for i in range(0, len(highintfiles), chunksize):
+        shard = highintfiles[i:i + chunksize]
+        shards[''.join([filename[-7] for filename in shard])] = shard
+    return(shards)
+
+
+def make_madj_gpr_list(madjgprlist, highintfiles):
+    """Makes a list of masliner adjusted gpr files at highest scan intensity
+
+    Inputs:
+        madjgprlist: the path to the output list file
+        highintfiles: a list of the highest intensity filenames to write
+    """
+    # Do not overwrite madjgprlist if it already exists
+    prevent_overwrite(madjgprlist)
+
     # Write list to madjgprlist
     with open(madjgprlist, 'w') as f:
         for filename in highintfiles:
             f.write(filename + '\n')
 
 
+def make_shard_dir(madjgprdir, chambernums, highintfiles):
+    """Makes a directory in which to run spatial detrending on one shard
+
+    Inputs:
+        madjgprdir: the directory where the masliner adjusted gpr files are
+        chambernums: the chamber numbers of the shard (e.g. '12')
+        highintfiles: the list of filenames in the shard
+
+    Output:
+        the path to the shard directory
+        NOTE: the shard directory contains links to the files in the shard
+            so that each job can run in its own directory without copying
+            any gpr files and without the outputs of different jobs mixing
+    """
+    # Do not overwrite sharddir if it already exists
+    sharddir = madjgprdir + '/shard_' + chambernums
+    prevent_overwrite(sharddir)
+
+    # Make sharddir and link the files in the shard into it
+    subprocess.run(['mkdir', sharddir])
+    for filename in highintfiles:
+        subprocess.os.symlink('../' + filename, sharddir + '/' + filename)
+
+    # Return path to shard directory
+    return(sharddir)
+
+
+def concatenate_shard_files(filenames, outfile):
+    """Concatenates files with the same name made by several shards
+
+    Inputs:
+        filenames: a list of the paths to the files, in shard order
+        outfile: the path to the merged file
+            NOTE: the leading lines that a file shares with the first file
+                (e.g. a column header) are only written once
+    """
+    with open(filenames[0], 'rb') as f:
+        header = f.readlines()
+    with open(outfile, 'wb') as out:
+        out.writelines(header)
+        for filename in filenames[1:]:
+            with open(filename, 'rb') as f:
+                lines = f.readlines()
+            shared = 0
+            while shared < min(len(lines), len(header)) and \
+                    lines[shared] == header[shared]:
+                shared += 1
+            out.writelines(lines[shared:])
+
+
+def merge_shard_dirs(sharddirs, normgprdir):
+    """Moves the output of every shard into one directory
+
+    Inputs:
+        sharddirs: a list of the paths to the shard directories
+        normgprdir: the path to the directory in which to save the output files
+            NOTE: output files with the same name in more than one shard
+                (e.g. the summary of the normalization) are concatenated, in
+                the order of sharddirs, so the directory looks as if all the
+                chambers had been detrended in a single job
+    """
+    # Find the new (non-link) files in each shard directory
+    shardfiles = {}
+    for sharddir in sharddirs:
+        shardfiles[sharddir] = [filename
+                for filename in sorted(glob.glob(sharddir + '/*'))
+                if not subprocess.os.path.islink(filename)]
+
+    # Group the files by name
+    names = {}
+    for sharddir in sharddirs:
+        for filename in shardfiles[sharddir]:
+            names.setdefault(subprocess.os.path.basename(filename),
+                    []).append(filename)
+
+    # Move (or concatenate) the files, then remove the shard directories
+    #   with their links
+    for name, filenames in names.items():
+        if len(filenames) > 1:
+            concatenate_shard_files(filenames, normgprdir + '/' + name)
+        else:
+            subprocess.run(['mv', filenames[0], normgprdir + '/' + name])
+    for sharddir in sharddirs:
+        subprocess.run(['rm', '-r', sharddir])
+
+
 def make_spatial_detrend_comfile(madjgprlist, analysisfile, comfile):
     """Makes a comfile for performing spatial detrending
 
@@ -63,40 +194,47 @@ def make_spatial_detrend_comfile(madjgprlist, analysisfile, comfile):
 
     # Open comfile for writing
     with open(comfile, 'w') as f:
-        f.write('perl /project/siggers/perl/GENEPIX/' +
-                'gpr_file_process_conc_series.pl\n')
-        f.write('-i ' + madjgprlist + '\n')
-        f.write('-a ' + analysisfile + '\n')
-        f.write('-keep_ctrl\n-output_norm_files\n-o norm\n-f1med')
+        f.write(spatial_detrend_command(madjgprlist, analysisfile))
 
 
-def run_spatial_detrend_comfile(comfile, madjgprdir):
-    """Runs a comfile for performing spatial detrending
+def spatial_detrend_command(madjgprlist, analysisfile):
+    """Writes the contents of a comfile for performing spatial detrending
 
     Inputs:
-        comfile: the path to the comfile to run
-        madjgprdir: the path to the directory in which the masliner adjusted
-            gpr files are stored
+        madjgprlist: the path to the list of masliner adjusted gpr files
+        analysisfile: the path to the analysis file
+
+    Output:
+        the contents of the comfile
     """
-    # Navigate to madjgprdir after saving current working directory
-    cwd = subprocess.os.getcwd()
-    subprocess.os.chdir(madjgprdir)
+    return('perl /project/siggers/perl/GENEPIX/' +
+            'gpr_file_process_conc_series.pl\n' +
+            '-i ' + madjgprlist + '\n' +
+            '-a ' + analysisfile + '\n' +
+            '-keep_ctrl\n-output_norm_files\n-o norm\n-f1med')
 
-    # Read contents of comfile as single string on one line
-    with open(comfile) as f:
-        comfilecont = f.read().replace('\n', ' ')
 
-    # Run comfile
-    logging.info('qsub -sync y -P siggers -m a -cwd -N customprobes -V -b y ' +
-            comfilecont)
-    subprocess.run(['qsub', '-sync', 'y', '-P', 'siggers', '-m', 'a', '-cwd',
-        '-N', 'customprobes', '-V', '-b', 'y', comfilecont])
+def spatial_detrend_job(comfile, sharddir, inputs):
+    """Describes a batch job for running a spatial detrending comfile
+
+    Inputs:
+        comfile: the path to the comfile to run
+        sharddir: the path to the directory in which to run the comfile
+        inputs: a list of paths to the masliner adjusted gpr files used by
+            the comfile
 
-    # Navigate back to original directory
-    subprocess.os.chdir(cwd)
+    Output:
+        a dictionary of arguments for submit_job.submit_comfile
+    """
+    # There should be a normalized gpr file for every chamber in the shard
+    return({'comfile': comfile, 'jobname': 'customprobes',
+        'stage': 'spatial_detrend', 'inputs': inputs, 'cwd': sharddir,
+        'expected': [sharddir + '/norm_madj*' + filename[-7:]
+            for filename in inputs]})
 
 
-def spatial_detrend_wrapper(madjgprdir, analysisfile, normgprdir):
+def spatial_detrend_wrapper(madjgprdir, analysisfile, normgprdir,
+        chunksize = 1):
     """Runs spatial detrending on all masliner adjusted gpr files in a directory
 
     Inputs:
@@ -104,40 +242,44 @@ def spatial_detrend_wrapper(madjgprdir, analysisfile, normgprdir):
             gpr files to use
         analysisfile: the path to the analysis file to use
         normgprdir: the path to the directory in which to save the output files
+        chunksize: the number of chambers to detrend in each batch job
+            (default: 1) The jobs for all the shards run at the same time
     """
     # If normgprdir already exists, abort to prevent overwrite
     prevent_overwrite(normgprdir)
 
-    # Get a list of all files in madjgprdir before spatial detrending
-    beforefiles = glob.glob(madjgprdir + '/*')
-
-    # Make a file listing all the masliner adjusted gpr files in madjgprdir
-    logging.info('Making a list of all masliner adjusted gpr files')
-    madjgprlist = madjgprdir + '/madj_gpr.list'
-    make_madj_gpr_list(madjgprdir, madjgprlist)
-
-    # Make a comfile for performing spatial detrending in madjgprdir
-    logging.info('Making spatial detrend comfile')
-    comfile = madjgprdir + '/process_custom_probes.com'
-    make_spatial_detrend_comfile(madjgprlist, analysisfile, comfile)
-
-    # Run spatial detrending comfile
-    logging.info('Running spatial detrend comfile ' +
+    # Find the highest intensity masliner adjusted gpr file for each chamber
+    logging.info('Finding highest intensity masliner adjusted gpr files')
+    highintfiles = find_highest_intensity_scans(madjgprdir)
+    shards = shard_chambers(highintfiles, chunksize)
+
+    # Make a directory, list and comfile for each shard
+    logging.info('Making spatial detrend comfile(s) for ' + str(len(shards)) +
+            ' shard(s)')
+    sharddirs = []
+    jobs = []
+    for chambernums, shard in shards.items():
+        sharddir = make_shard_dir(madjgprdir, chambernums, shard)
+        madjgprlist = sharddir + '/madj_gpr_' + chambernums + '.list'
+        make_madj_gpr_list(madjgprlist, shard)
+        comfile = sharddir + '/process_custom_probes_' + chambernums + '.com'
+        make_spatial_detrend_comfile(madjgprlist, analysisfile, comfile)
+        sharddirs.append(sharddir)
+        jobs.append(spatial_detrend_job(comfile, sharddir,
+            [madjgprdir + '/' + filename for filename in shard]))
+
+    # Run spatial detrending comfiles for all shards at the same time
+    logging.info('Running spatial detrend comfile(s) ' +
             '(this may take a few minutes)')
-    run_spatial_detrend_comfile(comfile, madjgprdir)
+    submit_job.submit_comfiles(jobs)
 
-    # Get a list of all files in madjgprdir after spatial detrending
-    afterfiles = glob.glob(madjgprdir + '/*')
-
-    # Get a list of all new files in madjgprdir
-    newfiles = [filename for filename in afterfiles
-            if filename not in beforefiles]
-
-    # Make a new directory and move all new files to this directory
+    # Make a new directory and move the output of every shard to it
     subprocess.run(['mkdir', normgprdir])
     logging.info('Moving files to normalized gpr directory: ' +
             normgprdir + '\n')
-    for filename in newfiles:
-        subprocess.run(['mv', filename, normgprdir])
-
+    merge_shard_dirs(sharddirs, normgprdir)
 
+    # Record how much disk space the spatial detrending output takes up
+    job_history.record_stage('spatial_detrend', job_history.total_size(
+        [madjgprdir + '/' + filename for filename in highintfiles]),
+        job_history.total_size(glob.glob(normgprdir + '/*')))
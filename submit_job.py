@@ -0,0 +1,397 @@
+import subprocess
+import re
+import glob
+import time
+import fnmatch
+import threading
+import concurrent.futures
+import logging
+import job_history
+import resource_model
+import scratch_job
+import result_cache
+import worker_pool
+
+# Settings shared by every job the pipeline submits
+#   sizing: whether to request wall time, slots and memory sized to the
+#       input of each job (otherwise the scheduler's defaults are used)
+#   retries: how many times to resubmit a job that fails
+#   backoff: how many seconds to wait before the first resubmission
+#       (the wait doubles with every further resubmission)
+#   scratch: whether to copy each job's inputs to node-local scratch, run
+#       the job there and copy its output back in one transfer
+#   cache_dir: the shared directory in which to cache the output of jobs
+#       (None turns the cache off)
+#   cache_size: the largest the cache may grow, in bytes
+#   backend: 'qsub' to submit jobs to the scheduler, or 'local' to run them
+#       in the persistent local worker pool (see worker_pool)
+#   workers: the number of jobs the local worker pool runs at the same time
+#       if it has to be started
+SETTINGS = {'sizing': True, 'retries': 2, 'backoff': 60, 'scratch': False,
+        'cache_dir': None, 'cache_size': 100 * 1024 ** 3, 'backend': 'qsub',
+        'workers': worker_pool.WORKERS}
+
+# The expected outputs of every job this run has submitted, by the directory
+#   the job runs in, so that the new files of jobs running in the same
+#   directory at the same time can be told apart
+CLAIMS = {}
+CLAIMS_LOCK = threading.Lock()
+
+# Names of the output and error files the scheduler writes for a job
+SCHEDULER_FILE = re.compile(r'\.[oe][0-9]+$')
+
+def configure(**settings):
+    """Changes the settings used for every job the pipeline submits
+
+    Inputs:
+        settings: new values for any of the keys of SETTINGS
+    """
+    for key, value in settings.items():
+        if key not in SETTINGS:
+            raise KeyError('Unknown job setting: ' + key)
+        SETTINGS[key] = value
+
+
+def parse_qsub_output(output):
+    """Extracts the job ID and exit status from the output of qsub -sync y
+
+    Inputs:
+        output: the text printed by qsub
+
+    Output:
+        the job ID (or None if it could not be found)
+        the exit status of the job (or None if it could not be found)
+    """
+    # qsub prints 'Your job <ID> ("<name>") has been submitted'
+    jobid = re.search(r'Your job (\d+)', output)
+
+    # qsub -sync y prints 'Job <ID> exited with exit code <status>.'
+    exitstatus = re.search(r'exited with exit code (\d+)', output)
+
+    return(jobid.group(1) if jobid else None,
+            int(exitstatus.group(1)) if exitstatus else None)
+
+
+def parse_memory(value):
+    """Converts a memory value reported by qacct to bytes
+
+    Inputs:
+        value: the memory value to convert (e.g. '1.234G')
+
+    Output:
+        the memory value in bytes (or None if it could not be parsed)
+    """
+    match = re.match(r'([0-9.]+)([KMGT]?)', value)
+    if match is None:
+        return(None)
+    power = ' KMGT'.index(match.group(2) or ' ')
+    return(int(float(match.group(1)) * 1024 ** power))
+
+
+def query_job_usage(jobid):
+    """Looks up the wall clock time and peak memory of a finished job
+
+    Inputs:
+        jobid: the scheduler's ID for the job
+
+    Output:
+        the wall clock time of the job in seconds
+        the peak memory usage of the job in bytes
+        NOTE: either value is None if the accounting record is unavailable
+    """
+    # Ask the scheduler for the accounting record of the job
+    try:
+        result = subprocess.run(['qacct', '-j', jobid],
+                stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                universal_newlines = True)
+    except FileNotFoundError:
+        return(None, None)
+
+    # Extract ru_wallclock and maxvmem from the record
+    wallclock = None
+    maxvmem = None
+    for l in result.stdout.splitlines():
+        fields = l.split()
+        if len(fields) < 2:
+            continue
+        if fields[0] == 'ru_wallclock':
+            wallclock = float(fields[1].rstrip('s'))
+        if fields[0] == 'maxvmem':
+            maxvmem = parse_memory(fields[1])
+
+    return(wallclock, maxvmem)
+
+
+def run_qsub(comfilecont, jobname, stage, inputbytes, cwd, attempt = 0):
+    """Submits a command as a batch job once and records its resource usage
+
+    Inputs:
+        comfilecont: the command to run
+        jobname: the name to give the job
+        stage: the pipeline stage the job belongs to
+        inputbytes: the total size of the job's input files in bytes
+        cwd: the directory in which to run the job
+        attempt: the number of times the job has already failed (default: 0)
+            Every failure doubles the resources requested
+
+    Output:
+        the exit status of the job
+        the scheduler's ID for the job (or None if it could not be found)
+    """
+    # Request resources sized to the job's input
+    resources = []
+    if SETTINGS['sizing']:
+        resources = resource_model.qsub_flags(
+                resource_model.request_resources(stage, inputbytes,
+                    attempt))
+
+    # Run command
+    command = ['qsub', '-sync', 'y', '-P', 'siggers', '-m', 'a', '-cwd',
+            '-N', jobname, '-V'] + resources + ['-b', 'y', comfilecont]
+    logging.info(' '.join(command))
+    result = subprocess.run(command, cwd = cwd, stdout = subprocess.PIPE,
+            universal_newlines = True)
+    logging.info(result.stdout.strip())
+
+    # Record how long the job took and how much memory it used
+    jobid, exitstatus = parse_qsub_output(result.stdout)
+    if jobid is not None:
+        wallclock, maxvmem = query_job_usage(jobid)
+        job_history.record_job(stage, jobname, jobid, inputbytes, wallclock,
+                maxvmem, exitstatus)
+
+    # qsub -sync y exits with the job's exit status if it cannot be parsed
+    if exitstatus is None:
+        exitstatus = result.returncode
+
+    # Return exit status and ID of job
+    return(exitstatus, jobid)
+
+
+def run_local(comfilecont, jobname, stage, inputbytes, cwd, attempt = 0):
+    """Runs a command once in the local worker pool and records its usage
+
+    Inputs:
+        comfilecont: the command to run
+        jobname: the name to give the job
+        stage: the pipeline stage the job belongs to
+        inputbytes: the total size of the job's input files in bytes
+        cwd: the directory in which to run the job
+        attempt: the number of times the job has already failed (default: 0)
+            Not used, since local jobs have no resource requests
+
+    Output:
+        the exit status of the job
+        the worker pool's ID for the job
+    """
+    # Start the worker pool if this is the first job to use it
+    worker_pool.ensure_running(workers = SETTINGS['workers'])
+
+    # Run command
+    logging.info('Running in local worker pool: ' + comfilecont)
+    try:
+        result = worker_pool.run_job(comfilecont, jobname,
+                cwd or subprocess.os.getcwd())
+
+    # Treat a worker pool that stopped during the job like a failed job, so
+    #   the job is resubmitted (to a new pool) like any other failure
+    except (OSError, ValueError) as e:
+        logging.warning('Lost the local worker pool while running ' +
+                comfilecont + ': ' + str(e))
+        return(1, None)
+    logging.info('Local job ' + str(result['jobid']) + ' exited with ' +
+            'exit code ' + str(result['exit_status']))
+
+    # Record how long the job took and how much memory it used, apart from
+    #   the batch jobs since the memory is measured differently
+    job_history.record_local_job(stage, jobname, result['jobid'], inputbytes,
+            result['wallclock'], result['maxrss'], result['exit_status'])
+
+    # Return exit status and ID of job
+    return(result['exit_status'], result['jobid'])
+
+
+def missing_outputs(expected):
+    """Finds the expected output files that a job did not make
+
+    Inputs:
+        expected: a list of paths (or glob patterns) of the expected outputs
+
+    Output:
+        a list of the paths (or glob patterns) that match no files
+    """
+    return([pattern for pattern in expected if len(glob.glob(pattern)) == 0])
+
+
+def new_job_files(jobdir, before, comfile, ownfiles):
+    """Finds the files a job made in the directory it ran in
+
+    Inputs:
+        jobdir: the absolute path to the directory the job ran in
+        before: a set of the names in jobdir before the job was submitted
+        comfile: the path to the job's comfile
+        ownfiles: the names of the job's own output and error files
+
+    Output:
+        a list of the names of the new files and directories in jobdir
+            NOTE: files that another job of this run expects to make, and the
+                output and error files of other jobs (including earlier
+                attempts of this one), are left out
+    """
+    with CLAIMS_LOCK:
+        others = [pattern for owner, patterns in CLAIMS.get(jobdir, [])
+                if owner != comfile for pattern in patterns]
+    names = []
+    for name in sorted(subprocess.os.listdir(jobdir)):
+        if name in before:
+            continue
+        if SCHEDULER_FILE.search(name) and name not in ownfiles:
+            continue
+        if any(fnmatch.fnmatch(jobdir + '/' + name, pattern)
+                for pattern in others):
+            continue
+        names.append(name)
+    return(names)
+
+
+def remove_job_files(jobdir, names):
+    """Removes the files made by a failed attempt at a job
+
+    Inputs:
+        jobdir: the absolute path to the directory the job ran in
+        names: the names of the files and directories in jobdir to remove
+    """
+    if len(names) == 0:
+        return
+    logging.warning('Removing the files made by the failed job in ' +
+            jobdir + ': ' + ', '.join(names))
+    subprocess.run(['rm', '-rf'] + [jobdir + '/' + name for name in names])
+
+
+def submit_comfile(comfile, jobname, stage, inputs, cwd = None,
+        expected = None):
+    """Submits a comfile as a batch job, resubmitting it if it fails
+
+    Inputs:
+        comfile: the path to the comfile to run
+        jobname: the name to give the job
+            This affects the names of the output and error files for this job
+        stage: the pipeline stage the job belongs to
+        inputs: a list of paths to the job's input files
+            This is used to size the job's resource request and to relate
+            the job's resource usage to its input size
+        cwd: the directory in which to run the job (default: current directory)
+        expected: a list of paths (or glob patterns) of the files the job
+            should make (default: None)
+            The job has failed if its exit status is not 0 or if any of these
+            are missing, in which case the new files it made in cwd are
+            removed and it is resubmitted (with a wait that doubles every
+            time) up to SETTINGS['retries'] times
+            If SETTINGS['cache_dir'] is set, these files and every other
+            new file the job makes in cwd are also saved in the cache, and
+            copied from it instead of running the job if an identical job
+            has already been run
+
+    Output:
+        the exit status of the job (always 0)
+    """
+    # Read contents of comfile as single string on one line
+    with open(comfile) as f:
+        comfilecont = f.read().replace('\n', ' ')
+
+    # Let other jobs in the same directory know which files are this job's
+    jobdir = subprocess.os.path.abspath(cwd or subprocess.os.getcwd())
+    with CLAIMS_LOCK:
+        CLAIMS.setdefault(jobdir, []).append((comfile,
+            [subprocess.os.path.join(jobdir, pattern)
+                for pattern in expected or []]))
+
+    # Use the cached output of an identical job if there is one
+    cachedir = SETTINGS['cache_dir']
+    key = None
+    if cachedir is not None and expected:
+        key = result_cache.job_key(stage, comfilecont, jobdir, inputs)
+        if key is not None and result_cache.fetch(cachedir, key, jobdir,
+                expected):
+            logging.info('Using cached output for ' + comfile +
+                    ' (cache key ' + key + ')')
+            return(0)
+
+    # Run the comfile on node-local scratch if requested
+    if SETTINGS['scratch']:
+        specfile = subprocess.os.path.splitext(comfile)[0] + '.scratch.json'
+        comfilecont = scratch_job.write_scratch_spec(specfile, comfilecont,
+                jobdir, inputs)
+
+    # Note which files already exist, so the job's new files can be found
+    before = set(subprocess.os.listdir(jobdir))
+
+    inputbytes = job_history.total_size(inputs)
+    for attempt in range(SETTINGS['retries'] + 1):
+        # Wait longer before each resubmission in case the failure is transient
+        if attempt > 0:
+            delay = SETTINGS['backoff'] * 2 ** (attempt - 1)
+            logging.warning('Resubmitting ' + comfile + ' in ' + str(delay) +
+                    ' seconds (attempt ' + str(attempt + 1) + ' of ' +
+                    str(SETTINGS['retries'] + 1) + ')')
+            time.sleep(delay)
+
+        # Run comfile and check that it succeeded
+        run = run_local if SETTINGS['backend'] == 'local' else run_qsub
+        exitstatus, jobid = run(comfilecont, jobname, stage, inputbytes, cwd,
+                attempt)
+        ownfiles = [jobname + '.o' + str(jobid), jobname + '.e' + str(jobid)]
+        missing = missing_outputs(expected or [])
+        if exitstatus == 0 and len(missing) == 0:
+            # Save the output (and every other file the job made, such as
+            #   its output and error files) in the cache for later runs
+            if key is not None:
+                result_cache.store(cachedir, key, jobdir, expected,
+                        new_job_files(jobdir, before, comfile, ownfiles),
+                        SETTINGS['cache_size'])
+            return(exitstatus)
+
+        # Report the failure
+        if exitstatus != 0:
+            logging.warning('Job for ' + comfile +
+                    ' exited with exit status ' + str(exitstatus))
+        else:
+            logging.warning('Job for ' + comfile +
+                    ' did not make expected output: ' + ', '.join(missing))
+
+        # Remove everything the failed attempt made before resubmitting, so
+        #   a half-written output cannot pass for the next attempt's and its
+        #   output and error files are not taken for those of the job
+        #   NOTE: the files of the last attempt are kept for checking
+        if attempt < SETTINGS['retries']:
+            remove_job_files(jobdir,
+                    new_job_files(jobdir, before, comfile, ownfiles))
+
+    # Abort if the job failed every time
+    logging.error('Job for ' + comfile + ' failed ' +
+            str(SETTINGS['retries'] + 1) + ' time(s)' +
+            '\nPlease check its output and error files and try again')
+    raise RuntimeError('Job for ' + comfile + ' failed ' +
+            str(SETTINGS['retries'] + 1) + ' time(s)' +
+            '\nPlease check its output and error files and try again')
+
+
+def submit_comfiles(jobs):
+    """Submits several comfiles as batch jobs that run at the same time
+
+    Inputs:
+        jobs: a list of dictionaries of arguments for submit_comfile
+
+    Output:
+        a list of the exit statuses of the jobs, in the same order as jobs
+        NOTE: a job that fails is resubmitted on its own while the others
+            keep running; if it still fails, the error is raised once all
+            the other jobs have finished
+    """
+    # Each qsub -sync y call waits for its job, so wait for them in threads
+    if len(jobs) == 0:
+        return([])
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = len(jobs)) as executor:
+        futures = [executor.submit(submit_comfile, **job) for job in jobs]
+        return([future.result() for future in futures])
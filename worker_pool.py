@@ -0,0 +1,405 @@
+import subprocess
+import sys
+import json
+import time
+import shlex
+import shutil
+import socket
+import argparse
+import threading
+import socketserver
+
+# Socket on which the worker pool listens for jobs
+#   The home directory is often shared between nodes, so every host gets its
+#   own socket
+SOCKET = subprocess.os.path.expanduser('~/.auto_PBM_prepro/worker_pool_' +
+        socket.gethostname() + '.sock')
+
+# Number of jobs the worker pool runs at the same time by default
+WORKERS = 4
+
+# Seconds the worker pool waits without any jobs before it shuts itself down
+IDLE_TIMEOUT = 3600
+
+# Seconds to wait for a newly started worker pool to start listening
+START_TIMEOUT = 10
+
+# The fork server that keeps Perl warm for the pipeline's Perl scripts
+PERL_SERVER = subprocess.os.path.join(subprocess.os.path.dirname(
+    subprocess.os.path.abspath(__file__)), 'perl_fork_server.pl')
+
+# Characters that make a command more than a single call of a Perl script
+SHELL_CHARACTERS = set(';&|<>()$`*?[]{}~\n')
+
+
+class WorkerPoolHandler(socketserver.StreamRequestHandler):
+    """Handles one request sent to the worker pool"""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        server = self.server
+        if 'stop' in request:
+            reply = {'stopping': True}
+            threading.Thread(target = server.shutdown).start()
+        elif 'status' in request:
+            with server.lock:
+                reply = {'pid': subprocess.os.getpid(),
+                        'workers': server.workers, 'running': server.running,
+                        'waiting': server.waiting, 'finished': server.finished,
+                        'warm': server.warm,
+                        'perl_server': server.perl is not None and
+                        server.perl.poll() is None}
+        else:
+            reply = server.run_job(request)
+        self.wfile.write((json.dumps(reply) + '\n').encode())
+
+
+class WorkerPool(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    """A long-lived local server that runs comfile commands as jobs
+
+    Commands that call one Perl script are run by a fork server
+    (perl_fork_server.pl) that keeps Perl warm: it loads the modules each
+    script uses and reads the analysis file once, and every job runs in a
+    fork of it. Any other command is run in a shell. Every request is
+    handled in its own thread, and a semaphore lets at most workers jobs run
+    at once, so later jobs wait as they would in a queue. Job IDs continue
+    from the time the pool started so that the output and error files of
+    different pools never share a name.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, workers):
+        socketserver.UnixStreamServer.__init__(self, path, WorkerPoolHandler)
+        self.workers = workers
+        self.slots = threading.Semaphore(workers)
+        self.lock = threading.Lock()
+        self.nextid = int(time.time())
+        self.running = 0
+        self.waiting = 0
+        self.finished = 0
+        self.warm = 0
+        self.lastactive = time.time()
+        self.perlsocket = path + '.perl'
+        self.perl = start_perl_server(self.perlsocket)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if self.perl is not None:
+            self.perl.terminate()
+            self.perl.wait()
+
+    def perl_request(self, request, stdout, stderr):
+        """Builds the fork server request for a job, if it can run there
+
+        Inputs:
+            request: the job request sent to the worker pool
+            stdout: the path to the job's output file
+            stderr: the path to the job's error file
+
+        Output:
+            the request for the fork server (or None if the job must run in
+                a shell)
+            NOTE: the job must call the same perl as the fork server, with
+                the same PERL5LIB, since the modules are loaded in advance
+        """
+        if self.perl is None or self.perl.poll() is not None:
+            return(None)
+        command = request['command']
+        if SHELL_CHARACTERS & set(command):
+            return(None)
+        try:
+            tokens = shlex.split(command)
+        except ValueError:
+            return(None)
+        if len(tokens) < 2 or tokens[0] != 'perl' or \
+                not tokens[1].endswith('.pl'):
+            return(None)
+        env = request.get('env')
+        if env is None or env.get('PERL5LIB') != \
+                subprocess.os.environ.get('PERL5LIB') or \
+                shutil.which('perl', path = env.get('PATH')) != \
+                shutil.which('perl'):
+            return(None)
+        return({'script': tokens[1], 'args': tokens[2:],
+            'cwd': request['cwd'], 'env': env, 'stdout': stdout,
+            'stderr': stderr})
+
+    def run_job(self, request):
+        """Runs a command the way qsub -cwd would
+
+        Inputs:
+            request: a dictionary with the command to run, the directory to
+                run it in and the name of the job
+
+        Output:
+            a dictionary with the job's ID, exit status, wall clock time in
+                seconds and peak resident set size in bytes
+        """
+        with self.lock:
+            jobid = self.nextid
+            self.nextid += 1
+            self.waiting += 1
+        with self.slots:
+            with self.lock:
+                self.waiting -= 1
+                self.running += 1
+
+            # Write the job's output and error files as the scheduler would
+            cwd = request['cwd']
+            name = request['jobname']
+            stdout = cwd + '/' + name + '.o' + str(jobid)
+            stderr = cwd + '/' + name + '.e' + str(jobid)
+            start = time.time()
+            perlrequest = self.perl_request(request, stdout, stderr)
+            if perlrequest is not None:
+                exitstatus, maxrss = run_warm(perlrequest, self.perlsocket,
+                        stderr)
+                with self.lock:
+                    self.warm += 1
+            else:
+                exitstatus, maxrss = run_shell(request['command'], cwd,
+                        request.get('env'), stdout, stderr)
+
+            with self.lock:
+                self.running -= 1
+                self.finished += 1
+                self.lastactive = time.time()
+        return({'jobid': jobid, 'exit_status': exitstatus,
+            'wallclock': time.time() - start, 'maxrss': maxrss})
+
+    def idle(self):
+        """Checks whether the pool has had nothing to do for IDLE_TIMEOUT"""
+        with self.lock:
+            return(self.running == 0 and self.waiting == 0 and
+                    time.time() - self.lastactive > IDLE_TIMEOUT)
+
+
+def start_perl_server(path):
+    """Starts the fork server that keeps Perl warm
+
+    Inputs:
+        path: the path to the socket the fork server should listen on
+
+    Output:
+        the fork server's process (or None if it could not be started, in
+            which case every job runs in a shell)
+    """
+    try:
+        process = subprocess.Popen(['perl', PERL_SERVER, path,
+            str(subprocess.os.getpid())], stdin = subprocess.DEVNULL,
+            stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+    except OSError:
+        return(None)
+
+    # Wait for it to start listening
+    waited = 0
+    while not subprocess.os.path.exists(path):
+        if process.poll() is not None or waited >= START_TIMEOUT:
+            process.kill()
+            return(None)
+        time.sleep(0.1)
+        waited += 0.1
+    return(process)
+
+
+def run_warm(request, path, stderr):
+    """Runs a Perl script in a fork of the warm fork server
+
+    Inputs:
+        request: the request for the fork server
+        path: the path to the fork server's socket
+        stderr: the path to the job's error file, for problems reaching the
+            fork server
+
+    Output:
+        the exit status of the job
+        the peak resident set size of the job in bytes (or None)
+    """
+    try:
+        reply = request_json(request, path)
+    except (OSError, ValueError) as e:
+        reply = {'error': str(e)}
+    if 'error' in reply:
+        with open(stderr, 'a') as err:
+            err.write('Could not run the job in the Perl fork server: ' +
+                    reply['error'] + '\n')
+        return(1, None)
+    return(reply['exit_status'], reply['maxrss'])
+
+
+def run_shell(command, cwd, env, stdout, stderr):
+    """Runs a command in a shell
+
+    Inputs:
+        command: the command to run
+        cwd: the directory in which to run the command
+        env: the environment in which to run the command
+        stdout: the path to the job's output file
+        stderr: the path to the job's error file
+
+    Output:
+        the exit status of the job
+        the peak resident set size of the job in bytes (or None)
+    """
+    with open(stdout, 'w') as out, open(stderr, 'w') as err:
+        try:
+            process = subprocess.Popen(command, shell = True, cwd = cwd,
+                    env = env, stdout = out, stderr = err)
+            # wait4 gives the peak resident set size of this job alone (not
+            #   the virtual memory qacct reports)
+            pid, status, usage = subprocess.os.wait4(process.pid, 0)
+            exitstatus = subprocess.os.waitstatus_to_exitcode(status)
+            process.returncode = exitstatus
+            return(exitstatus, usage.ru_maxrss * 1024)
+        except OSError as e:
+            err.write(str(e) + '\n')
+            return(1, None)
+
+
+def request_json(message, path):
+    """Sends a JSON request over a socket and waits for the JSON reply
+
+    Inputs:
+        message: the request as a dictionary
+        path: the path to the socket
+
+    Output:
+        the reply as a dictionary
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall((json.dumps(message) + '\n').encode())
+        with client.makefile() as f:
+            return(json.loads(f.readline()))
+
+
+def request(message, path = SOCKET):
+    """Sends a request to the worker pool and waits for its reply
+
+    Inputs:
+        message: the request as a dictionary
+        path: the path to the worker pool's socket
+
+    Output:
+        the reply as a dictionary
+    """
+    return(request_json(message, path))
+
+
+def is_running(path = SOCKET):
+    """Checks whether a worker pool is listening on a socket"""
+    try:
+        request({'status': True}, path)
+    except (OSError, ValueError):
+        return(False)
+    return(True)
+
+
+def ensure_running(path = SOCKET, workers = WORKERS):
+    """Starts a worker pool in the background unless one is already running
+
+    Inputs:
+        path: the path to the worker pool's socket
+        workers: the number of jobs the new pool should run at the same time
+            NOTE: a pool that is already running keeps its own number
+    """
+    if is_running(path):
+        return
+
+    # Start the pool in its own session so it outlives this run
+    subprocess.Popen([sys.executable, subprocess.os.path.abspath(__file__),
+        'start', '--socket', path, '--workers', str(workers)],
+        stdin = subprocess.DEVNULL, stdout = subprocess.DEVNULL,
+        stderr = subprocess.DEVNULL, start_new_session = True)
+
+    # Wait for it to start listening
+    waited = 0
+    while not is_running(path):
+        if waited >= START_TIMEOUT:
+            raise RuntimeError('The worker pool did not start listening on ' +
+                    path)
+        time.sleep(0.1)
+        waited += 0.1
+
+
+def run_job(command, jobname, cwd, path = SOCKET):
+    """Runs a command in the worker pool and waits for it to finish
+
+    Inputs:
+        command: the command to run
+        jobname: the name of the job, used for its output and error files
+        cwd: the directory in which to run the command
+        path: the path to the worker pool's socket
+            NOTE: the job runs with the caller's environment (as with qsub
+                -V), not the environment the worker pool was started with
+
+    Output:
+        a dictionary with the job's ID, exit status, wall clock time in
+            seconds and peak resident set size in bytes
+    """
+    return(request({'command': command, 'jobname': jobname,
+        'cwd': subprocess.os.path.abspath(cwd),
+        'env': dict(subprocess.os.environ)}, path))
+
+
+def serve(path, workers):
+    """Runs a worker pool until it is stopped or has been idle too long
+
+    Inputs:
+        path: the path to the socket to listen on
+        workers: the number of jobs to run at the same time
+    """
+    subprocess.os.makedirs(subprocess.os.path.dirname(path), exist_ok = True)
+
+    # Remove the socket of a pool that did not shut down cleanly
+    if subprocess.os.path.exists(path):
+        if is_running(path):
+            raise RuntimeError('A worker pool is already listening on ' + path)
+        subprocess.os.remove(path)
+
+    server = WorkerPool(path, workers)
+
+    # Shut down once there has been nothing to do for a while
+    def watch():
+        while True:
+            time.sleep(60)
+            if server.idle():
+                server.shutdown()
+                return
+    threading.Thread(target = watch, daemon = True).start()
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if subprocess.os.path.exists(path):
+            subprocess.os.remove(path)
+
+
+if __name__ == '__main__':
+    # Create object for handling command line arguments
+    parser = argparse.ArgumentParser(
+            description = 'Runs, stops or reports on the persistent local ' +
+            'worker pool that runs batch jobs without qsub')
+    parser.add_argument('command', choices = ['start', 'stop', 'status'],
+            help = 'start: run a worker pool in the foreground; stop: ask ' +
+            'the running worker pool to shut down; status: report what the ' +
+            'running worker pool is doing')
+    parser.add_argument('--socket', default = SOCKET,
+            help = 'the path to the worker pool\'s socket (default: ' +
+            SOCKET + ')')
+    parser.add_argument('--workers', default = WORKERS, type = int,
+            help = 'the number of jobs to run at the same time (default: ' +
+            str(WORKERS) + ')')
+    args = parser.parse_args()
+
+    if args.command == 'start':
+        serve(args.socket, args.workers)
+    elif not is_running(args.socket):
+        print('No worker pool is listening on ' + args.socket)
+        sys.exit(1)
+    elif args.command == 'stop':
+        request({'stop': True}, args.socket)
+    else:
+        print(json.dumps(request({'status': True}, args.socket), indent = 1))